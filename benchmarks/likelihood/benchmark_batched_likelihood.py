@@ -0,0 +1,75 @@
+"""Throughput of the batched posterior (Fiesta.posterior_batch) against the vmapped single-point posterior (Fiesta.posterior) that flowMC uses, in chains per second."""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from fiesta.inference.lightcurve_model import AfterglowFlux
+from fiesta.inference.likelihood import EMLikelihood
+from fiesta.inference.prior import Uniform, CompositePrior
+from fiesta.inference.fiesta import Fiesta
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--name", type=str, default="flux", help="Name of the flux model.")
+parser.add_argument("--model-dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "..", "tests", "models"), help="Directory of the flux model.")
+parser.add_argument("--filters", type=str, nargs="+", default=["radio-3GHz", "radio-6GHz", "bessellb", "bessellv", "bessellr", "besselli"])
+parser.add_argument("--n-obs", type=int, default=50, help="Number of observations per filter.")
+parser.add_argument("--n-chains", type=int, nargs="+", default=[100, 1_000, 10_000])
+parser.add_argument("--n-repeat", type=int, default=20)
+args = parser.parse_args()
+
+#############
+### SETUP ###
+#############
+
+model = AfterglowFlux(name=args.name, directory=args.model_dir, filters=args.filters)
+
+# mock observations between the first and last time of the model grid, a fifth of them non-detections
+rng = np.random.default_rng(0)
+data = {}
+for filt in model.filters:
+    times = np.sort(rng.uniform(model.times[0], model.times[-1], args.n_obs))
+    mag_err = np.where(rng.uniform(size=args.n_obs) < 0.2, np.inf, 0.1)
+    data[filt] = np.array([times, rng.normal(22, 1, args.n_obs), mag_err]).T
+
+likelihood = EMLikelihood(model, data, filters=model.filters.copy(), fixed_params={"luminosity_distance": 40.0, "redshift": 0.01})
+
+priors = []
+for name, (xmin, xmax, _) in model.parameter_distributions.items():
+    priors.append(Uniform(xmin=float(xmin), xmax=float(xmax), naming=[name]))
+prior = CompositePrior(priors)
+
+fiesta = Fiesta(likelihood, prior, n_chains=2, n_loop_training=1, n_loop_production=1)
+
+#################
+### BENCHMARK ###
+#################
+
+posterior_vmap = jax.jit(jax.vmap(fiesta.posterior, in_axes=(0, None)))
+posterior_batch = jax.jit(fiesta.posterior_batch)
+
+def get_throughput(func, params) -> tuple[float, float]:
+    start = time.perf_counter()
+    func(params, None).block_until_ready()
+    compile_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    for _ in range(args.n_repeat):
+        func(params, None).block_until_ready()
+    return compile_time, args.n_repeat * len(params) / (time.perf_counter() - start)
+
+print(f"\nBenchmarking {model.name} with {len(model.filters)} filters and {len(likelihood.obs_times)} observations on {jax.devices()[0].platform}.")
+print(f"{'n_chains':>10} {'vmap [chains/s]':>18} {'batch [chains/s]':>18} {'speedup':>8} {'compile vmap [s]':>17} {'compile batch [s]':>18}")
+for n_chains in args.n_chains:
+    samples = prior.sample(jax.random.key(n_chains), n_chains)
+    params = jnp.stack([samples[name] for name in prior.naming]).T
+    
+    assert jnp.allclose(posterior_vmap(params, None), posterior_batch(params, None), rtol=1e-4)
+    compile_vmap, throughput_vmap = get_throughput(posterior_vmap, params)
+    compile_batch, throughput_batch = get_throughput(posterior_batch, params)
+    print(f"{n_chains:>10} {throughput_vmap:>18.0f} {throughput_batch:>18.0f} {throughput_batch / throughput_vmap:>8.2f} {compile_vmap:>17.2f} {compile_batch:>18.2f}")
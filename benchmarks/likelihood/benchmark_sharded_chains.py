@@ -0,0 +1,76 @@
+"""Throughput of the local sampler steps of Fiesta with the chains sharded across several host devices, in chain steps per second."""
+
+import argparse
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--name", type=str, default="flux", help="Name of the flux model.")
+parser.add_argument("--model-dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "..", "tests", "models"), help="Directory of the flux model.")
+parser.add_argument("--filters", type=str, nargs="+", default=["radio-3GHz", "radio-6GHz", "bessellb", "bessellv", "bessellr", "besselli"])
+parser.add_argument("--n-obs", type=int, default=50, help="Number of observations per filter.")
+parser.add_argument("--n-devices", type=int, default=os.cpu_count(), help="Number of XLA host devices.")
+parser.add_argument("--n-chains", type=int, default=1_024)
+parser.add_argument("--n-local-steps", type=int, default=50)
+parser.add_argument("--n-repeat", type=int, default=5)
+args = parser.parse_args()
+
+# the host devices need to be set up before jax is initialized
+os.environ["XLA_FLAGS"] = os.environ.get("XLA_FLAGS", "") + f" --xla_force_host_platform_device_count={args.n_devices}"
+
+import time
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from fiesta.inference.lightcurve_model import AfterglowFlux
+from fiesta.inference.likelihood import EMLikelihood
+from fiesta.inference.prior import Uniform, CompositePrior
+from fiesta.inference.fiesta import Fiesta
+
+#############
+### SETUP ###
+#############
+
+model = AfterglowFlux(name=args.name, directory=args.model_dir, filters=args.filters)
+
+# mock observations between the first and last time of the model grid, a fifth of them non-detections
+rng = np.random.default_rng(0)
+data = {}
+for filt in model.filters:
+    times = np.sort(rng.uniform(model.times[0], model.times[-1], args.n_obs))
+    mag_err = np.where(rng.uniform(size=args.n_obs) < 0.2, np.inf, 0.1)
+    data[filt] = np.array([times, rng.normal(22, 1, args.n_obs), mag_err]).T
+
+likelihood = EMLikelihood(model, data, filters=model.filters.copy(), fixed_params={"luminosity_distance": 40.0, "redshift": 0.01})
+
+priors = []
+for name, (xmin, xmax, _) in model.parameter_distributions.items():
+    priors.append(Uniform(xmin=float(xmin), xmax=float(xmax), naming=[name]))
+prior = CompositePrior(priors)
+
+#################
+### BENCHMARK ###
+#################
+
+def get_throughput(shard_chains: bool) -> float:
+    fiesta = Fiesta(likelihood, prior, n_chains=args.n_chains, n_local_steps=args.n_local_steps, shard_chains=shard_chains,
+                    local_sampler_arg={"step_size": 1e-3 * jnp.eye(prior.n_dim)})
+    samples = prior.sample(jax.random.key(0), args.n_chains)
+    positions = fiesta.shard_positions(jnp.stack([samples[name] for name in prior.naming]).T)
+    data = fiesta.get_sampler_data()
+    sampler = fiesta.Sampler.local_sampler
+
+    # the first call compiles the local sampler
+    keys, chains, *_ = sampler.sample(fiesta.Sampler.rng_keys_mcmc, args.n_local_steps, positions, data)
+    start = time.perf_counter()
+    for _ in range(args.n_repeat):
+        keys, chains, *_ = sampler.sample(keys, args.n_local_steps, chains[:, -1], data)
+    chains.block_until_ready()
+    return args.n_repeat * args.n_local_steps * args.n_chains / (time.perf_counter() - start)
+
+print(f"\nBenchmarking MALA steps of {args.n_chains} chains with {model.name}, {len(model.filters)} filters and {len(likelihood.obs_times)} observations.")
+throughput_single = get_throughput(shard_chains=False)
+throughput_sharded = get_throughput(shard_chains=True)
+print(f"{'devices':>8} {'single [steps/s]':>18} {'sharded [steps/s]':>18} {'speedup':>8}")
+print(f"{len(jax.devices()):>8} {throughput_single:>18.0f} {throughput_sharded:>18.0f} {throughput_sharded / throughput_single:>8.2f}")
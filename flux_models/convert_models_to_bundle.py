@@ -0,0 +1,17 @@
+"""Convert the shipped surrogate models from pickle files into single-file bundles that can be memory-mapped."""
+import glob
+import os
+
+from fiesta.inference.bundle import convert_to_bundle
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+model_dirs = glob.glob(os.path.join(base_dir, "*", "model")) + glob.glob(os.path.join(base_dir, "..", "lightcurve_models", "*", "model"))
+
+for model_dir in sorted(model_dirs):
+    for meta_file in glob.glob(os.path.join(model_dir, "*_metadata.pkl")):
+        name = os.path.basename(meta_file)[:-len("_metadata.pkl")]
+        try:
+            convert_to_bundle(model_dir, name)
+        except FileNotFoundError as e:
+            print(f"Skipping {name} in {model_dir}, the network files are missing: {e}")
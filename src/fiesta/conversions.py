@@ -161,6 +161,22 @@ def integrated_AB_mag(flux: Float[Array, "n_nus n_times"],
     mag = mJys_to_mag_jnp(mJys) 
     return mag
 
+def weighted_AB_mag(log_flux: Float[Array, "n_nus n_times"],
+                    weights: Float[Array, "n_filters n_nus"],
+                    offsets: Float[Array, "n_filters"]) -> Float[Array, "n_filters n_times"]:
+    """
+    AB magnitudes of several filters at once, for filters whose band flux is a linear functional of the spectral flux density, see fiesta.filters.Filter.get_mag_weights.
+    The weights of all filters are contracted with the flux in a single matrix product instead of one interpolation and integration per filter and time.
+
+    Args:
+        log_flux (Float[Array, "n_nus n_times"]): Natural logarithm of the spectral flux density in mJys.
+        weights (Float[Array, "n_filters n_nus"]): Weights of the flux density at the frequencies of log_flux for each filter.
+        offsets (Float[Array, "n_filters"]): Magnitude offsets of the filters.
+    """
+    max_log_flux = jnp.max(log_flux, axis=0) # make the flux between 0 and 1, otherwise infs could appear
+    band_flux = weights @ jnp.exp(log_flux - max_log_flux)
+    return -2.5 * (jnp.log10(band_flux) + max_log_flux / jnp.log(10)) + offsets[:, None]
+
 @jax.jit
 def mJys_to_mag_jnp(mJys: Array):
     mag = -48.6 + -1 * jnp.log10(mJys) * 2.5 + 26 * 2.5 # https://en.wikipedia.org/wiki/AB_magnitude
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import re
 
 import jax
@@ -91,6 +92,38 @@ class Filter:
             self.get_mag = lambda Fnu, nus: integrated_AB_mag(Fnu, nus, self.nus, self.trans)
 
     
+    def get_mag_weights(self, nus: Float[Array, "n_nus"]) -> tuple[Float[Array, "n_nus"], Float]:
+        """
+        Linear weights W and an offset such that get_mag(Fnu, nus) = -2.5 log10(W @ Fnu) + offset.
+        The interpolation of Fnu onto the filter frequencies and the integration over the bandpass are both linear in Fnu, so they are absorbed into W.
+
+        Args:
+            nus (Float[Array, "n_nus"]): Frequencies of the spectral flux density in Hz, in increasing order.
+
+        Returns:
+            W (Float[Array, "n_nus"]): Weights of the flux density at nus.
+            offset (Float): Magnitude offset.
+        """
+        if self.filt_type == "monochromatic":
+            quadrature = self.trans
+            offset = -48.6 + 26 * 2.5 # see mJys_to_mag_jnp
+        else:
+            dnus = jnp.diff(self.nus)
+            quadrature = jnp.zeros(len(self.nus)).at[:-1].add(dnus / 2).at[1:].add(dnus / 2) # trapezoidal rule
+            if self.filt_type == "bandpass":
+                quadrature = quadrature * self.trans / (constants.h_erg_s * self.nus)
+                offset = 2.5 * jnp.log10(self.ref_flux)
+            else:
+                quadrature = quadrature * self.trans / (self.nus[-1] - self.nus[0])
+                offset = -48.6 + 26 * 2.5
+        
+        # linear interpolation weights with constant extrapolation, as in jnp.interp
+        nus = jnp.asarray(nus)
+        idx = jnp.clip(jnp.searchsorted(nus, self.nus, side="right"), 1, len(nus) - 1)
+        weight = jnp.clip((self.nus - nus[idx - 1]) / (nus[idx] - nus[idx - 1]), 0., 1.)
+        W = jnp.zeros(len(nus)).at[idx - 1].add(quadrature * (1 - weight)).at[idx].add(quadrature * weight)
+        return W, offset
+    
     def _calculate_ref_flux(self,):
         """method to determine the reference flux for the magnitude conversion."""
         if self.filt_type in ["monochromatic", "integrated"]:
@@ -106,4 +139,13 @@ class Filter:
             return self.get_mag(flux, nus)
         
         mags = jax.vmap(get_single)(fluxes)
-        return mags
\ No newline at end of file
+        return mags
+
+
+@lru_cache(maxsize=None)
+def get_filter(name: str) -> Filter:
+    """
+    Shared Filter object for the given name, so that the bandpass is only loaded from sncosmo once per process.
+    The returned object should not be modified.
+    """
+    return Filter(name)
@@ -0,0 +1,122 @@
+"""Ahead-of-time export of surrogate predictions and the persistent compilation cache."""
+
+import hashlib
+import json
+import os
+
+import jax
+import numpy as np
+from jax import export
+from jax.experimental.compilation_cache import compilation_cache
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fiesta")
+EXPORT_EXTENSION = ".jaxexport"
+
+def get_cache_dir(cache_dir: str = None) -> str:
+    """The fiesta cache directory: cache_dir if given, else the environment variable FIESTA_CACHE_DIR or ~/.cache/fiesta."""
+    if cache_dir is None:
+        cache_dir = os.environ.get("FIESTA_CACHE_DIR", DEFAULT_CACHE_DIR)
+    return cache_dir
+
+#########################
+### COMPILATION CACHE ###
+#########################
+
+def enable_compilation_cache(cache_dir: str = None,
+                             max_size: int = -1) -> str:
+    """
+    Enable the persistent compilation cache of jax, so that compiled executables (e.g. of the likelihood) are reused across processes.
+    Every compilation is cached, irrespective of its compile time and size. This changes the global jax configuration and is only done if called explicitly.
+
+    Args:
+        cache_dir (str): Cache directory. Defaults to the environment variable FIESTA_CACHE_DIR or ~/.cache/fiesta.
+        max_size (int): Maximum size of the cache in bytes, the least recently used entries are removed beyond. Defaults to -1, i.e. no limit.
+
+    Returns:
+        str: The cache directory.
+    """
+    cache_dir = os.path.join(get_cache_dir(cache_dir), "jax")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    previous_cache_dir = jax.config.jax_compilation_cache_dir
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0.)
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+    jax.config.update("jax_compilation_cache_max_size", max_size)
+    # the cache is set up at the first compilation, so it only has to be reset if it was set up for another directory
+    if compilation_cache.is_initialized() and previous_cache_dir != cache_dir:
+        compilation_cache.reset_cache()
+    return cache_dir
+
+#######################
+### EXPORTED MODELS ###
+#######################
+
+def get_array_hash(array) -> str:
+    """Hash of the values of an array, e.g. of a time grid that an output subset of a model has cut down."""
+    return hashlib.sha256(np.ascontiguousarray(array, dtype=np.float64).tobytes()).hexdigest()
+
+def get_export_key(model) -> str:
+    """
+    Hash of everything that determines the exported predict function of a model: the model files, filters, output grid, precision and float width.
+    """
+    # the file the model was loaded from, a stale bundle is not used
+    if model.bundle is not None:
+        model_file = model.bundle.filename
+    else:
+        model_file = os.path.join(model.directory, f"{model.name}_metadata.pkl")
+    stat = os.stat(model_file)
+
+    key = {"model_file": [os.path.basename(model_file), stat.st_size, stat.st_mtime_ns],
+           "filters": list(model.filters),
+           "times": get_array_hash(model.times),
+           "nus": get_array_hash(getattr(model, "nus", [])),
+           "precision": model.precision,
+           "x64": jax.config.jax_enable_x64,
+           "platform": export.default_export_platform(),
+           "jax": jax.__version__}
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()[:16]
+
+def export_predict(model) -> export.Exported:
+    """
+    Export the batched magnitude prediction of a model with a symbolic batch dimension, so that it can be called with any batch size without recompilation.
+
+    Args:
+        model (SurrogateModel): The surrogate model.
+
+    Returns:
+        export.Exported: Exported function with signature (X, luminosity_distance, redshift) -> mag, see SurrogateModel.predict_mag_batch.
+    """
+    b, = export.symbolic_shape("b")
+    dtype = jax.numpy.result_type(float)
+    args = (jax.ShapeDtypeStruct((b, len(model.parameter_names)), dtype),
+            jax.ShapeDtypeStruct((b,), dtype),
+            jax.ShapeDtypeStruct((b,), dtype))
+    return export.export(jax.jit(jax.vmap(model.predict_mag_array)))(*args)
+
+def get_exported_predict(model, directory: str = None) -> export.Exported:
+    """
+    Load the exported predict function of a model from directory, or export it and save it there if it does not exist yet.
+
+    Args:
+        model (SurrogateModel): The surrogate model.
+        directory (str): Directory of the exported functions. Defaults to the subdirectory exported of the fiesta cache directory, see get_cache_dir.
+
+    Returns:
+        export.Exported: The exported predict function.
+    """
+    if directory is None:
+        directory = os.path.join(get_cache_dir(), "exported")
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f"{model.name}_predict_{get_export_key(model)}{EXPORT_EXTENSION}")
+
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            return export.deserialize(bytearray(f.read()))
+
+    exported = export_predict(model)
+    with open(filename, "wb") as f:
+        f.write(exported.serialize())
+    print(f"Saved exported predict function of {model.name} to {filename}.")
+    return exported
@@ -0,0 +1,307 @@
+"""Single-file model bundles: a JSON header followed by raw little-endian arrays that are memory-mapped on loading."""
+
+import json
+import os
+import pickle
+import struct
+
+import dill
+import jax.numpy as jnp
+import numpy as np
+from flax.training.train_state import TrainState
+
+import fiesta.scalers as fiesta_scalers
+import fiesta.train.neuralnets as fiesta_nn
+import fiesta.train.nn_architectures as nn
+
+
+MAGIC = b"FIESTA\x00\x01"
+ALIGNMENT = 64 # alignment of the arrays in bytes
+BUNDLE_EXTENSION = ".fiesta"
+
+#################
+### UTILITIES ###
+#################
+
+def get_bundle_filename(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{name}{BUNDLE_EXTENSION}")
+
+def get_file_fingerprint(filename: str) -> dict:
+    """Size and modification time of a file, used to detect pickle files that changed after the conversion to a bundle."""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+class LegacyUnpickler(dill.Unpickler):
+    """Unpickler for old metadata files, in which the scalers were still located in fiesta.utils."""
+    def find_class(self, module: str, name: str):
+        if module == "fiesta.utils" and hasattr(fiesta_scalers, name):
+            module = "fiesta.scalers"
+        return super().find_class(module, name)
+
+def get_closure_variable(func: callable, name: str):
+    """Get the value of the free variable name of a closure, used for ImageScaler objects that do not store their shapes."""
+    return func.__closure__[func.__code__.co_freevars.index(name)].cell_contents
+
+def build_state(model_type: str,
+                params: dict,
+                config: fiesta_nn.NeuralnetConfig) -> TrainState:
+    """
+    Create the TrainState of a network for inference only, i.e. without optimizer.
+
+    Args:
+        model_type (str): Either 'MLP', 'MLPEnsemble', or 'CVAE'. For a CVAE, the params are those of the decoder.
+        params (dict): Network parameters.
+        config (NeuralnetConfig): Configuration of the network.
+
+    Returns:
+        TrainState: TrainState without optimizer state.
+    """
+    if model_type in ["MLP", "MLPEnsemble"]:
+        net = nn.MLP(config.layer_sizes) # ensemble members are stacked in the params
+    elif model_type == "CVAE":
+        net = nn.Decoder(layer_sizes = [*config.hidden_layer_sizes[::-1], config.output_size])
+    else:
+        raise ValueError(f"Model type must be either 'MLP', 'MLPEnsemble', or 'CVAE'.")
+    return TrainState(step=0, apply_fn=net.apply, params=params, tx=None, opt_state=None)
+
+##############
+### WRITER ###
+##############
+
+class BundleWriter:
+    """Collects the arrays of a bundle and replaces them by references into the data section."""
+
+    def __init__(self):
+        self.arrays = []
+        self.nbytes = 0
+
+    def add_array(self, array) -> dict:
+        array = np.asarray(array)
+        array = array.astype(array.dtype.newbyteorder("<"))
+        self.nbytes += -self.nbytes % ALIGNMENT
+        ref = {"__array__": {"offset": self.nbytes, "dtype": array.dtype.str, "shape": list(array.shape)}}
+        self.arrays.append((self.nbytes, array))
+        self.nbytes += array.nbytes
+        return ref
+
+    def add_tree(self, tree):
+        if isinstance(tree, dict):
+            return {key: self.add_tree(value) for key, value in tree.items()}
+        return self.add_array(tree)
+
+    def add_scaler(self, scaler: fiesta_scalers.Scaler) -> dict:
+        spec = {"type": type(scaler).__name__, "attributes": {}}
+
+        if isinstance(scaler, fiesta_scalers.DataScaler):
+            spec["scalers"] = [self.add_scaler(s) for s in scaler.scalers]
+            return spec
+        elif isinstance(scaler, fiesta_scalers.ParameterScaler):
+            spec["scaler"] = self.add_scaler(scaler.scaler)
+            spec["attributes"] = {"parameter_names": list(scaler.parameter_names),
+                                  "conversion": scaler.conversion.__name__}
+            return spec
+        elif isinstance(scaler, fiesta_scalers.ImageScaler):
+            downscale = getattr(scaler, "downscale", None)
+            if downscale is None:
+                downscale = get_closure_variable(scaler.transform, "downscale")
+            upscale = getattr(scaler, "upscale", None)
+            if upscale is None:
+                upscale = get_closure_variable(scaler.transform, "upscale")
+            spec["attributes"] = {"downscale": [int(d) for d in downscale], "upscale": [int(u) for u in upscale]}
+            return spec
+
+        for key, value in vars(scaler).items():
+            if isinstance(value, fiesta_scalers.Scaler):
+                spec["attributes"][key] = {"__scaler__": self.add_scaler(value)}
+            elif isinstance(value, (np.ndarray, jnp.ndarray)):
+                spec["attributes"][key] = self.add_array(value)
+            elif isinstance(value, np.generic):
+                spec["attributes"][key] = value.item()
+            elif isinstance(value, (int, float, str, bool)) or value is None:
+                spec["attributes"][key] = value
+            else:
+                raise ValueError(f"Attribute {key} of type {type(value).__name__} of {type(scaler).__name__} cannot be stored in a bundle.")
+        return spec
+
+    def write(self, filename: str, header: dict) -> None:
+        header = json.dumps(header).encode("utf-8")
+        data_start = len(MAGIC) + 8 + len(header)
+        data_start += -data_start % ALIGNMENT
+
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for offset, array in self.arrays:
+                f.seek(data_start + offset)
+                f.write(array.tobytes())
+
+def convert_to_bundle(directory: str,
+                      name: str,
+                      outfile: str = None) -> str:
+    """
+    Convert a model that is saved as pickle files (metadata and networks) into a single bundle file.
+
+    Args:
+        directory (str): Directory with the model files.
+        name (str): Name of the model.
+        outfile (str): Filename of the bundle. Defaults to {directory}/{name}.fiesta.
+
+    Returns:
+        str: Filename of the bundle.
+    """
+    with open(os.path.join(directory, f"{name}_metadata.pkl"), "rb") as meta_file:
+        metadata = LegacyUnpickler(meta_file).load()
+
+    writer = BundleWriter()
+    model_type = metadata.get("model_type", "MLP")
+    header = {"name": name,
+              "model_type": model_type,
+              "parameter_names": list(metadata["parameter_names"]),
+              "parameter_distributions": metadata["parameter_distributions"],
+              "times": writer.add_array(metadata["times"]),
+              "X_scaler": writer.add_scaler(metadata["X_scaler"])}
+
+    if "nus" in metadata:
+        header["nus"] = writer.add_array(metadata["nus"])
+        header["y_scaler"] = writer.add_scaler(metadata["y_scaler"])
+        network_files = {name: f"{name}.pkl"}
+    else:
+        header["y_scaler"] = {filt: writer.add_scaler(scaler) for filt, scaler in metadata["y_scaler"].items()}
+        network_files = {filt: f"{name}_{filt}.pkl" for filt in metadata["y_scaler"].keys()}
+
+    header["networks"] = {}
+    for key, network_file in network_files.items():
+        with open(os.path.join(directory, network_file), "rb") as handle:
+            loaded_dict = pickle.load(handle)
+        params = loaded_dict["params"]
+        if model_type == "CVAE":
+            params = params["decoder"] # only the decoder is needed for inference
+        header["networks"][key] = {"config": loaded_dict["config"].to_dict(),
+                                   "params": writer.add_tree(params)}
+
+    source_files = [f"{name}_metadata.pkl", *network_files.values()]
+    header["sources"] = {filename: get_file_fingerprint(os.path.join(directory, filename)) for filename in source_files}
+
+    if outfile is None:
+        outfile = get_bundle_filename(directory, name)
+    writer.write(outfile, header)
+    print(f"Saved bundle of {name} to {outfile}.")
+    return outfile
+
+##############
+### READER ###
+##############
+
+class ModelBundle:
+    """
+    Read-only access to a model bundle. The file is memory-mapped, such that the arrays are only read when they are used and the pages can be shared between processes.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a fiesta model bundle.")
+            header_length, = struct.unpack("<Q", f.read(8))
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+
+        data_start = len(MAGIC) + 8 + header_length
+        data_start += -data_start % ALIGNMENT
+        self.buffer = np.memmap(filename, dtype=np.uint8, mode="r")[data_start:]
+
+        self.name = self.header["name"]
+        self.model_type = self.header["model_type"]
+        self.network_keys = list(self.header["networks"].keys())
+
+    def is_stale(self, directory: str) -> bool:
+        """
+        Whether one of the pickle files the bundle was converted from exists in directory and changed since the conversion, e.g. because the model was retrained.
+        Bundles without a record of their sources are stale if the metadata pickle exists.
+        """
+        sources = self.header.get("sources")
+        if sources is None:
+            return os.path.exists(os.path.join(directory, f"{self.name}_metadata.pkl"))
+        for filename, fingerprint in sources.items():
+            filename = os.path.join(directory, filename)
+            if os.path.exists(filename) and get_file_fingerprint(filename) != fingerprint:
+                return True
+        return False
+
+    def get_array(self, ref: dict) -> np.ndarray:
+        ref = ref["__array__"]
+        dtype = np.dtype(ref["dtype"])
+        nbytes = int(np.prod(ref["shape"])) * dtype.itemsize
+        return self.buffer[ref["offset"]:ref["offset"] + nbytes].view(dtype).reshape(ref["shape"])
+
+    def get_tree(self, tree: dict):
+        if "__array__" in tree:
+            return jnp.asarray(self.get_array(tree))
+        return {key: self.get_tree(value) for key, value in tree.items()}
+
+    def get_scaler(self, spec: dict) -> fiesta_scalers.Scaler:
+        cls = getattr(fiesta_scalers, spec["type"], None)
+        if not (isinstance(cls, type) and issubclass(cls, fiesta_scalers.Scaler)):
+            raise ValueError(f"Unknown scaler type {spec['type']} in {self.filename}.")
+        attributes = spec["attributes"]
+
+        if cls is fiesta_scalers.DataScaler:
+            return fiesta_scalers.DataScaler([self.get_scaler(s) for s in spec["scalers"]])
+        elif cls is fiesta_scalers.ParameterScaler:
+            return fiesta_scalers.ParameterScaler(self.get_scaler(spec["scaler"]), **attributes)
+        elif cls is fiesta_scalers.ImageScaler:
+            return fiesta_scalers.ImageScaler(**attributes)
+
+        scaler = cls.__new__(cls)
+        for key, value in attributes.items():
+            if isinstance(value, dict) and "__array__" in value:
+                value = jnp.asarray(self.get_array(value))
+            elif isinstance(value, dict) and "__scaler__" in value:
+                value = self.get_scaler(value["__scaler__"])
+            setattr(scaler, key, value)
+        return scaler
+
+    @property
+    def metadata(self) -> dict:
+        """Metadata in the same format as the metadata pickle files."""
+        metadata = {"model_type": self.model_type,
+                    "parameter_names": self.header["parameter_names"],
+                    "parameter_distributions": self.header["parameter_distributions"],
+                    "times": np.asarray(self.get_array(self.header["times"])),
+                    "X_scaler": self.get_scaler(self.header["X_scaler"])}
+
+        if "nus" in self.header:
+            metadata["nus"] = np.asarray(self.get_array(self.header["nus"]))
+            metadata["y_scaler"] = self.get_scaler(self.header["y_scaler"])
+        else:
+            metadata["y_scaler"] = {filt: self.get_scaler(spec) for filt, spec in self.header["y_scaler"].items()}
+        return metadata
+
+    def load_network(self, key: str) -> tuple[TrainState, fiesta_nn.NeuralnetConfig]:
+        """
+        Load a single network from the bundle.
+
+        Args:
+            key (str): Filter for lightcurve models, name of the model for flux models.
+
+        Returns:
+            tuple[TrainState, NeuralnetConfig]: The TrainState without optimizer and the config of the network.
+        """
+        network = self.header["networks"][key]
+        config = {k: v for k, v in network["config"].items() if k != "layer_sizes"}
+        config = fiesta_nn.NeuralnetConfig(**config)
+        params = self.get_tree(network["params"])
+        return build_state(self.model_type, params, config), config
+
+class LazyNetworks(dict):
+    """Dictionary of networks that are only loaded from the bundle when they are accessed for the first time."""
+
+    def __init__(self, bundle: ModelBundle):
+        super().__init__()
+        self.bundle = bundle
+
+    def __missing__(self, key: str) -> TrainState:
+        state, _ = self.bundle.load_network(key)
+        self[key] = state
+        return state
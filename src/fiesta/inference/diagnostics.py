@@ -0,0 +1,94 @@
+"""Convergence diagnostics of the chains computed on the device: rank-normalized split-R-hat, bulk and tail effective sample size (Vehtari et al. 2021) and the plateau of the loss of the normalizing flow."""
+
+import jax
+import jax.numpy as jnp
+from jax.scipy.special import ndtri
+from jaxtyping import Array, Float
+
+
+def split_chains(x: Float[Array, "n_chains n_steps"]) -> Float[Array, "2*n_chains n_steps//2"]:
+    """Split every chain into its first and second half, dropping the middle step for an odd number of steps."""
+    n_half = x.shape[1] // 2
+    return jnp.concatenate([x[:, :n_half], x[:, x.shape[1] - n_half:]])
+
+def rank_normalize(x: Float[Array, "n_chains n_steps"]) -> Float[Array, "n_chains n_steps"]:
+    """Replace the draws by the normal quantiles of their fractional ranks over all chains, ties get the average rank."""
+    sorted_x = jnp.sort(x.ravel())
+    rank = (jnp.searchsorted(sorted_x, x, side="left") + jnp.searchsorted(sorted_x, x, side="right") + 1) / 2
+    return ndtri((rank - 3/8) / (x.size + 1/4))
+
+def rhat(x: Float[Array, "n_chains n_steps"]) -> Float:
+    """Potential scale reduction of the chains, comparing the variance between and within the chains."""
+    n_steps = x.shape[1]
+    between = n_steps * jnp.var(jnp.mean(x, axis=1), ddof=1)
+    within = jnp.mean(jnp.var(x, axis=1, ddof=1))
+    return jnp.sqrt(((n_steps - 1) / n_steps * within + between / n_steps) / within)
+
+def ess(x: Float[Array, "n_chains n_steps"]) -> Float:
+    """
+    Effective sample size of the chains from their autocorrelation, truncated with Geyer's initial monotone sequence.
+    The autocovariance is computed with a FFT for all chains at once.
+    """
+    n_chains, n_steps = x.shape
+    chain_mean = jnp.mean(x, axis=1)
+    x = x - chain_mean[:, None]
+    spectrum = jnp.fft.rfft(x, n=2 * n_steps, axis=1)
+    acov = jnp.fft.irfft(spectrum * jnp.conj(spectrum), axis=1)[:, :n_steps] / n_steps
+
+    chain_var = acov[:, 0] * n_steps / (n_steps - 1)
+    mean_var = jnp.mean(chain_var)
+    var_plus = mean_var * (n_steps - 1) / n_steps
+    if n_chains > 1:
+        var_plus += jnp.var(chain_mean, ddof=1)
+    rho = 1 - (mean_var - jnp.mean(acov, axis=0)) / var_plus
+    rho = rho.at[0].set(1.)
+
+    # sums of pairs of autocorrelations, up to the first negative one and made monotone
+    n_pairs = n_steps // 2
+    pairs = rho[:2 * n_pairs:2] + rho[1:2 * n_pairs:2]
+    positive = jnp.cumprod(pairs > 0)
+    pairs = jax.lax.cummin(jnp.where(positive, pairs, 0.))
+    tau = jnp.maximum(-1 + 2 * jnp.sum(pairs * positive), 1 / jnp.log10(n_chains * n_steps))
+    return n_chains * n_steps / tau
+
+def bulk_ess(x: Float[Array, "n_chains n_steps"]) -> Float:
+    return ess(rank_normalize(split_chains(x)))
+
+def tail_ess(x: Float[Array, "n_chains n_steps"]) -> Float:
+    """Minimum of the effective sample sizes of the 5% and 95% quantiles."""
+    x = split_chains(x)
+    lower, upper = jnp.quantile(x, jnp.array([0.05, 0.95]))
+    return jnp.minimum(ess((x <= lower).astype(float)), ess((x >= upper).astype(float)))
+
+def split_rhat(x: Float[Array, "n_chains n_steps"]) -> Float:
+    """Rank-normalized split-R-hat, the maximum of the R-hat of the rank-normalized draws and of their absolute deviation from the median."""
+    x = split_chains(x)
+    folded = jnp.abs(x - jnp.median(x))
+    return jnp.maximum(rhat(rank_normalize(x)), rhat(rank_normalize(folded)))
+
+@jax.jit
+def compute_diagnostics(chains: Float[Array, "n_chains n_steps n_dim"]) -> dict[str, Float[Array, "n_dim"]]:
+    """
+    Split-R-hat, bulk and tail effective sample size of every dimension of the chains.
+
+    Args:
+        chains (Float[Array, "n_chains n_steps n_dim"]): Samples of the chains, at least 4 steps.
+
+    Returns:
+        dict[str, Float[Array, "n_dim"]]: The diagnostics rhat, bulk_ess and tail_ess.
+    """
+    per_dim = lambda func: jax.vmap(func, in_axes=2)(chains)
+    return {"rhat": per_dim(split_rhat),
+            "bulk_ess": per_dim(bulk_ess),
+            "tail_ess": per_dim(tail_ess)}
+
+def loss_change(loss_vals: Float[Array, "n_loops n_epochs"], fraction: float = 0.25) -> float:
+    """
+    Absolute change of the loss of the normalizing flow between the last two training loops, each averaged over its last fraction of epochs.
+    Returns inf for less than two loops.
+    """
+    if loss_vals.shape[0] < 2:
+        return jnp.inf
+    n_epochs = max(int(fraction * loss_vals.shape[1]), 1)
+    loss = jnp.mean(loss_vals[-2:, -n_epochs:], axis=1)
+    return jnp.abs(loss[1] - loss[0])
@@ -1,23 +1,37 @@
 import copy
 import json
 import os
+import pickle
+import warnings
 import numpy as np
 import matplotlib.pyplot as plt
+import equinox as eqx
 import jax
 import jax.numpy as jnp
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
 from jaxtyping import Float, Array, PRNGKeyArray
 
 from fiesta.inference.lightcurve_model import LightcurveModel
 from fiesta.inference.prior import Prior 
-from fiesta.inference.likelihood import EMLikelihood
+from fiesta.inference.likelihood import EMLikelihood, MultiEventLikelihood
+from fiesta.inference.posterior_file import PosteriorFile
+from fiesta.inference.optimizer import maximize_and_initialize
+from fiesta.inference.diagnostics import compute_diagnostics, loss_change
+from fiesta.inference.smc import tempered_smc
+from fiesta.inference.local_sampler import AdaptiveMALA, AdaptiveGaussianRandomWalk, TARGET_ACCEPTANCE, as_step_matrix, default_step_scale, estimate_mass_matrix, tune_step_scale
 from fiesta.conversions import mag_app_from_mag_abs
 
 from flowMC.sampler.Sampler import Sampler
-from flowMC.sampler.MALA import MALA
-from flowMC.sampler.Gaussian_random_walk import GaussianRandomWalk
 from flowMC.nfmodel.rqSpline import MaskedCouplingRQSpline
 from flowMC.utils.PRNG_keys import initialize_rng_keys
 
+CHECKPOINT_FILENAME = "checkpoint.pkl"
+POSTERIOR_FILENAME = "results_production.h5"
+DIAGNOSTICS_FILENAME = "diagnostics.json"
+POSTERIOR_PREDICTIVE_FILENAME = "posterior_predictive.npz"
+# options of the flowMC Sampler that are only used by Sampler.sample, which Fiesta.sample replaces
+UNSUPPORTED_FLOWMC_OPTIONS = ["local_autotune", "precompile"]
+
 default_hyperparameters = {
         "seed": 1,
         "n_chains": 20,
@@ -25,7 +39,23 @@ default_hyperparameters = {
         "hidden_size": [128,128],
         "num_bins": 8,
         "local_sampler_arg": {},
-        "which_local_sampler": "MALA"
+        "which_local_sampler": "MALA",
+        "shard_chains": False,
+        "n_walkers_maximize_likelihood": 0,
+        "n_loops_maximize_likelihood": 100,
+        "n_steps_adam_maximize_likelihood": 100,
+        "adapt_local_sampler": True,
+        "mass_matrix": "diagonal",
+        "target_acceptance": None,
+        "loss_tolerance": None,
+        "rhat_threshold": 1.05,
+        "target_ess": None,
+        "sampler_backend": "flowMC",
+        "n_particles_smc": 2_000,
+        "n_mcmc_steps_smc": 10,
+        "target_ess_smc": 0.5,
+        "max_steps_smc": 200,
+        "n_flow_steps_smc": 0,
 }
 
 class Fiesta(object):
@@ -41,10 +71,29 @@ class Fiesta(object):
         "local_sampler_arg": "(dict) Additional arguments to be used in the local sampler",
         "n_walkers_maximize_likelihood": "(int) Number of walkers used in the maximization of the likelihood with the evolutionary optimizer",
         "n_loops_maximize_likelihood": "(int) Number of loops to run the evolutionary optimizer in the maximization of the likelihood",
+        "n_steps_adam_maximize_likelihood": "(int) Number of Adam steps that refine the result of the evolutionary optimizer",
         "which_local_sampler": "(str) Name of the local sampler to use",
+        "shard_chains": "(bool) Whether to shard the chains across all devices of jax.devices()",
+        "adapt_local_sampler": "(bool) Whether to adapt the mass matrix and the step size of the local sampler during the training loops",
+        "mass_matrix": "(str) Mass matrix estimated in the adaptation, either 'diagonal' or 'dense'",
+        "target_acceptance": "(float) Acceptance rate the step size is tuned to. Defaults to None, i.e. 0.574 for MALA and 0.234 for the gaussian random walk",
+        "loss_tolerance": "(float) Training stops early once the loss of the NF changes by less than this between two loops and the split-R-hat is below rhat_threshold. Defaults to None, i.e. all n_loop_training loops",
+        "rhat_threshold": "(float) Maximal rank-normalized split-R-hat of all parameters for the early stopping of training and production",
+        "target_ess": "(float) Production stops early once the bulk and tail ESS of all parameters reach this and the split-R-hat is below rhat_threshold. Defaults to None, i.e. all n_loop_production loops",
+        "sampler_backend": "(str) Either 'flowMC' or 'smc' for adaptive tempered sequential Monte Carlo, which also estimates the evidence",
+        "n_particles_smc": "(int) Number of particles of the SMC backend",
+        "n_mcmc_steps_smc": "(int) Number of MALA steps per temperature of the SMC backend",
+        "target_ess_smc": "(float) Fraction of the particles the effective sample size may drop to between two temperatures of the SMC backend",
+        "max_steps_smc": "(int) Maximal number of temperatures of the SMC backend",
+        "n_flow_steps_smc": "(int) Number of training steps of the NF per temperature for the NF moves of the SMC backend. Defaults to 0, i.e. only MALA moves",
+    
+    All other keyword arguments are passed to the flowMC Sampler. Fiesta runs the training and production loops itself, so the flowMC options local_autotune and precompile are not supported.
+    
+    If the likelihood is a MultiEventLikelihood, the independent posteriors of all events are sampled together in one flowMC run: 
+    the sampled vector concatenates the parameters of the events, which all have the given prior.
     """
     
-    likelihood: EMLikelihood
+    likelihood: EMLikelihood | MultiEventLikelihood
     prior: Prior
 
     def __init__(self, 
@@ -53,9 +102,11 @@ class Fiesta(object):
                  **kwargs):
         self.likelihood = likelihood
         self.prior = prior
+        self.n_events = likelihood.n_events if isinstance(likelihood, MultiEventLikelihood) else None
+        self.n_dim = self.prior.n_dim * (self.n_events or 1)
 
         # Set and override any given hyperparameters, and save as attribute
-        self.hyperparameters = default_hyperparameters
+        self.hyperparameters = copy.deepcopy(default_hyperparameters)
         hyperparameter_names = list(self.hyperparameters.keys())
         
         for key, value in kwargs.items():
@@ -65,29 +116,67 @@ class Fiesta(object):
         for key, value in self.hyperparameters.items():
             setattr(self, key, value)
 
+        # sample runs the loops of flowMC itself, options outside of Sampler.sampling_loop would be ignored
+        unsupported = [option for option in UNSUPPORTED_FLOWMC_OPTIONS if kwargs.get(option)]
+        if unsupported:
+            raise ValueError(f"The flowMC options {unsupported} are not supported, the local sampler is adapted with adapt_local_sampler.")
+
         rng_key_set = initialize_rng_keys(self.hyperparameters["n_chains"], seed=self.hyperparameters["seed"])
-        local_sampler_arg = kwargs.get("local_sampler_arg", {})
+        local_sampler_arg = dict(kwargs.get("local_sampler_arg", {}))
 
+        if self.hyperparameters["sampler_backend"] not in ["flowMC", "smc"]:
+            raise ValueError(f"Sampler backend {self.hyperparameters['sampler_backend']} not recognized, use 'flowMC' or 'smc'")
+        if self.hyperparameters["mass_matrix"] not in ["diagonal", "dense"]:
+            raise ValueError(f"Mass matrix {self.hyperparameters['mass_matrix']} not recognized, use 'diagonal' or 'dense'")
+        if "step_size" in local_sampler_arg:
+            local_sampler_arg["step_size"] = as_step_matrix(local_sampler_arg["step_size"], self.n_dim)
+        elif not self.hyperparameters["adapt_local_sampler"]:
+            raise ValueError("A step_size in local_sampler_arg is needed if the local sampler is not adapted.")
+
+        # the step size is passed with the data, so that it can be adapted without recompiling the sampler
         if self.hyperparameters["which_local_sampler"] == "MALA":
             print("INFO: Using MALA as local sampler")
-            local_sampler = MALA(
-                self.posterior, True, local_sampler_arg
-            )  # Remember to add routine to find automated mass matrix
+            local_sampler = AdaptiveMALA(
+                self.sampler_posterior, True, local_sampler_arg
+            )
         elif self.hyperparameters["which_local_sampler"] == "GaussianRandomWalk":
             print("INFO: Using gaussian random walk as local sampler")
-            local_sampler = GaussianRandomWalk(
-                self.posterior, True, local_sampler_arg
-            )  # Remember to add routine to find automated mass matrix
+            local_sampler = AdaptiveGaussianRandomWalk(
+                self.sampler_posterior, True, local_sampler_arg
+            )
         else:   
             sampler = self.hyperparameters["which_local_sampler"]
             raise ValueError(f"Local sampler {sampler} not recognized")
+        
+        if self.hyperparameters["target_acceptance"] is None:
+            self.target_acceptance = TARGET_ACCEPTANCE[self.hyperparameters["which_local_sampler"]]
+        
+        # directory of the plots
+        self.outdir = kwargs.get("outdir", "./outdir/")
+        
+        # set in sample if the production samples are streamed to disk
+        self.posterior_file = None
+        # convergence diagnostics after every loop, see update_diagnostics
+        self.diagnostics = []
+        self.diagnostics_file = None
+        # weighted samples and evidence of the SMC backend, see sample_smc
+        self.smc_results = None
+        # posterior predictive of the last run, see save_posterior_predictive
+        self.posterior_predictive = None
+        
+        self.mesh = None
+        if self.hyperparameters["shard_chains"]:
+            self.mesh = Mesh(np.array(jax.devices()), ("chains",))
+            if self.hyperparameters["n_chains"] % self.mesh.size != 0:
+                raise ValueError(f"The number of chains {self.hyperparameters['n_chains']} needs to be a multiple of the number of devices {self.mesh.size} to shard the chains.")
+            print(f"INFO: Sharding the chains across {self.mesh.size} devices")
 
         model = MaskedCouplingRQSpline(
-            self.prior.n_dim, self.num_layers, self.hidden_size, self.num_bins, rng_key_set[-1]
+            self.n_dim, self.num_layers, self.hidden_size, self.num_bins, rng_key_set[-1]
         )
 
         self.Sampler = Sampler(
-            self.prior.n_dim,
+            self.n_dim,
             rng_key_set,
             None,  # type: ignore
             local_sampler,
@@ -97,44 +186,421 @@ class Fiesta(object):
         )
 
     def posterior(self, params: Float[Array, " n_dim"], data: dict):
+        if self.n_events:
+            # parameters of the events along a leading axis
+            params = params.reshape(self.n_events, self.prior.n_dim)
         prior_params = self.prior.add_name(params.T)
-        prior = self.prior.log_prob(prior_params)
+        prior = jnp.sum(self.prior.log_prob(prior_params))
         return (
             self.likelihood.evaluate(self.prior.transform(prior_params), data) + prior
         )
 
-    def sample(self, key: PRNGKeyArray, initial_guess: Array = jnp.array([])):
-        if initial_guess.size == 0:
-            initial_guess_named = self.prior.sample(key, self.Sampler.n_chains)
-            initial_guess = jnp.stack([initial_guess_named[key] for key in self.prior.naming]).T
+    def sampler_posterior(self, params: Float[Array, " n_dim"], data: dict):
+        """Log posterior as called by the samplers of flowMC, whose data also contains the step size of the local sampler, see get_sampler_data."""
+        return self.posterior(params, data["likelihood"])
+
+    def posterior_batch(self, params: Float[Array, "n_chains n_dim"], data: dict):
+        """
+        Log posterior of all chains at once, with the prior transforms and the likelihood applied to the whole batch, see EMLikelihood.evaluate_batch.
+        """
+        prior, likelihood = self.prior_and_likelihood_batch(params, data)
+        return likelihood + prior
+
+    def prior_and_likelihood_batch(self, params: Float[Array, "n_chains n_dim"], data: dict) -> tuple[Float[Array, "n_chains"], Float[Array, "n_chains"]]:
+        """Log prior and log-likelihood of a batch of points, evaluated separately for the tempering of the SMC backend."""
+        if self.n_events:
+            def single(params):
+                prior_params = self.prior.add_name(params.reshape(self.n_events, self.prior.n_dim).T)
+                return jnp.sum(self.prior.log_prob(prior_params)), self.likelihood.evaluate(self.prior.transform(prior_params), data)
+            return jax.vmap(single)(params)
+        prior_params = self.prior.add_name(params.T)
+        return self.prior.log_prob(prior_params), self.likelihood.evaluate_batch(self.prior.transform(prior_params), data)
+
+    def sample(self, 
+               key: PRNGKeyArray, 
+               initial_guess: Array = jnp.array([]),
+               outdir: str = None,
+               resume: bool = False,
+               stream_output: bool = False,
+               thinning: int = 1):
+        """
+        Run the training and production loops of flowMC. 
+        If outdir is given, the full sampler state is saved to a checkpoint in outdir after every loop, and the run can be continued from the last completed loop with resume=True, e.g. after the job was preempted.
+        With stream_output, the production samples are appended to an HDF5 file in outdir after every loop and removed from memory, such that the memory stays flat irrespective of the length of the run. 
+        The diagnostics and plots then read the samples from the file, see PosteriorFile.
+        After every loop, the convergence diagnostics are computed (see update_diagnostics) and written to outdir/diagnostics.json. With loss_tolerance and target_ess, training and production stop early once they have converged, 
+        so n_loop_training and n_loop_production become maximal numbers of loops.
+
+        Args:
+            key (PRNGKeyArray): Key to draw the initial positions from the prior.
+            initial_guess (Array): Initial positions of the chains with shape (n_chains, n_dim). Defaults to an empty array, i.e. positions drawn from the prior.
+            outdir (str): Directory of the checkpoint. Defaults to None, i.e. no checkpointing.
+            resume (bool): Whether to continue from the checkpoint in outdir if it exists. Defaults to False.
+            stream_output (bool): Whether to stream the production samples to outdir/results_production.h5. Defaults to False.
+            thinning (int): Only every thinning-th production step is written to the file. Defaults to 1.
+        """
+        self.posterior_predictive = None
+        if self.sampler_backend == "smc":
+            if resume or stream_output:
+                raise NotImplementedError("Checkpointing and streaming are not supported by the SMC backend.")
+            return self.sample_smc(key)
+        
+        checkpoint_file = os.path.join(outdir, CHECKPOINT_FILENAME) if outdir is not None else None
+        self.diagnostics_file = os.path.join(outdir, DIAGNOSTICS_FILENAME) if outdir is not None else None
+        checkpoint_exists = checkpoint_file is not None and os.path.exists(checkpoint_file)
+        if resume and not checkpoint_exists:
+            print(f"NOTE: No checkpoint found in {outdir}, starting a new run.")
+        resume = resume and checkpoint_exists
+        if stream_output:
+            if outdir is None:
+                raise ValueError("An outdir is needed to stream the production samples.")
+            os.makedirs(outdir, exist_ok=True)
+            parameter_names = list(self.name_chains(jnp.zeros((1, self.n_dim)), transform=False).keys())
+            self.posterior_file = PosteriorFile(os.path.join(outdir, POSTERIOR_FILENAME), self.Sampler.n_chains, self.n_dim, 
+                                                parameter_names=parameter_names, thinning=thinning, dtype=jnp.result_type(float), overwrite=not resume)
+        
+        if resume:
+            n_training, n_production, last_step = self.load_checkpoint(checkpoint_file)
+            last_step = self.shard_positions(last_step)
+            print(f"Resuming from {checkpoint_file} after {n_training} training and {n_production} production loops.")
+        else:
+            self.diagnostics = []
+            if initial_guess.size == 0 and self.hyperparameters["n_walkers_maximize_likelihood"] > 0:
+                initial_guess = self.maximize_likelihood(key)
+            elif initial_guess.size == 0:
+                n_events = self.n_events or 1
+                initial_guess_named = self.prior.sample(key, self.Sampler.n_chains * n_events)
+                initial_guess = jnp.stack([initial_guess_named[key] for key in self.prior.naming]).T
+                initial_guess = initial_guess.reshape(self.Sampler.n_chains, self.n_dim)
+            
+            initial_guess = self.shard_positions(initial_guess)
+            if self.adapt_local_sampler:
+                self.adapt_step_size(initial_guess)
+            n_training, n_production, last_step = 0, 0, initial_guess
+        
+        # the observations are passed as an argument, so that the compiled sampler can be reused for other events
+        data = self.get_sampler_data()
+        
+        # same loops as Sampler.sample, with a checkpoint after each of them
+        if self.Sampler.use_global and not self.has_converged("training"):
+            if n_training < self.Sampler.n_loop_training:
+                print("Training normalizing flow")
+            for n_training in range(n_training + 1, self.Sampler.n_loop_training + 1):
+                n_steps = self.Sampler.summary["training"]["chains"].shape[1]
+                last_step = self.Sampler.sampling_loop(last_step, data, training=True)
+                loop_chains = self.Sampler.summary["training"]["chains"][:, n_steps:]
+                converged = self.update_diagnostics("training", n_training, loop_chains)
+                if self.adapt_local_sampler:
+                    # the step size is frozen after the last training loop
+                    self.adapt_step_size(last_step, loop_chains)
+                    data = self.get_sampler_data()
+                if checkpoint_file is not None:
+                    self.save_checkpoint(checkpoint_file, n_training, n_production, last_step)
+                if converged:
+                    print(f"INFO: Training converged after {n_training} loops")
+                    break
+        
+        if self.has_converged("production"):
+            return
+        print("Starting Production run")
+        for n_production in range(n_production + 1, self.Sampler.n_loop_production + 1):
+            n_steps = self.Sampler.summary["production"]["chains"].shape[1]
+            last_step = self.Sampler.sampling_loop(last_step, data)
+            converged = self.update_diagnostics("production", n_production, self.Sampler.summary["production"]["chains"][:, n_steps:])
+            if self.posterior_file is not None:
+                self.flush_production_samples()
+            if checkpoint_file is not None:
+                self.save_checkpoint(checkpoint_file, n_training, n_production, last_step)
+            if converged:
+                print(f"INFO: Production reached the target ESS after {n_production} loops")
+                break
+    
+    def sample_smc(self, key: PRNGKeyArray) -> None:
+        """
+        Sample the posterior with adaptive tempered SMC from n_particles_smc prior draws, see fiesta.inference.smc.tempered_smc. 
+        The whole run is a single compiled loop, in which all particles are evaluated in one batched call of the likelihood (see prior_and_likelihood_batch) per MALA step.
+        With n_flow_steps_smc, the particles are also moved with proposals of a NF with the architecture of the flowMC hyperparameters.
+        The weighted samples and the log-evidence are stored in self.smc_results.
+
+        Args:
+            key (PRNGKeyArray): Random key.
+        """
+        n_particles = self.hyperparameters["n_particles_smc"]
+        key_prior, key_flow, key_smc = jax.random.split(key, 3)
+        samples = self.prior.sample(key_prior, n_particles * (self.n_events or 1))
+        x = jnp.stack([samples[name] for name in self.prior.naming]).T.reshape(n_particles, self.n_dim)
+        
+        flow = None
+        if self.n_flow_steps_smc > 0:
+            flow = MaskedCouplingRQSpline(self.n_dim, self.num_layers, self.hidden_size, self.num_bins, key_flow)
+        
+        print(f"INFO: Running tempered SMC with {n_particles} particles")
+        results = tempered_smc(self.prior_and_likelihood_batch, x, key_smc, self.likelihood.data,
+                               n_mcmc_steps=self.n_mcmc_steps_smc, 
+                               target_ess=self.target_ess_smc, 
+                               max_steps=self.max_steps_smc, 
+                               flow=flow,
+                               n_flow_steps=self.n_flow_steps_smc)
+        
+        self.smc_results = jax.tree.map(np.asarray, results)
+        n_steps = int(self.smc_results["n_steps"])
+        if self.smc_results["betas"][n_steps - 1] < 1:
+            print(f"NOTE: SMC did not reach the posterior within {self.max_steps_smc} temperatures, the samples and the evidence belong to beta = {self.smc_results['betas'][n_steps - 1]:.3e}.")
+        ess = 1 / np.sum(np.exp(2 * self.smc_results["log_weights"]))
+        print(f"SMC finished after {n_steps} temperatures with ESS {ess:.0f}, log evidence: {self.smc_results['log_evidence']:.3f}")
+    
+    def update_diagnostics(self, 
+                           stage: str, 
+                           n_loop: int, 
+                           chains: Array) -> bool:
+        """
+        Compute the rank-normalized split-R-hat and the bulk and tail ESS of every parameter from the samples of a loop on the device, see fiesta.inference.diagnostics, and append them to self.diagnostics and the diagnostics file.
+        The diagnostics only use the samples of the loop, so their cost does not grow with the run. For production, the ESS are summed over the loops, treating the loops as independent, which holds if a loop is much longer than the autocorrelation of the chains.
+        For training, the change of the NF loss between the last two loops is recorded as well.
+
+        Args:
+            stage (str): Either 'training' or 'production'.
+            n_loop (int): Number of the loop in its stage.
+            chains (Array): Samples of the chains in the loop with shape (n_chains, n_steps, n_dim).
+
+        Returns:
+            bool: Whether the stage has converged, i.e. whether the loops of this stage can be stopped.
+        """
+        names = list(self.name_chains(jnp.zeros((1, self.n_dim)), transform=False).keys())
+        diagnostics = jax.tree.map(lambda x: dict(zip(names, np.asarray(x).tolist())), compute_diagnostics(chains))
+        record = {"stage": stage, "loop": n_loop, **diagnostics, "max_rhat": max(diagnostics["rhat"].values())}
+        converged = record["max_rhat"] < self.rhat_threshold
+        
+        if stage == "training":
+            record["loss_change"] = float(loss_change(self.Sampler.summary["training"]["loss_vals"]))
+            converged = converged and self.loss_tolerance is not None and record["loss_change"] < self.loss_tolerance
+            message = f"loss change {record['loss_change']:.3f}"
+        else:
+            previous = [r for r in self.diagnostics if r["stage"] == "production"]
+            for key in ["bulk_ess", "tail_ess"]:
+                total = {name: value + (previous[-1][f"total_{key}"][name] if previous else 0.) for name, value in diagnostics[key].items()}
+                record[f"total_{key}"] = total
+                record[f"min_total_{key}"] = min(total.values())
+            converged = converged and self.target_ess is not None and min(record["min_total_bulk_ess"], record["min_total_tail_ess"]) >= self.target_ess
+            message = f"bulk ESS {record['min_total_bulk_ess']:.0f}, tail ESS {record['min_total_tail_ess']:.0f}"
+        
+        record["converged"] = converged
+        self.diagnostics.append(record)
+        print(f"INFO: {stage.capitalize()} loop {n_loop}: max split-R-hat {record['max_rhat']:.3f}, {message}")
+        if self.diagnostics_file is not None:
+            self.save_diagnostics(self.diagnostics_file)
+        return converged
+    
+    def has_converged(self, stage: str) -> bool:
+        """Whether a loop of the stage ('training' or 'production') has converged according to the diagnostics history, e.g. of a resumed run."""
+        return any(record["stage"] == stage and record["converged"] for record in self.diagnostics)
+    
+    def save_diagnostics(self, filename: str) -> None:
+        """Write the diagnostics history to a JSON file."""
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(self.diagnostics, f, indent=4)
+    
+    def get_sampler_data(self) -> dict:
+        """Data passed to the samplers of flowMC: the data of the likelihood and the current step size matrix of the local sampler."""
+        return self.replicate({"likelihood": self.likelihood.data,
+                               "local_sampler": {"step_size": self.Sampler.local_sampler.params["step_size"]}})
+    
+    def adapt_step_size(self, positions: Array, samples: Array = None) -> None:
+        """
+        Adapt the step size matrix eps * L of the local sampler. The Cholesky factor L of the mass matrix is estimated from the samples of all chains, e.g. of the last training loop. 
+        Without samples, the mass matrix of the given step size is kept, or estimated from the spread of the positions if no step size was given.
+        The scale eps is then tuned towards target_acceptance with single steps of all chains from their current positions, see fiesta.inference.local_sampler.
+        The result is stored in the parameters of the local sampler, and thereby also in the checkpoints.
+
+        Args:
+            positions (Array): Current positions of the chains.
+            samples (Array): Samples of the chains with shape (n_chains, n_steps, n_dim). Defaults to None.
+        """
+        sampler = self.Sampler
+        params = sampler.local_sampler.params
+        if samples is None and "step_size" in params:
+            cholesky, step_scale = params["step_size"], 1.
+        else:
+            if samples is None:
+                samples = positions[:, None]
+            cholesky = estimate_mass_matrix(samples, dense=self.mass_matrix == "dense")
+            step_scale = default_step_scale(self.which_local_sampler, self.n_dim)
+        
+        data = self.replicate({"likelihood": self.likelihood.data, "local_sampler": {"step_size": cholesky}})
+        log_prob = sampler.local_sampler.logpdf_vmap(positions, data)
+        step_scale, sampler.rng_keys_mcmc = tune_step_scale(sampler.local_sampler.kernel_vmap, sampler.rng_keys_mcmc, positions, log_prob, 
+                                                            data, cholesky, step_scale, self.target_acceptance)
+        params["step_size"] = step_scale * cholesky
+        print(f"INFO: Adapted the local sampler, step scale {step_scale:.3e} with {self.mass_matrix} mass matrix")
+    
+    def maximize_likelihood(self, key: PRNGKeyArray) -> Array:
+        """
+        Maximize the posterior from n_walkers_maximize_likelihood prior draws with a batched evolution strategy and Adam, see fiesta.inference.optimizer, and place the chains around the best points found.
+        Within the support of the prior, this maximizes the likelihood for uniform priors. The cost and the best log-likelihood are printed and stored in self.maximization_report.
+
+        Args:
+            key (PRNGKeyArray): Random key.
+
+        Returns:
+            Array: Initial positions of the chains with shape (n_chains, n_dim).
+        """
+        n_walkers = self.hyperparameters["n_walkers_maximize_likelihood"]
+        key_prior, key_optimizer = jax.random.split(key)
+        samples = self.prior.sample(key_prior, n_walkers * (self.n_events or 1))
+        x = jnp.stack([samples[name] for name in self.prior.naming]).T.reshape(n_walkers, self.n_dim)
+        
+        positions, report = maximize_and_initialize(self.posterior_batch, x, key_optimizer, self.likelihood.data, self.Sampler.n_chains,
+                                                    n_loops=self.hyperparameters["n_loops_maximize_likelihood"], 
+                                                    n_steps_adam=self.hyperparameters["n_steps_adam_maximize_likelihood"])
+        
+        best = report["best_position"]
+        prior_params = self.prior.add_name(best.reshape(self.n_events or 1, self.prior.n_dim).T)
+        report["best_log_likelihood"] = report["best_log_prob"] - float(jnp.sum(self.prior.log_prob(prior_params)))
+        self.maximization_report = report
+        print(f"Maximized the likelihood with {n_walkers} walkers in {report['time']:.1f} s and {report['n_evaluations']} evaluations, best log-likelihood: {report['best_log_likelihood']:.3f}")
+        return positions
+    
+    def shard_positions(self, positions: Array) -> Array:
+        """
+        Distribute the chain positions and the random keys of the local sampler along the chain axis over the devices of the mesh.
+        The compiled local and global steps of flowMC are vmapped over the chains, so the sharding propagates through them: every device evaluates the likelihood of its own chains, and the normalizing flow is trained data-parallel on the sharded samples.
+        Does nothing if the chains are not sharded.
+        """
+        if self.mesh is None:
+            return positions
+        sharding = NamedSharding(self.mesh, PartitionSpec("chains"))
+        self.Sampler.rng_keys_mcmc = jax.device_put(self.Sampler.rng_keys_mcmc, sharding)
+        return jax.device_put(positions, sharding)
+    
+    def replicate(self, data: dict) -> dict:
+        """Copy the data to all devices of the mesh, if the chains are sharded."""
+        if self.mesh is None:
+            return data
+        return jax.device_put(data, NamedSharding(self.mesh, PartitionSpec()))
+    
+    def flush_production_samples(self) -> None:
+        """Append the production samples in memory to the posterior file and remove them from the sampler state."""
+        production = self.Sampler.summary["production"]
+        self.posterior_file.append(production)
+        self.Sampler.summary["production"] = {key: value[:, :0] for key, value in production.items()}
+    
+    def save_checkpoint(self, 
+                        filename: str, 
+                        n_training: int, 
+                        n_production: int, 
+                        last_step: Array) -> None:
+        """
+        Save the full sampler state after a completed loop: the chain positions, the parameters of the normalizing flow and the state of its optimizer, the parameters of the local sampler, the random keys and the samples collected so far.
+        The file is replaced atomically, so that an interrupted write does not corrupt the previous checkpoint.
+        """
+        sampler = self.Sampler
+        to_numpy = lambda tree: jax.tree.map(np.asarray, tree)
+        checkpoint = {"n_chains": sampler.n_chains,
+                      "n_dim": sampler.n_dim,
+                      "n_training": n_training,
+                      "n_production": n_production,
+                      "last_step": np.asarray(last_step),
+                      "rng_keys_mcmc": np.asarray(sampler.rng_keys_mcmc),
+                      "rng_keys_nf": np.asarray(sampler.rng_keys_nf),
+                      "local_sampler_params": to_numpy(sampler.local_sampler.params),
+                      "nf_model": to_numpy(jax.tree.leaves(eqx.filter(sampler.nf_model, eqx.is_array))),
+                      "optim_state": to_numpy(sampler.optim_state), # its structure changes after the first update, so it is stored as a whole
+                      "variables": to_numpy(sampler.variables),
+                      "summary": to_numpy(sampler.summary),
+                      "posterior_file": self.posterior_file.get_state() if self.posterior_file is not None else None,
+                      "diagnostics": copy.deepcopy(self.diagnostics)}
+        
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump(checkpoint, f)
+        os.replace(filename + ".tmp", filename)
+    
+    def load_checkpoint(self, filename: str) -> tuple[int, int, Array]:
+        """
+        Restore the sampler state from a checkpoint written by save_checkpoint. The sampler needs to have the same number of chains, dimensions and normalizing flow architecture.
+
+        Returns:
+            tuple[int, int, Array]: Number of completed training and production loops, and the last positions of the chains.
+        """
+        with open(filename, "rb") as f:
+            checkpoint = pickle.load(f)
+        
+        sampler = self.Sampler
+        if (checkpoint["n_chains"], checkpoint["n_dim"]) != (sampler.n_chains, sampler.n_dim):
+            raise ValueError(f"The checkpoint {filename} has {checkpoint['n_chains']} chains of dimension {checkpoint['n_dim']}, but the sampler has {sampler.n_chains} chains of dimension {sampler.n_dim}.")
+        
+        def restore(tree, leaves):
+            treedef = jax.tree.structure(tree)
+            if treedef.num_leaves != len(leaves):
+                raise ValueError(f"The checkpoint {filename} does not match the normalizing flow of the sampler.")
+            return jax.tree.unflatten(treedef, [jnp.asarray(leaf) for leaf in leaves])
+        
+        nf_params, nf_static = eqx.partition(sampler.nf_model, eqx.is_array)
+        sampler.global_sampler.model = eqx.combine(restore(nf_params, checkpoint["nf_model"]), nf_static)
+        
+        to_jax = lambda tree: jax.tree.map(jnp.asarray, tree)
+        sampler.optim_state = to_jax(checkpoint["optim_state"])
+        sampler.rng_keys_mcmc = jnp.asarray(checkpoint["rng_keys_mcmc"])
+        sampler.rng_keys_nf = jnp.asarray(checkpoint["rng_keys_nf"])
+        sampler.local_sampler.params = to_jax(checkpoint["local_sampler_params"])
+        sampler.variables = to_jax(checkpoint["variables"])
+        sampler.summary = to_jax(checkpoint["summary"])
+        self.diagnostics = checkpoint.get("diagnostics", [])
+        if self.posterior_file is not None:
+            if checkpoint["posterior_file"] is None:
+                raise ValueError(f"The production samples of the checkpoint {filename} were not streamed to a file.")
+            # remove samples that were written after the checkpoint
+            self.posterior_file.set_state(checkpoint["posterior_file"])
+        return checkpoint["n_training"], checkpoint["n_production"], jnp.asarray(checkpoint["last_step"])
+
+    def name_chains(self, chains: Array, transform: bool = True) -> dict[str, Array]:
+        """
+        Flatten the chains of the sampler state and name the parameters. In multi-event mode, the names get the index of the event as suffix, e.g. log10_E0_0.
+        """
+        if not self.n_events:
+            chains = self.prior.add_name(chains.reshape(-1, self.prior.n_dim).T)
+            return self.prior.transform(chains) if transform else chains
         
-        self.Sampler.sample(initial_guess, None)  # type: ignore
+        chains = chains.reshape(-1, self.n_events, self.prior.n_dim)
+        output = {}
+        for j in range(self.n_events):
+            event_chains = self.prior.add_name(chains[:, j].T)
+            if transform:
+                event_chains = self.prior.transform(event_chains)
+            output.update({f"{key}_{j}": value for key, value in event_chains.items()})
+        return output
 
     def print_summary(self, transform: bool = True):
         """
         Generate summary of the run
 
         """
+        if self.smc_results is not None:
+            weights = np.exp(self.smc_results["log_weights"])
+            print("SMC summary")
+            print("=" * 10)
+            for key, value in self.name_chains(jnp.asarray(self.smc_results["samples"]), transform).items():
+                mean = np.sum(weights * value)
+                print(f"{key}: {mean:.3f} +/- {np.sqrt(np.sum(weights * (value - mean)**2)):.3f}")
+            print(f"Temperatures: {self.smc_results['n_steps']}, ESS: {1 / np.sum(weights**2):.0f}")
+            print(f"Log evidence: {self.smc_results['log_evidence']:.3f}")
+            return
 
         train_summary = self.Sampler.get_sampler_state(training=True)
         production_summary = self.Sampler.get_sampler_state(training=False)
 
-        training_chain = train_summary["chains"].reshape(-1, self.prior.n_dim).T
-        training_chain = self.prior.add_name(training_chain)
-        if transform:
-            training_chain = self.prior.transform(training_chain)
+        training_chain = self.name_chains(train_summary["chains"], transform)
         training_log_prob = train_summary["log_prob"]
         training_local_acceptance = train_summary["local_accs"]
         training_global_acceptance = train_summary["global_accs"]
         training_loss = train_summary["loss_vals"]
 
-        production_chain = production_summary["chains"].reshape(-1, self.prior.n_dim).T
-        production_chain = self.prior.add_name(production_chain)
-        if transform:
-            production_chain = self.prior.transform(production_chain)
-        production_log_prob = production_summary["log_prob"]
-        production_local_acceptance = production_summary["local_accs"]
-        production_global_acceptance = production_summary["global_accs"]
+        if self.posterior_file is not None:
+            production_stats = self.get_streamed_moments(transform)
+        else:
+            production_stats = {key: (value.mean(), value.std()) for key, value in self.name_chains(production_summary["chains"], transform).items()}
+            production_stats.update({key: (production_summary[key].mean(), production_summary[key].std()) for key in ["log_prob", "local_accs", "global_accs"]})
 
         print("Training summary")
         print("=" * 10)
@@ -155,17 +621,32 @@ class Fiesta(object):
 
         print("Production summary")
         print("=" * 10)
-        for key, value in production_chain.items():
-            print(f"{key}: {value.mean():.3f} +/- {value.std():.3f}")
-        print(
-            f"Log probability: {production_log_prob.mean():.3f} +/- {production_log_prob.std():.3f}"
-        )
-        print(
-            f"Local acceptance: {production_local_acceptance.mean():.3f} +/- {production_local_acceptance.std():.3f}"
-        )
-        print(
-            f"Global acceptance: {production_global_acceptance.mean():.3f} +/- {production_global_acceptance.std():.3f}"
-        )
+        labels = {"log_prob": "Log probability", "local_accs": "Local acceptance", "global_accs": "Global acceptance"}
+        for key, (mean, std) in production_stats.items():
+            print(f"{labels.get(key, key)}: {mean:.3f} +/- {std:.3f}")
+    
+    def get_streamed_moments(self, transform: bool = True) -> dict[str, tuple[float, float]]:
+        """
+        Mean and standard deviation of the named production samples, the log probability and the acceptances in the posterior file, accumulated over blocks of steps.
+        """
+        sums = {}
+        def accumulate(key, value):
+            value = np.asarray(value, dtype=np.float64)
+            total = sums.get(key, np.zeros(3))
+            sums[key] = total + np.array([value.size, np.sum(value), np.sum(value**2)])
+        
+        for chunk in self.posterior_file.iter_chunks("chains"):
+            for key, value in self.name_chains(jnp.asarray(chunk), transform).items():
+                accumulate(key, value)
+        for key in ["log_prob", "local_accs", "global_accs"]:
+            for chunk in self.posterior_file.iter_chunks(key):
+                accumulate(key, chunk)
+        
+        moments = {}
+        for key, (n, total, total_squared) in sums.items():
+            mean = total / n
+            moments[key] = (mean, np.sqrt(max(total_squared / n - mean**2, 0.)))
+        return moments
 
     def get_samples(self, training: bool = False) -> dict:
         """
@@ -179,18 +660,47 @@ class Fiesta(object):
         Returns
         -------
         dict
-            Dictionary of samples
+            Dictionary of samples, with shape (n_chains, n_steps). In multi-event mode, the samples have a leading event axis.
+            With the SMC backend, the particles have shape (n_particles, 1) and their weights are in smc_results["log_weights"].
 
         """
-        if training:
+        if self.smc_results is not None:
+            # particles along a single step, their weights are in self.smc_results
+            chains = jnp.asarray(self.smc_results["samples"])[:, None]
+        elif training:
             chains = self.Sampler.get_sampler_state(training=True)["chains"]
+        elif self.posterior_file is not None:
+            chains = jnp.asarray(self.posterior_file.read("chains"))
         else:
             chains = self.Sampler.get_sampler_state(training=False)["chains"]
 
-        chains = self.prior.transform(self.prior.add_name(chains.transpose(2, 0, 1)))
+        if self.n_events:
+            chains = chains.reshape(*chains.shape[:2], self.n_events, self.prior.n_dim).transpose(3, 2, 0, 1)
+        else:
+            chains = chains.transpose(2, 0, 1)
+        chains = self.prior.transform(self.prior.add_name(chains))
         return chains
     
-    def save_results(self, outdir):
+    def save_results(self, outdir, posterior_predictive: bool = False):
+        """
+        Save the samples of the run to outdir.
+
+        Args:
+            outdir (str): Output directory.
+            posterior_predictive (bool): Whether to also compute and save the posterior predictive lightcurves, see save_posterior_predictive. Defaults to False.
+        """
+        if self.smc_results is not None:
+            name = os.path.join(outdir, 'results_smc.npz')
+            print(f"Saving SMC samples to {name}")
+            np.savez(name, **self.smc_results)
+            if posterior_predictive:
+                self.save_posterior_predictive(outdir)
+            return
+        
+        # - convergence diagnostics
+        if self.diagnostics:
+            self.save_diagnostics(os.path.join(outdir, DIAGNOSTICS_FILENAME))
+        
         # - training phase
         name = os.path.join(outdir, f'results_training.npz')
         print(f"Saving training samples to {name}")
@@ -201,7 +711,14 @@ class Fiesta(object):
         jnp.savez(name, log_prob=log_prob, local_accs=local_accs,
                 global_accs=global_accs, loss_vals=loss_vals)
         
+        # - posterior predictive lightcurves, so that the plots only need to read them
+        if posterior_predictive:
+            self.save_posterior_predictive(outdir)
+        
         #  - production phase
+        if self.posterior_file is not None:
+            print(f"Production samples were streamed to {self.posterior_file.filename}")
+            return
         name = os.path.join(outdir, f'results_production.npz')
         print(f"Saving production samples to {name}")
         state = self.Sampler.get_sampler_state(training=False)
@@ -228,87 +745,178 @@ class Fiesta(object):
             print(f"Error occurred saving jim hyperparameters, are all hyperparams JSON compatible?: {e}")
             
 
-    def plot_lightcurves(self,
-                         N_curves: int = 200):
-        
+    def get_production_log_prob(self) -> tuple[np.ndarray, callable]:
+        """
+        Flattened log probabilities of the production samples (the log-likelihood of the particles for the SMC backend) and a function that returns the samples at given flat indices with shape (n_dim, n_indices).
+        If the samples were streamed to a file, only the requested samples are read from it.
         """
-        Plot the data and the posterior lightcurves and the best fit lightcurve more visible on top
+        if self.smc_results is not None:
+            samples = self.smc_results["samples"].T
+            return self.smc_results["log_likelihood"], lambda idx: samples[:, idx]
+        if self.posterior_file is not None:
+            log_prob = self.posterior_file.read("log_prob")
+            n_steps = log_prob.shape[1]
+            get_samples = lambda idx: self.posterior_file.read_points("chains", *np.divmod(idx, n_steps)).T
+        else:
+            production_state = self.Sampler.get_sampler_state(training=False)
+            samples, log_prob = production_state["chains"], production_state["log_prob"]
+            samples = np.asarray(samples).reshape(-1, self.n_dim).T
+            get_samples = lambda idx: samples[:, idx]
+        return np.asarray(log_prob).reshape(-1), get_samples
+    
+    def predict_lightcurves(self, samples: Float[Array, "n_dim n_samples"], chunk_size: int = 1_000, key: PRNGKeyArray = None) -> tuple[Array, Array]:
         """
+        Apparent magnitudes of the filters of the likelihood for a batch of samples of the sampler, computed in chunks with LightcurveModel.predict_batch.
+        If the redshift is sampled and stretches the time grid, the magnitudes are interpolated to the time grid of the first sample.
+        If the likelihood marginalizes offsets, they are drawn per sample with EMLikelihood.sample_offsets and added to the magnitudes. Without a key, the mean of their conditional posterior is added instead.
 
-        production_state = self.Sampler.get_sampler_state(training=False)
-        samples, log_prob = production_state["chains"], production_state["log_prob"]
+        Returns:
+            tuple[Array, Array]: Times with shape (n_times,) and magnitudes with shape (n_samples, n_filters, n_times).
+        """
+        model = self.likelihood.model
+        n_samples = samples.shape[1]
+        named_samples = self.prior.transform(self.prior.add_name(jnp.asarray(samples)))
+        theta = self.likelihood.conversion({**named_samples, **self.likelihood.fixed_params})
+        X = jnp.stack([jnp.broadcast_to(theta[name], (n_samples,)) for name in model.parameter_names], axis=1)
+        redshift = theta.get("redshift", 0.)
+        times, mag = model.predict_batch(X, theta["luminosity_distance"], redshift, chunk_size=chunk_size)
+        
+        if self.likelihood.stretched_times:
+            sample_times = jax.vmap(model.observed_times)(jnp.broadcast_to(redshift, (n_samples,)))
+            interp = jax.vmap(lambda t, m: jax.vmap(jnp.interp, in_axes=(None, None, 0))(times, t, m))
+            mag = interp(sample_times, mag)
         
-        # Reshape both
-        samples = samples.reshape(-1, self.prior.n_dim).T
-        log_prob = log_prob.reshape(-1)
+        filter_idx = jnp.array([model.filters.index(filt) for filt in self.likelihood.filters])
+        mag = mag[:, filter_idx]
         
-        # Get the best fit lightcurve
-        best_fit_idx = np.argmax(log_prob)
-        best_fit_params = samples[:, best_fit_idx]
-        best_fit_params_named = self.prior.add_name(best_fit_params)
+        if self.likelihood.offset_names:
+            offsets = self.likelihood.sample_offsets(named_samples, key)
+            for name in self.likelihood.offset_names:
+                if name == "distance_modulus":
+                    mag = mag + offsets[name][:, None, None]
+                else:
+                    i = self.likelihood.filters.index(name.removeprefix("offset_"))
+                    mag = mag.at[:, i].add(offsets[name][:, None])
+        return times, mag
+    
+    def get_posterior_predictive(self, 
+                                 n_samples: int = 10_000,
+                                 quantiles: tuple[float] = (0.05, 0.16, 0.5, 0.84, 0.95),
+                                 chunk_size: int = 1_000,
+                                 seed: int = 0) -> dict[str, np.ndarray]:
+        """
+        Posterior predictive lightcurves: the lightcurves of a random subset of the production samples are evaluated in one chunked, batched call and reduced on the device to quantile bands per filter and time.
+        Marginalized offsets are drawn for every sample of the subset, see predict_lightcurves.
+
+        Args:
+            n_samples (int): Number of production samples, at most all of them. Defaults to 10_000.
+            quantiles (tuple[float]): Quantiles of the bands. Defaults to (0.05, 0.16, 0.5, 0.84, 0.95).
+            chunk_size (int): Number of samples that are evaluated at the same time. Defaults to 1_000.
+            seed (int): Seed of the random subset and the offsets. Defaults to 0.
+
+        Returns:
+            dict[str, np.ndarray]: times with shape (n_times,), filters, quantiles, the bands with shape (n_quantiles, n_filters, n_times), 
+                the best fit lightcurves with shape (n_filters, n_times) and the sampled parameters of the best fit.
+        """
+        if self.n_events:
+            raise NotImplementedError("The posterior predictive is only supported for single events.")
         
-        # Limit N_curves if necessary
-        total_nb_samples = samples.shape[1]
-        N_curves = min(N_curves, total_nb_samples)
+        log_prob, get_samples = self.get_production_log_prob()
+        n_samples = min(n_samples, len(log_prob))
+        # the weighted particles of the SMC backend are drawn according to their weights
+        weights = None
+        if self.smc_results is not None:
+            weights = np.exp(self.smc_results["log_weights"].astype(np.float64))
+            weights /= np.sum(weights)
+        idx = np.sort(np.random.default_rng(seed).choice(len(log_prob), n_samples, replace=weights is not None, p=weights))
+        best_fit_params = get_samples(np.atleast_1d(np.argmax(log_prob)))
         
-        # Randomly sample N_curves samples
-        idx = np.random.choice(total_nb_samples, N_curves, replace=False)
-        samples = samples[:, idx]
-        log_prob = log_prob[idx]
+        times, mag = self.predict_lightcurves(get_samples(idx), chunk_size, key=jax.random.key(seed))
+        bands = jnp.quantile(mag, jnp.asarray(quantiles), axis=0)
+        _, best_fit = self.predict_lightcurves(best_fit_params)
         
-        filters = self.likelihood.filters
+        return {"times": np.asarray(times),
+                "filters": np.array(self.likelihood.filters),
+                "quantiles": np.asarray(quantiles),
+                "bands": np.asarray(bands),
+                "best_fit": np.asarray(best_fit[0]),
+                "best_fit_params": np.asarray(best_fit_params[:, 0])}
+    
+    def save_posterior_predictive(self, outdir: str, **kwargs) -> dict[str, np.ndarray]:
+        """
+        Compute the posterior predictive (see get_posterior_predictive) and save it to outdir/posterior_predictive.npz.
+        The result is kept in self.posterior_predictive, so that plot_lightcurves does not compute it again.
+        """
+        self.posterior_predictive = self.get_posterior_predictive(**kwargs)
+        name = os.path.join(outdir, POSTERIOR_PREDICTIVE_FILENAME)
+        print(f"Saving posterior predictive lightcurves to {name}")
+        np.savez(name, **self.posterior_predictive)
+        return self.posterior_predictive
+
+    def plot_lightcurves(self,
+                         posterior_predictive: dict[str, np.ndarray] | str = None,
+                         outdir: str = None,
+                         N_curves: int = None,
+                         **kwargs):
+        
+        """
+        Plot the data, the posterior predictive bands and the best fit lightcurve more visible on top.
+        The plot only reads the arrays of the posterior predictive, so it can also be made from a saved file.
+
+        Args:
+            posterior_predictive (dict[str, np.ndarray] | str): Posterior predictive as returned by get_posterior_predictive, or the name of a file written by save_posterior_predictive. 
+                Defaults to None, i.e. the posterior predictive of save_posterior_predictive if it was saved, otherwise it is computed with kwargs.
+            outdir (str): Directory of the plot. Defaults to the outdir of the hyperparameters.
+            N_curves (int): Deprecated, use n_samples instead. For backwards compatibility, it can also be given as the first positional argument.
+            **kwargs: Arguments of get_posterior_predictive.
+        """
+        if isinstance(posterior_predictive, (int, np.integer)):
+            posterior_predictive, N_curves = None, posterior_predictive
+        if N_curves is not None:
+            warnings.warn("N_curves is deprecated, the bands are computed from n_samples samples, see get_posterior_predictive.", DeprecationWarning, stacklevel=2)
+            kwargs["n_samples"] = N_curves
+        
+        if posterior_predictive is None:
+            if self.posterior_predictive is None or kwargs:
+                self.posterior_predictive = self.get_posterior_predictive(**kwargs)
+            posterior_predictive = self.posterior_predictive
+        elif isinstance(posterior_predictive, str):
+            posterior_predictive = dict(np.load(posterior_predictive))
+        
+        time_obs, bands, mag_bestfit = posterior_predictive["times"], posterior_predictive["bands"], posterior_predictive["best_fit"]
+        filters = list(posterior_predictive["filters"])
         tmin, tmax = self.likelihood.tmin, self.likelihood.tmax
+        mask = (time_obs >= tmin) & (time_obs <= tmax)
+        n_bands = len(bands) // 2
         
-        ### Plot the data
         height = len(filters) * 2.5
         plt.subplots(nrows = len(filters), ncols = 1, figsize = (8, height))
-        zorder = 3
         for i, filt in enumerate(filters):
             ax = plt.subplot(len(filters), 1, i + 1)
             
+            ### Plot the data
             # Detections
             t, mag, err = self.likelihood.times_det[filt], self.likelihood.mag_det[filt], self.likelihood.mag_err[filt]
             ax.errorbar(t, mag, yerr=err, fmt = "o", color = "red", label = "Data")
             
             # Non-detections
             t, mag = self.likelihood.times_nondet[filt], self.likelihood.mag_nondet[filt]
-            ax.scatter(t, mag, marker = "v", color = "red", zorder = zorder)
+            ax.scatter(t, mag, marker = "v", color = "red", zorder = 3)
             
-        ### Plot bestfit LC
-        best_fit_params_named.update(self.likelihood.fixed_params)
-        
-        zorder = 2
-        # Predict and convert to apparent magnitudes
-        best_fit_params_named = self.likelihood.conversion(best_fit_params_named)
-        time_obs, mag_bestfit = self.likelihood.model.predict(best_fit_params_named)
-
-        for i, filter_name in enumerate(filters):
-            ax = plt.subplot(len(filters), 1, i + 1)
-            mag = mag_bestfit[filter_name]
-            mask = (time_obs >= tmin) & (time_obs <= tmax)
-            ax.plot(time_obs[mask], mag[mask], color = "blue", label = "Best fit", zorder = zorder)
+            ### Plot bestfit LC
+            ax.plot(time_obs[mask], mag_bestfit[i][mask], color = "blue", label = "Best fit", zorder = 2)
             
-        # Other samples
-        zorder = 1
-        for sample in samples.T:
-            sample_named = self.prior.add_name(sample)
-            sample_named.update(self.likelihood.fixed_params)
-            sample_named = self.likelihood.conversion(sample_named)
-            time_obs, mag = self.likelihood.model.predict(sample_named)
-            mask = (time_obs >= tmin) & (time_obs <= tmax)
-
-            for i, filter_name in enumerate(filters):
-                ax = plt.subplot(len(filters), 1, i + 1)
-                ax.plot(time_obs[mask], mag[filter_name][mask], color = "gray", alpha = 0.05, zorder = zorder)
-        
-        ### Make pretty
-        for i, filter_name in enumerate(filters):
-            ax = plt.subplot(len(filters), 1, i + 1)
+            # Nested bands from the outer to the inner quantiles
+            for j in range(n_bands):
+                ax.fill_between(time_obs[mask], bands[j, i][mask], bands[-j - 1, i][mask], color = "gray", alpha = 0.2, lw = 0, zorder = 1)
+        
+            ### Make pretty
             ax.set_xlabel("Time [days]")
-            ax.set_ylabel(filter_name)
+            ax.set_ylabel(filt)
             ax.set_xlim(right = self.likelihood.tmax + 1)
             ax.invert_yaxis()  
         
         # Save
-        plt.savefig(os.path.join(self.Sampler.outdir, "lightcurves.png"), bbox_inches = 'tight')
-        plt.close()
\ No newline at end of file
+        outdir = outdir if outdir is not None else self.outdir
+        plt.savefig(os.path.join(outdir, "lightcurves.png"), bbox_inches = 'tight')
+        plt.close()
@@ -2,6 +2,7 @@
 
 # TODO: improve them with jax treemaps, since dicts are essentially pytrees
 from ast import literal_eval
+import copy
 import dill
 from functools import partial
 import os
@@ -10,12 +11,16 @@ import pickle
 import jax
 import jax.numpy as jnp
 from jaxtyping import Array, Float
+import numpy as np
 
 from flax.training.train_state import TrainState
 
 import fiesta.train.neuralnets as fiesta_nn
-from fiesta.conversions import mag_app_from_mag_abs, apply_redshift
+from fiesta.inference.bundle import ModelBundle, LazyNetworks, get_bundle_filename
+from fiesta.conversions import mag_app_from_mag_abs, weighted_AB_mag
 from fiesta import filters as fiesta_filters
+from fiesta.scalers import DataScaler, MinMaxScalerJax, SVDDecomposer
+from fiesta.train.DataManager import array_mask_from_interval
 
 
 ########################
@@ -30,6 +35,7 @@ class SurrogateModel:
     filters: list[str]
     parameter_names: list[str]
     times: Array
+    precision: str
     
     def __init__(self, 
                  name: str,
@@ -40,17 +46,31 @@ class SurrogateModel:
         self.load_metadata()
         
         self.filters = []
+        self.precision = "float64"
+        self.exported_predict = None
     
     def add_name(self, x: Array):
         return dict(zip(self.parameter_names, x))
     
     def load_metadata(self) -> None:
-        metadata_filename = os.path.join(self.directory, f"{self.name}_metadata.pkl")
-        assert os.path.exists(metadata_filename), f"Metadata file {metadata_filename} not found - check the directory {self.directory}"
+        # prefer the memory-mapped bundle over the pickle files if it exists and is up to date
+        bundle_filename = get_bundle_filename(self.directory, self.name)
+        self.bundle = None
+        if os.path.exists(bundle_filename):
+            self.bundle = ModelBundle(bundle_filename)
+            if self.bundle.is_stale(self.directory):
+                print(f"NOTE: The pickle files of {self.name} changed after the conversion to {bundle_filename}. Loading the pickle files, convert the model again to use the bundle.")
+                self.bundle = None
         
-        # open the file
-        with open(metadata_filename, "rb") as meta_file:
-            metadata = dill.load(meta_file)
+        if self.bundle is not None:
+            metadata = self.bundle.metadata
+        else:
+            metadata_filename = os.path.join(self.directory, f"{self.name}_metadata.pkl")
+            assert os.path.exists(metadata_filename), f"Metadata file {metadata_filename} not found - check the directory {self.directory}"
+            
+            # open the file
+            with open(metadata_filename, "rb") as meta_file:
+                metadata = dill.load(meta_file)
         
         # make the scaler objects attributes
         self.X_scaler = metadata["X_scaler"]
@@ -99,6 +119,13 @@ class SurrogateModel:
             Array: Output array
         """
         raise NotImplementedError
+    
+    def compute_output_samples(self, x: Array, key: jax.random.PRNGKey, n_latent: int) -> Array:
+        """
+        Compute several output samples from the given, transformed input, stacked along a leading axis, to estimate the surrogate uncertainty. 
+        Needs to be implemented by subclasses that support ensembles or latent spaces.
+        """
+        raise ValueError(f"Surrogate {self.name} of type {self.model_type} has neither ensemble members nor a latent space to sample the uncertainty from.")
         
     def project_output(self, y: dict[str, Array]) -> dict[str, Array]:
         """
@@ -116,6 +143,116 @@ class SurrogateModel:
     def convert_to_mag(self, y: Array, x: dict[str, Array]) -> tuple[Array, dict[str, Array]]:
         raise NotImplementedError
     
+    def set_output_subset(self, 
+                          times: Array, 
+                          redshift_range: tuple[Float, Float] = None) -> None:
+        """
+        Restrict the reconstruction of the output to the entries that are needed to interpolate the magnitudes onto the given observer frame times.
+        The inverse output transforms are sliced accordingly, so that every prediction only decodes these entries.
+        This changes the time grid of the model, so it should only be called on a (shallow) copy of a model that is dedicated to a specific data set, see EMLikelihood.
+
+        Args:
+            times (Array): Observer frame times at which the magnitudes will be evaluated.
+            redshift_range (tuple[Float, Float]): Range of redshifts for which the model will be evaluated. Only needed for models whose time grid depends on the redshift.
+        """
+        raise NotImplementedError
+    
+    @property
+    def compute_dtype(self) -> jnp.dtype:
+        """Dtype in which the networks and the inverse output transforms are evaluated."""
+        if self.precision == "float64":
+            return jnp.result_type(float)
+        return jnp.float32
+    
+    def cast_networks(self, precision: str) -> None:
+        """
+        Cast the network parameters and the output scalers to the given precision. Needs to be implemented by subclasses and should only be called through set_precision.
+        """
+        raise NotImplementedError
+    
+    def apply_network(self, apply_fn: callable, params: dict, x: Array) -> Array:
+        """
+        Apply a network in the compute dtype. For ensembles, the mean output of all members is returned.
+        """
+        params = self.get_params(params)
+        if self.model_type == "MLPEnsemble":
+            return jnp.mean(fiesta_nn.apply_ensemble(apply_fn, params, x), axis=0)
+        return apply_fn({'params': params}, x)
+    
+    def get_params(self, params: dict) -> dict:
+        """Network parameters in the compute dtype, i.e. dequantized if they are stored in reduced precision."""
+        if self.precision == "float64":
+            return params
+        return fiesta_nn.dequantize_params(params, self.compute_dtype)
+    
+    def set_precision(self, 
+                      precision: str,
+                      check_accuracy: bool = True,
+                      metric_name: str = "Linf",
+                      threshold: Float = 0.05,
+                      n_test: int = 1_000) -> None:
+        """
+        Evaluate the networks and the inverse output transforms in reduced precision. The conversion to magnitudes and everything downstream stays in the default float precision.
+        Since compiled predictions are cached per model object, this should be called before the first prediction, e.g. through the precision argument of the constructor.
+
+        Args:
+            precision (str): Either 'float64' (default, no reduction), 'float32', 'bfloat16', or 'int8'. For 'bfloat16' and 'int8', only the weights are stored in reduced precision and the evaluation is done in float32.
+            check_accuracy (bool): Whether to compare the reduced precision model with the full precision model on random parameters from the training ranges. Defaults to True.
+            metric_name (str): Benchmarker metric used in the comparison, either 'Linf' or 'L2'. Defaults to 'Linf'.
+            threshold (Float): Largest tolerated error in mag between the reduced and the full precision predictions. Defaults to 0.05.
+            n_test (int): Number of random parameter points for the comparison. Defaults to 1_000.
+        """
+        if precision not in ["float64", "float32", "bfloat16", "int8"]:
+            raise ValueError(f"Precision must be one of 'float64', 'float32', 'bfloat16', or 'int8', got {precision}.")
+        if precision == self.precision:
+            return
+        if self.precision != "float64":
+            raise ValueError(f"Model {self.name} is already in precision {self.precision}, reload the model to change it.")
+        
+        # work on copies, so that no compiled function of self is affected
+        reference = copy.copy(self)
+        reduced = copy.copy(self)
+        reduced.cast_networks(precision)
+        reduced.precision = precision
+        reduced.exported_predict = None
+        
+        if check_accuracy:
+            error = reduced.get_error(reference, metric_name=metric_name, n_test=n_test)
+            if error > threshold:
+                raise ValueError(f"Precision {precision} of {self.name} yields an error of {error:.3e} mag ({metric_name}) with respect to the full precision, which exceeds the threshold {threshold:.3e}.")
+            print(f"Precision {precision} of {self.name} yields an error of {error:.3e} mag ({metric_name}) with respect to the full precision.")
+        
+        self.__dict__.update(reduced.__dict__)
+    
+    def get_error(self, 
+                  reference: "SurrogateModel",
+                  metric_name: str = "Linf",
+                  n_test: int = 1_000,
+                  seed: int = 42) -> Float:
+        """
+        Largest error of the absolute magnitudes of this model with respect to a reference model, evaluated on random parameters drawn uniformly from the training ranges.
+
+        Args:
+            reference (SurrogateModel): Model with the same parameters and filters.
+            metric_name (str): Benchmarker metric, either 'Linf' or 'L2'. Defaults to 'Linf'.
+            n_test (int): Number of random parameter points. Defaults to 1_000.
+            seed (int): Seed for the random parameters. Defaults to 42.
+
+        Returns:
+            Float: The largest error over all parameter points and filters.
+        """
+        from fiesta.train.Benchmarker import get_metric
+        
+        rng = np.random.default_rng(seed)
+        X = np.array([rng.uniform(*self.parameter_distributions[p][:2], size=n_test) for p in self.parameter_names]).T
+        times, mag = self.predict_batch(jnp.array(X))
+        _, mag_ref = reference.predict_batch(jnp.array(X))
+        
+        mask = np.isinf(mag) | np.isinf(mag_ref)
+        diff = np.where(mask, 0., np.asarray(mag) - np.asarray(mag_ref))
+        metric = get_metric(metric_name, np.asarray(times))
+        return float(np.max(metric(diff)))
+    
     @partial(jax.jit, static_argnums=(0,))
     def predict(self, x: dict[str, Array]) -> tuple[Array, dict[str, Array]]:
         """
@@ -134,37 +271,192 @@ class SurrogateModel:
         
         # Use saved parameter names to extract the parameters in the correct order into an array
         x_array = jnp.array([x[name] for name in self.parameter_names])
-
-        # apply the NN
-        x_tilde = self.project_input(x_array)
-        y_tilde = self.compute_output(x_tilde)
-        y = self.project_output(y_tilde)
+        
+        if self.exported_predict is not None:
+            redshift = x.get("redshift", 0.)
+            mag = self.predict_mag_batch(x_array[None], 
+                                         jnp.atleast_1d(x["luminosity_distance"]), 
+                                         jnp.atleast_1d(redshift))[0]
+            return self.observed_times(redshift), dict(zip(self.filters, mag))
+
+        # apply the NN, the named scopes mark the stages in profiler traces (see fiesta.inference.profiling)
+        with jax.named_scope("project_input"):
+            x_tilde = self.project_input(x_array)
+        with jax.named_scope("apply_fn"):
+            y_tilde = self.compute_output(x_tilde)
+        with jax.named_scope("inverse_transform"):
+            y = self.project_output(y_tilde).astype(jnp.result_type(float))
 
         # convert the NN output to apparent magnitude
-        times, mag = self.convert_to_mag(y, x)
+        with jax.named_scope("get_mag"):
+            times, mag = self.convert_to_mag(y, x)
 
         return times, mag
     
+    @partial(jax.jit, static_argnums=(0, 3))
+    def predict_with_uncertainty(self, 
+                                 x: dict[str, Array],
+                                 key: jax.random.PRNGKey = None,
+                                 n_latent: int = 32) -> tuple[Array, dict[str, Array], dict[str, Array]]:
+        """
+        Predict the apparent magnitudes with the surrogate uncertainty, given by the spread of the ensemble members (MLPEnsemble) or of the decoder over the latent space (CVAE).
+        All output samples are computed in a single vmapped call, and the mean and variance of the resulting magnitudes are returned.
+
+        Args:
+            x (dict[str, Array]): Input array, unnormalized and untransformed.
+            key (jax.random.PRNGKey): Key to draw the latent vectors, not used for ensembles. Use a fixed key to get a deterministic function of x, e.g. in the likelihood.
+            n_latent (int): Number of latent vectors, not used for ensembles. Defaults to 32.
+
+        Returns:
+            times
+            mag (dict[str, Array]): Mean of the magnitudes per filter.
+            mag_var (dict[str, Array]): Variance of the magnitudes per filter.
+        """
+        x_array = jnp.array([x[name] for name in self.parameter_names])
+        x_tilde = self.project_input(x_array)
+        
+        y_tilde = self.compute_output_samples(x_tilde, key, n_latent)
+        y = jax.vmap(self.project_output)(y_tilde).astype(jnp.result_type(float))
+        times, mag = jax.vmap(lambda y: self.convert_to_mag(y, x))(y)
+        
+        mag_mean = jax.tree.map(lambda m: jnp.mean(m, axis=0), mag)
+        mag_var = jax.tree.map(lambda m: jnp.var(m, axis=0), mag)
+        return times[0], mag_mean, mag_var
+    
+    @property
+    def predicts_uncertainty(self) -> bool:
+        """Whether predict_with_uncertainty is supported, i.e. whether the model is an ensemble or has a latent space."""
+        return self.model_type == "MLPEnsemble" or getattr(self, "latent_dim", 0) > 0
+    
     def predict_abs_mag(self, x: dict[str, Array]) -> tuple[Array, dict[str, Array]]:
         x["luminosity_distance"] = 1e-5
         x["redshift"] = 0.
 
         return self.predict(x)
     
-    def vpredict(self, X: dict[str, Array]) -> tuple[Array, dict[str, Array]]:
+    @partial(jax.jit, static_argnums=(0,), static_argnames=("chunk_size",))
+    def predict_batch(self,
+                      X: Float[Array, "n_samples n_params"],
+                      luminosity_distance: Float[Array, "n_samples"] = 1e-5,
+                      redshift: Float[Array, "n_samples"] = 0.0,
+                      chunk_size: int = 1_000) -> tuple[Float[Array, "n_times"], Float[Array, "n_samples n_filters n_times"]]:
         """
-        Vectorized prediction function to calculate the apparent magnitudes for several inputs x at the same time.
+        Vectorized prediction of the apparent magnitudes for a batch of parameter points given as an array.
+        The batch is split into chunks of chunk_size that are evaluated one after another with jax.lax.map, so that the peak memory stays bounded for large batches.
+
+        Args:
+            X (Float[Array, "n_samples n_params"]): Parameter points, the columns have to be ordered as self.parameter_names.
+            luminosity_distance (Float[Array, "n_samples"]): Luminosity distance in Mpc, either a scalar or one value per sample. Defaults to 1e-5, i.e. absolute magnitudes.
+            redshift (Float[Array, "n_samples"]): Redshift, either a scalar or one value per sample. Ignored if redshift is one of the parameter_names, since then it is taken from X. Defaults to 0.
+            chunk_size (int): Number of samples that are evaluated at the same time. Defaults to 1_000.
+
+        Returns:
+            times (Float[Array, "n_times"]): Observer frame times of the first sample. For an empty batch, the times at the given redshift.
+            mag (Float[Array, "n_samples n_filters n_times"]): Apparent magnitudes with the filters ordered as self.filters.
         """
+        n_samples = X.shape[0]
+        if n_samples == 0:
+            redshift = redshift if jnp.ndim(redshift) == 0 and "redshift" not in self.parameter_names else 0.0
+            return self.observed_times(redshift), jnp.zeros((0, len(self.filters), len(self.times)), dtype=jnp.result_type(float))
+        chunk_size = min(chunk_size, n_samples)
+        
+        luminosity_distance = jnp.broadcast_to(luminosity_distance, (n_samples,))
+        redshift = jnp.broadcast_to(redshift, (n_samples,))
+        if "redshift" in self.parameter_names:
+            redshift = X[:, self.parameter_names.index("redshift")]
+        
+        # pad the inputs to a multiple of chunk_size and split into chunks
+        n_chunks = -(-n_samples // chunk_size)
+        pad = n_chunks * chunk_size - n_samples
+        def to_chunks(a):
+            a = jnp.pad(a, [(0, pad)] + [(0, 0)] * (a.ndim - 1), mode="edge")
+            return a.reshape(n_chunks, chunk_size, *a.shape[1:])
         
-        X_array = jnp.array([X[name] for name in X.keys()]).T
+        chunks = jax.tree.map(to_chunks, (X, luminosity_distance, redshift))
+        mag = jax.lax.map(lambda chunk: self.predict_mag_batch(*chunk), chunks)
+        mag = mag.reshape(n_chunks * chunk_size, *mag.shape[2:])[:n_samples]
+        
+        return self.observed_times(redshift[0]), mag
+    
+    def predict_mag_array(self,
+                          x: Float[Array, "n_params"],
+                          luminosity_distance: Float,
+                          redshift: Float) -> Float[Array, "n_filters n_times"]:
+        """
+        Apparent magnitudes for a single parameter array, with the filters ordered as self.filters.
+        """
+        with jax.named_scope("project_input"):
+            x_tilde = self.project_input(x)
+        with jax.named_scope("apply_fn"):
+            y_tilde = self.compute_output(x_tilde)
+        with jax.named_scope("inverse_transform"):
+            y = self.project_output(y_tilde).astype(jnp.result_type(float))
+        with jax.named_scope("get_mag"):
+            _, mag = self.convert_to_mag(y, {"luminosity_distance": luminosity_distance, "redshift": redshift})
+        return jnp.array([mag[filt] for filt in self.filters])
+    
+    def predict_mag_batch(self,
+                          X: Float[Array, "n_samples n_params"],
+                          luminosity_distance: Float[Array, "n_samples"],
+                          redshift: Float[Array, "n_samples"]) -> Float[Array, "n_samples n_filters n_times"]:
+        """
+        Apparent magnitudes for a batch of parameter arrays without chunking. Uses the exported function if it was loaded with load_exported_predict.
+        luminosity_distance and redshift can also be scalars that are shared by the whole batch, so that e.g. the filter weights of a fixed redshift are computed only once.
+        """
+        if self.exported_predict is not None:
+            shape = (len(X),)
+            return self.exported_predict.call(X, jnp.broadcast_to(luminosity_distance, shape), jnp.broadcast_to(redshift, shape))
+        in_axes = (0, 0 if jnp.ndim(luminosity_distance) else None, 0 if jnp.ndim(redshift) else None)
+        return jax.vmap(self.predict_mag_array, in_axes=in_axes)(X, luminosity_distance, redshift)
+    
+    def profile(self, 
+                x: dict[str, Array],
+                **kwargs) -> dict:
+        """
+        Time the stages of predict separately, compiled and with gradients, see fiesta.inference.profiling.profile_model.
+        """
+        from fiesta.inference.profiling import profile_model
+        return profile_model(self, x, **kwargs)
+    
+    def load_exported_predict(self, 
+                              directory: str = None,
+                              cache_dir: str = None,
+                              compilation_cache: bool = False) -> None:
+        """
+        Use an ahead-of-time exported version of predict_mag_batch with a symbolic batch dimension.
+        The exported function is loaded from directory if it exists and exported and saved there otherwise, so that other processes do not need to trace the model again.
 
-        def predict_single(x):
-            param_dict = {key: x[j] for j, key in enumerate(X.keys())}
-            return self.predict(param_dict)
+        Args:
+            directory (str): Directory of the exported function. Defaults to the subdirectory exported of the cache directory.
+            cache_dir (str): The fiesta cache directory. Defaults to None, i.e. FIESTA_CACHE_DIR or ~/.cache/fiesta.
+            compilation_cache (bool): Whether to also enable the persistent compilation cache of jax in the cache directory, which changes the global jax configuration, see fiesta.inference.aot.enable_compilation_cache. Defaults to False.
+        """
+        from fiesta.inference.aot import enable_compilation_cache, get_cache_dir, get_exported_predict
+        if compilation_cache:
+            enable_compilation_cache(cache_dir)
+        if directory is None:
+            directory = os.path.join(get_cache_dir(cache_dir), "exported")
+        self.exported_predict = get_exported_predict(self, directory)
+    
+    def vpredict(self, X: dict[str, Array]) -> tuple[Array, dict[str, Array]]:
+        """
+        Vectorized prediction function to calculate the apparent magnitudes for several inputs x at the same time.
+        Wraps predict_batch for inputs given as a dictionary of parameter arrays.
+        """
         
-        times, mag_apps = jax.vmap(predict_single)(X_array)
+        X_array = jnp.array([X[name] for name in self.parameter_names]).T
+        times, mag_apps = self.predict_batch(X_array, 
+                                             X.get("luminosity_distance", 1e-5), 
+                                             X.get("redshift", 0.0))
 
-        return times[0], mag_apps
+        return times, dict(zip(self.filters, jnp.moveaxis(mag_apps, 1, 0)))
+    
+    def observed_times(self, redshift: Float) -> Array:
+        """
+        Time grid of the predicted magnitudes in the observer frame.
+        By default (i.e., in this base class), the model times are not affected by the redshift.
+        """
+        return self.times
     
     def __repr__(self) -> str:
         return self.name
@@ -177,28 +469,40 @@ class LightcurveModel(SurrogateModel):
     X_scaler: object
     y_scaler: dict[str, object]
     models: dict[str, TrainState]
+    fused: bool
     
     def __init__(self,
                  name: str,
                  directory: str,
-                 filters: list[str] = None) -> None:
+                 filters: list[str] = None,
+                 fused: bool = False,
+                 precision: str = "float64") -> None:
         """_summary_
 
         Args:
             name (str): Name of the model
             directory (str): Directory with trained model states and projection metadata such as scalers.
             filters (list[str]): List of all the filters for which the model should be loaded.
+            fused (bool): Whether to stack the networks and output scalers of all filters into batched arrays, so that all filters are evaluated in a single vmapped call. Requires that the networks of all filters share the same architecture. Defaults to False.
+            precision (str): Precision of the network evaluation, see SurrogateModel.set_precision. Defaults to 'float64'.
         """
         super().__init__(name, directory)
+        self.fused = fused
         
         # Load the filters and networks
         self.load_filters(filters)
         self.load_networks()
+        if self.fused:
+            self.fuse_networks()
+        self.set_precision(precision)
         
     def load_filters(self, filters_args: list[str] = None) -> None:
         # Save those filters that were given and that were trained and store here already
-        pkl_files = [file for file in os.listdir(self.directory) if file.endswith(".pkl") or file.endswith(".pickle")]
-        all_available_filters = [(file.split(".")[0]).split("_")[1] for file in pkl_files]
+        if self.bundle is not None:
+            all_available_filters = self.bundle.network_keys
+        else:
+            pkl_files = [file for file in os.listdir(self.directory) if file.endswith(".pkl") or file.endswith(".pickle")]
+            all_available_filters = [(file.split(".")[0]).split("_")[1] for file in pkl_files]
         
         if filters_args is None:
             # Use all filters that the surrogate model supports
@@ -210,16 +514,66 @@ class LightcurveModel(SurrogateModel):
         if len(filters) == 0:
             raise ValueError(f"No filters found in {self.directory} that match the given filters {filters_args}.")
         self.filters = filters
-        self.Filters = [fiesta_filters.Filter(filt) for filt in self.filters]
+        self.Filters = [fiesta_filters.get_filter(filt) for filt in self.filters]
         print(f"Loaded SurrogateLightcurveModel with filters {self.filters}.")
         
     def load_networks(self) -> None:
+        if self.bundle is not None:
+            # networks are loaded from the bundle on first use
+            self.models = LazyNetworks(self.bundle)
+            return
+        
         self.models = {}
         for filter in self.filters:
             filename = os.path.join(self.directory, f"{self.name}_{filter}.pkl")
-            state, _ = fiesta_nn.MLP.load_model(filename)
+            if self.model_type == "MLPEnsemble":
+                state, _ = fiesta_nn.MLPEnsemble.load_model(filename)
+            else:
+                state, _ = fiesta_nn.MLP.load_model(filename)
             self.models[filter] = state
     
+    def fuse_networks(self) -> None:
+        """
+        Stack the network parameters and the output scalers of all filters along a leading filter axis.
+        Afterwards, compute_output and project_output evaluate the whole filter set with one batched call instead of one call per filter.
+        """
+        params = [self.models[filt].params for filt in self.filters]
+        try:
+            self.fused_params = jax.tree.map(lambda *p: jnp.stack(p), *params)
+        except ValueError:
+            raise ValueError(f"Cannot fuse the networks of {self.name}, since the filters {self.filters} do not share the same network architecture.")
+        self.fused_apply_fn = self.models[self.filters[0]].apply_fn
+        
+        VA, min_val, max_val = zip(*[get_svd_inverse_arrays(self.y_scaler[filt]) for filt in self.filters])
+        self.fused_VA = jnp.stack(VA)
+        self.fused_min_val = jnp.stack(min_val)
+        self.fused_max_val = jnp.stack(max_val)
+    
+    def cast_networks(self, precision: str) -> None:
+        self.models = {filt: self.models[filt].replace(params=fiesta_nn.quantize_params(self.models[filt].params, precision)) for filt in self.filters}
+        self.y_scaler = {filt: self.y_scaler[filt].astype(jnp.float32) for filt in self.filters}
+        if self.fused:
+            self.fused_params = fiesta_nn.quantize_params(self.fused_params, precision)
+            self.fused_VA = self.fused_VA.astype(jnp.float32)
+            self.fused_min_val = self.fused_min_val.astype(jnp.float32)
+            self.fused_max_val = self.fused_max_val.astype(jnp.float32)
+    
+    def set_output_subset(self, 
+                          times: Array, 
+                          redshift_range: tuple[Float, Float] = None) -> None:
+        # the time grid of the lightcurve models does not depend on the redshift
+        mask = get_bracketing_mask(self.times, times, times)
+        idx = np.where(mask)[0]
+
+        self.exported_predict = None
+        self.times = self.times[idx]
+        self.y_scaler = {filt: self.y_scaler[filt].output_subset(idx) for filt in self.filters}
+        if self.fused:
+            self.fused_VA = self.fused_VA[:, :, idx]
+            self.fused_min_val = self.fused_min_val[:, idx]
+            self.fused_max_val = self.fused_max_val[:, idx]
+        print(f"Reconstructing {len(idx)} out of {len(mask)} time points per filter.")
+    
     def project_input(self, x: Array) -> Array:
         """
         Project the given input to whatever preprocessed input space we are in.
@@ -243,13 +597,29 @@ class LightcurveModel(SurrogateModel):
         Returns:
             dict[str, Array]: _description_
         """
+        x = x.astype(self.compute_dtype)
+        if self.fused:
+            return jax.vmap(lambda params: self.apply_network(self.fused_apply_fn, params, x))(self.fused_params)
+        
         def apply_model(filter):
             model = self.models[filter]
-            output = model.apply_fn({'params': model.params}, x)
+            output = self.apply_network(model.apply_fn, model.params, x)
             return output
         
         y = jax.tree.map(apply_model, self.filters) # avoid for loop with jax.tree.map 
         return dict(zip(self.filters, y))
+    
+    def compute_output_samples(self, x: Array, key: jax.random.PRNGKey, n_latent: int) -> Array:
+        if self.model_type != "MLPEnsemble":
+            return super().compute_output_samples(x, key, n_latent)
+        
+        x = x.astype(self.compute_dtype)
+        if self.fused:
+            y = jax.vmap(lambda params: fiesta_nn.apply_ensemble(self.fused_apply_fn, self.get_params(params), x))(self.fused_params)
+            return jnp.moveaxis(y, 1, 0) # members on the leading axis
+        
+        y = [fiesta_nn.apply_ensemble(self.models[filt].apply_fn, self.get_params(self.models[filt].params), x) for filt in self.filters]
+        return dict(zip(self.filters, y))
         
     def project_output(self, y: dict[str, Array]) -> dict[str, Array]:
         """
@@ -261,6 +631,10 @@ class LightcurveModel(SurrogateModel):
         Returns:
             dict[str, Array]: Output array transformed to the preprocessed space.
         """
+        if self.fused:
+            y = jnp.einsum("fc,fct->ft", y, self.fused_VA)
+            return y * (self.fused_max_val - self.fused_min_val) + self.fused_min_val
+        
         def inverse_transform(filter):
             y_scaler = self.y_scaler[filter]
             output = y_scaler.inverse_transform(y[filter])
@@ -280,18 +654,20 @@ class FluxModel(SurrogateModel):
     def __init__(self,
                  name: str,
                  directory: str,
-                 filters: list[str] = None):
+                 filters: list[str] = None,
+                 precision: str = "float64"):
         super().__init__(name, directory)
 
         # Load the filters and networks
         self.load_filters(filters)
         self.load_networks()
+        self.set_precision(precision)
 
     def load_filters(self, filters: list[str] = None) -> None:
         self.Filters = []
         for filter in filters:
             try:
-                Filter = fiesta_filters.Filter(filter)
+                Filter = fiesta_filters.get_filter(filter)
                 if Filter.nu<self.nus[0] or Filter.nu>self.nus[-1]:
                     continue
                 self.Filters.append(Filter)
@@ -306,18 +682,31 @@ class FluxModel(SurrogateModel):
 
     def load_networks(self) -> None:
         filename = os.path.join(self.directory, f"{self.name}.pkl")
-        if self.model_type == "MLP":
+        if self.model_type not in ["MLP", "MLPEnsemble", "CVAE"]:
+            raise ValueError(f"Model type must be either 'MLP', 'MLPEnsemble', or 'CVAE'.")
+        
+        if self.bundle is not None:
+            state, _ = self.bundle.load_network(self.name)
+        elif self.model_type == "MLP":
             state, _ = fiesta_nn.MLP.load_model(filename)
-            latent_dim = 0
-        elif self.model_type == "CVAE":
-           state, _ = fiesta_nn.CVAE.load_model(filename)
-           x_tilde_dim = self.X_scaler.transform(jnp.zeros(len(self.parameter_names)).reshape(1, -1) ).shape[1]
-           latent_dim = state.params["layers_0"]["kernel"].shape[0] - x_tilde_dim
+        elif self.model_type == "MLPEnsemble":
+            state, _ = fiesta_nn.MLPEnsemble.load_model(filename)
         else:
-            raise ValueError(f"Model type must be either 'MLP' or 'CVAE'.")
+            state, _ = fiesta_nn.CVAE.load_model(filename)
+        
+        # only the CVAE takes a latent vector in addition to the parameters
+        latent_dim = 0
+        if self.model_type == "CVAE":
+            x_tilde_dim = self.X_scaler.transform(jnp.zeros(len(self.parameter_names)).reshape(1, -1) ).shape[1]
+            latent_dim = state.params["layers_0"]["kernel"].shape[0] - x_tilde_dim
+        self.latent_dim = latent_dim
         self.latent_vector = jnp.array(jnp.zeros(latent_dim)) # TODO: how to get latent vector?
         self.models = state
     
+    def cast_networks(self, precision: str) -> None:
+        self.models = self.models.replace(params=fiesta_nn.quantize_params(self.models.params, precision))
+        self.y_scaler = self.y_scaler.astype(jnp.float32)
+    
     def project_input(self, x: Array) -> Array:
         """
         Project the given input to whatever preprocessed input space we are in.
@@ -343,10 +732,25 @@ class FluxModel(SurrogateModel):
         Returns:
             dict[str, Array]: _description_
         """
-        x = jnp.concatenate((self.latent_vector, x))
-        output = self.models.apply_fn({'params': self.models.params}, x)
+        return self.compute_output_at_latent(x, self.latent_vector)
+    
+    def compute_output_at_latent(self, x: Array, z: Array) -> Array:
+        """
+        Apply the trained flax neural network on the given input x, conditioned on the latent vector z (empty for MLPs).
+        """
+        x = jnp.concatenate((z, x)).astype(self.compute_dtype)
+        output = self.apply_network(self.models.apply_fn, self.models.params, x)
         return output
-        
+    
+    def compute_output_samples(self, x: Array, key: jax.random.PRNGKey, n_latent: int) -> Array:
+        if self.model_type == "MLPEnsemble":
+            x = jnp.concatenate((self.latent_vector, x)).astype(self.compute_dtype)
+            return fiesta_nn.apply_ensemble(self.models.apply_fn, self.get_params(self.models.params), x)
+        elif self.latent_dim > 0:
+            z = jax.random.normal(key, (n_latent, self.latent_dim))
+            return jax.vmap(self.compute_output_at_latent, in_axes=(None, 0))(x, z)
+        return super().compute_output_samples(x, key, n_latent)
+    
     def project_output(self, y: Array) -> dict[str, Array]:
         """
         Project the computed output to whatever preprocessed output space we are in.
@@ -364,19 +768,45 @@ class FluxModel(SurrogateModel):
     
     def convert_to_mag(self, y: Array, x: dict[str, Array]) -> tuple[Array, dict[str, Array]]:
 
-        mJys = jnp.exp(y)
-
-        mJys_obs, times_obs, nus_obs = apply_redshift(mJys, self.times, self.nus, x["redshift"])
+        # the redshift factor of the flux density (see apply_redshift) is a shift of the log flux
+        log_mJys_obs = y + jnp.log(1 + x["redshift"])
+        times_obs, nus_obs = self.times * (1 + x["redshift"]), self.nus / (1 + x["redshift"])
         # TODO: Add EBL table here at some point
 
-        mag_abs = jax.tree.map(lambda Filter: Filter.get_mag(mJys_obs, nus_obs), 
-                               self.Filters)
-        mag_abs = jnp.array(mag_abs)
+        # all filters are evaluated with one matrix product, equivalent to Filter.get_mag
+        W, offsets = zip(*[Filter.get_mag_weights(nus_obs) for Filter in self.Filters])
+        mag_abs = weighted_AB_mag(log_mJys_obs, jnp.stack(W), jnp.array(offsets))
         
         mag_app = mag_app_from_mag_abs(mag_abs, x["luminosity_distance"])
         
         return times_obs, dict(zip(self.filters, mag_app))
     
+    def observed_times(self, redshift: Float) -> Array:
+        """Time grid of the predicted magnitudes in the observer frame, i.e. stretched by the redshift."""
+        return self.times * (1 + redshift)
+    
+    def set_output_subset(self, 
+                          times: Array, 
+                          redshift_range: tuple[Float, Float] = None) -> None:
+        if redshift_range is None:
+            raise ValueError(f"The time and frequency grid of {self.name} depend on the redshift, so a redshift range is needed to set an output subset.")
+        zmin, zmax = redshift_range
+
+        # observer frame times and filter frequencies are mapped to the source frame
+        time_mask = get_bracketing_mask(self.times, times / (1 + zmax), times / (1 + zmin))
+        nus_min = jnp.array([jnp.min(Filter.nus) for Filter in self.Filters])
+        nus_max = jnp.array([jnp.max(Filter.nus) for Filter in self.Filters])
+        nu_mask = get_bracketing_mask(self.nus, nus_min * (1 + zmin), nus_max * (1 + zmax))
+        
+        time_idx, nu_idx = np.where(time_mask)[0], np.where(nu_mask)[0]
+        idx = (nu_idx[:, None] * len(self.times) + time_idx[None, :]).flatten()
+
+        self.exported_predict = None
+        self.y_scaler = self.y_scaler.output_subset(idx)
+        self.times = self.times[time_idx]
+        self.nus = self.nus[nu_idx]
+        print(f"Reconstructing {len(idx)} out of {len(time_mask) * len(nu_mask)} entries of the flux array.")
+    
     def predict_log_flux(self, x: Array) -> Array:
         """
         Predict the total log flux array for the parameters x.
@@ -387,17 +817,62 @@ class FluxModel(SurrogateModel):
         Returns:
             log_flux [Array]: Array of log-fluxes.
         """
-        x = x.reshape(1,-1)
-        x_tilde = self.X_scaler.transform(x)
-        x_tilde = x_tilde.reshape(-1)
-        x_tilde = jnp.concatenate((self.latent_vector, x_tilde))
-        y = self.models.apply_fn({'params': self.models.params}, x_tilde)
-
-        logflux = self.y_scaler.inverse_transform(y)
-        logflux = logflux.reshape(len(self.nus), len(self.times))
+        x_tilde = self.project_input(x)
+        y = self.compute_output(x_tilde)
+        logflux = self.project_output(y).astype(jnp.result_type(float))
         return logflux
 
 
+def get_bracketing_mask(grid: Array, 
+                        lower: Array, 
+                        upper: Array) -> np.ndarray:
+    """
+    Get the mask of the grid points that are needed to linearly interpolate on the grid at any value within the intervals [lower, upper].
+    Values outside the grid are extrapolated (or clamped) with the first or last two grid points, which are then included as well.
+
+    Args:
+        grid (Array): Sorted grid, e.g. the model times.
+        lower (Array): Lower bounds of the intervals.
+        upper (Array): Upper bounds of the intervals.
+
+    Returns:
+        np.ndarray: Boolean mask over the grid.
+    """
+    grid = np.asarray(grid)
+    lower, upper = np.atleast_1d(lower), np.atleast_1d(upper)
+
+    mask = np.zeros(len(grid), dtype=bool)
+    for amin, amax in zip(lower, upper):
+        mask |= array_mask_from_interval(grid, amin, amax)
+    
+    if np.min(lower) < grid[0]:
+        mask[:2] = True
+    if np.max(upper) > grid[-1]:
+        mask[-2:] = True
+    return mask
+
+def get_svd_inverse_arrays(y_scaler: object) -> tuple[Array, Array, Array]:
+    """
+    Get the arrays that define the inverse transform of a lightcurve output scaler, i.e. y = (c @ VA) * (max_val - min_val) + min_val.
+    Used to stack the output scalers of several filters in LightcurveModel.fuse_networks.
+
+    Args:
+        y_scaler (object): Output scaler of a single filter. Either a DataScaler wrapping a single SVDDecomposer, an SVDDecomposer, or a MinMaxScalerJax.
+
+    Returns:
+        tuple[Array, Array, Array]: The projection matrix VA and the min and max values of the min-max scaling.
+    """
+    if isinstance(y_scaler, DataScaler) and len(y_scaler.scalers) == 1:
+        y_scaler = y_scaler.scalers[0]
+    
+    if isinstance(y_scaler, SVDDecomposer):
+        return y_scaler.VA, y_scaler.scaler.min_val, y_scaler.scaler.max_val
+    elif isinstance(y_scaler, MinMaxScalerJax):
+        return jnp.eye(len(y_scaler.min_val)), y_scaler.min_val, y_scaler.max_val
+    else:
+        raise ValueError(f"Output scaler of type {type(y_scaler).__name__} cannot be fused.")
+
+
 #################
 # MODEL CLASSES #
 #################
@@ -407,15 +882,18 @@ class BullaLightcurveModel(LightcurveModel):
     def __init__(self, 
                  name: str, 
                  directory: str,
-                 filters: list[str] = None):
+                 filters: list[str] = None,
+                 fused: bool = False,
+                 precision: str = "float64"):
         
-        super().__init__(name=name, directory=directory, filters=filters)
+        super().__init__(name=name, directory=directory, filters=filters, fused=fused, precision=precision)
 
 class AfterglowFlux(FluxModel):
     
     def __init__(self,
                  name: str,
                  directory: str,
-                 filters: list[str] = None):
-        super().__init__(name=name, directory=directory, filters=filters)
+                 filters: list[str] = None,
+                 precision: str = "float64"):
+        super().__init__(name=name, directory=directory, filters=filters, precision=precision)
     
\ No newline at end of file
@@ -5,12 +5,16 @@ from typing import Callable
 
 import numpy as np
 import jax
-from jaxtyping import Float, Array
+from jaxtyping import Float, Int, Bool, Array
 import jax.numpy as jnp
 
 from fiesta.inference.lightcurve_model import LightcurveModel
 from fiesta.utils import truncated_gaussian
 
+def get_bucket_size(n: int, min_size: int = 8) -> int:
+    """Smallest power of two that is at least n (and min_size), used to pad the observations."""
+    return max(min_size, 1 << (int(n) - 1).bit_length())
+
 class EMLikelihood:
     
     model: LightcurveModel
@@ -30,6 +34,18 @@ class EMLikelihood:
     times_nondet: dict[str, Array]
     mag_nondet: dict[str, Array]
     
+    obs_times: Float[Array, "n_obs"]
+    obs_mag: Float[Array, "n_obs"]
+    obs_sigma: Float[Array, "n_obs"]
+    obs_filter_idx: Int[Array, "n_obs"]
+    obs_lim: Float[Array, "n_obs"]
+    obs_is_det: Bool[Array, "n_obs"]
+    data: dict[str, Array]
+    
+    offset_names: list[str]
+    offset_prior_mean: Float[Array, "n_offsets"]
+    offset_prior_precision: Float[Array, "n_offsets"]
+    
     def __init__(self, 
                  model: LightcurveModel, 
                  data: dict[str, Float[Array, "ntimes 3"]],
@@ -40,14 +56,46 @@ class EMLikelihood:
                  error_budget: Float = 1.0,
                  conversion_function: Callable = lambda x: x,
                  fixed_params: dict[str, Float] = {},
-                 detection_limit: Float = None):
+                 detection_limit: Float = None,
+                 output_subset: bool = False,
+                 redshift_range: tuple[Float, Float] = None,
+                 surrogate_uncertainty: bool = False,
+                 n_latent: int = 32,
+                 latent_seed: int = 0,
+                 pad_to_bucket: bool = True,
+                 marginalize_distance_modulus: bool = False,
+                 distance_modulus_prior: tuple[Float, Float] = None,
+                 calibration_offsets: dict[str, Float] = None):
+        """
+        Args:
+            model (LightcurveModel): Surrogate model.
+            data (dict[str, Float[Array, "ntimes 3"]]): Observations of each filter as rows of (time, magnitude, error), non-detections have an infinite error.
+            filters (list[str]): Filters used in the likelihood. Defaults to None, i.e. the filters of the model.
+            trigger_time (Float): Time that is subtracted from the observation times. Defaults to 0.
+            tmin (Float): Observations before tmin (after subtracting the trigger time) are dropped. Defaults to 0.
+            tmax (Float): Observations after tmax are dropped. Defaults to 999.
+            error_budget (Float): Systematic uncertainty that is added in quadrature to the measurement errors, either one value or one per filter. Defaults to 1.
+            conversion_function (Callable): Conversion of the parameters before the model is evaluated. Defaults to the identity.
+            fixed_params (dict[str, Float]): Parameters that are not sampled. Defaults to {}.
+            detection_limit (Float): Detection limit at which the Gaussian of the detections is truncated, either one value or one per filter. Defaults to None, i.e. no truncation.
+            output_subset (bool): Whether the model only reconstructs the outputs needed at the observation times, see set_output_subset. Defaults to False.
+            redshift_range (tuple[Float, Float]): Redshift range for the output subset. Defaults to None.
+            surrogate_uncertainty (bool): Whether to add the uncertainty of an ensemble or CVAE surrogate to the observational uncertainties. Defaults to False.
+            n_latent (int): Number of latent samples or ensemble members for the surrogate uncertainty. Defaults to 32.
+            latent_seed (int): Seed of the fixed latent samples. Defaults to 0.
+            pad_to_bucket (bool): Whether to pad the observations to the next power of two, see set_data. Defaults to True.
+            marginalize_distance_modulus (bool): Whether to marginalize analytically over the distance modulus, which then is not sampled. The model is evaluated at 10 pc, i.e. in absolute magnitudes. Defaults to False.
+            distance_modulus_prior (tuple[Float, Float]): Mean and standard deviation of the Gaussian prior on the distance modulus. Defaults to None, i.e. a flat prior.
+            calibration_offsets (dict[str, Float]): Standard deviations of the Gaussian priors (with zero mean) on the zero-point offsets of the filters, which are marginalized analytically. np.inf gives a flat prior. Defaults to None, i.e. no calibration offsets.
+        """
         
         # Save as attributes
         self.model = model
         self.conversion = conversion_function
-        if filters is None:
-            filters = model.filters
-        self.filters = filters
+        # copy, the model may be shared through the registry and must not be modified
+        filters = list(model.filters if filters is None else filters)
+        # the packed observations refer to the filters by their position in the output of the model
+        self.model_filters = list(model.filters)
         self.trigger_time = trigger_time
         self.tmin = tmin
         self.tmax = tmax
@@ -83,11 +131,12 @@ class EMLikelihood:
         
         processed_data = copy.deepcopy(data)
         
-        for filt in self.filters:
+        self.filters = []
+        for filt in filters:
             if filt not in processed_data:
                 print(f"NOTE: Filter {filt} not found in the data. Removing for inference.")
-                self.filters.remove(filt)
                 continue
+            self.filters.append(filt)
             
             # Preprocess times before data selection
             times, mag, mag_err = processed_data[filt].T
@@ -113,12 +162,222 @@ class EMLikelihood:
             self.sigma[filt] = jnp.sqrt(self.mag_err[filt] ** 2 + self.error_budget[filt] ** 2)
             
         self.fixed_params = fixed_params
+        self.set_offsets(marginalize_distance_modulus, distance_modulus_prior, calibration_offsets)
         
         # Sanity check:
         detection_present = any([len(self.times_det[filt]) > 0 for filt in self.filters])
         assert detection_present, "No detections found in the data. Please check your data."
+        
+        self.pad_to_bucket = pad_to_bucket
+        self.pack_observations()
+        self.set_likelihood_terms()
+        if self.offset_names and (self.has_truncation or self.has_nondetections):
+            raise ValueError("The analytic marginalization over offsets is only possible for Gaussian detections, i.e. without non-detections and detection limits.")
         print("Loading and preprocessing observations in likelihood . . . DONE")
         
+        # Surrogate uncertainty from ensemble models or the latent space of CVAE models, 
+        # the latent vectors are fixed by the seed so that the likelihood is a deterministic function of theta
+        self.surrogate_uncertainty = surrogate_uncertainty
+        self.n_latent = n_latent
+        self.latent_key = jax.random.key(latent_seed)
+        if self.surrogate_uncertainty and not self.model.predicts_uncertainty:
+            raise ValueError(f"The surrogate uncertainty can only be added for ensembles or models with a latent space, but {self.model} is neither.")
+        
+        # Model that is used in the likelihood evaluation, the full model is kept for plotting
+        self.evaluation_model = self.model
+        if output_subset:
+            self.set_output_subset(redshift_range)
+        else:
+            self.set_interpolation_stencils()
+    
+    def pack_observations(self) -> None:
+        """
+        Pack the detections and non-detections of all filters into flat arrays, so that the likelihood is evaluated with a single gather and a single masked reduction instead of one pass per filter.
+        For detections, obs_sigma is the measurement error with the error budget, for non-detections it is the error budget. obs_filter_idx refers to the filters of the model in the order of self.model_filters.
+        """
+        times, mag, sigma, filter_idx, lim, is_det = [], [], [], [], [], []
+        for filt in self.filters:
+            if filt not in self.model_filters:
+                raise ValueError(f"Filter {filt} is not a filter of the model {self.model.name}.")
+            n_det, n_nondet = len(self.times_det[filt]), len(self.times_nondet[filt])
+            times.extend([self.times_det[filt], self.times_nondet[filt]])
+            mag.extend([self.mag_det[filt], self.mag_nondet[filt]])
+            sigma.extend([self.sigma[filt], np.full(n_nondet, self.error_budget[filt])])
+            filter_idx.append(np.full(n_det + n_nondet, self.model_filters.index(filt)))
+            lim.append(np.full(n_det + n_nondet, self.detection_limit[filt]))
+            is_det.extend([np.ones(n_det, dtype=bool), np.zeros(n_nondet, dtype=bool)])
+        
+        self.obs_times = jnp.asarray(np.concatenate(times))
+        self.obs_mag = jnp.asarray(np.concatenate(mag))
+        self.obs_sigma = jnp.asarray(np.concatenate(sigma))
+        self.obs_filter_idx = jnp.asarray(np.concatenate(filter_idx))
+        self.obs_lim = jnp.asarray(np.concatenate(lim))
+        self.obs_is_det = jnp.asarray(np.concatenate(is_det))
+    
+    def set_likelihood_terms(self) -> None:
+        """
+        Decide at construction which terms of the likelihood exist, so that only their code paths are traced and compiled:
+        the truncated Gaussian is only needed if a filter has a finite detection limit, and the non-detection term only if there are non-detections.
+        """
+        self.has_truncation = bool(np.any(np.isfinite(np.asarray(self.obs_lim)) & np.asarray(self.obs_is_det)))
+        self.has_nondetections = bool(not np.all(np.asarray(self.obs_is_det)))
+    
+    def set_offsets(self,
+                    marginalize_distance_modulus: bool,
+                    distance_modulus_prior: tuple[Float, Float],
+                    calibration_offsets: dict[str, Float]) -> None:
+        """
+        Set up the constant magnitude offsets that are marginalized analytically: the distance modulus, which is the same for all filters, and the zero-point offsets of single filters.
+        The detections are linear in the offsets, so for Gaussian (or flat) priors the offsets can be integrated out in closed form, see marginalize_offsets.
+        """
+        self.offset_names, mean, std = [], [], []
+        if marginalize_distance_modulus:
+            if "luminosity_distance" in self.fixed_params:
+                raise ValueError("The luminosity distance is fixed, so the distance modulus can not be marginalized.")
+            # evaluate the model at 10 pc, then the offset is the distance modulus
+            self.fixed_params = {**self.fixed_params, "luminosity_distance": 1e-5}
+            self.offset_names.append("distance_modulus")
+            mu, sigma = distance_modulus_prior if distance_modulus_prior is not None else (0., np.inf)
+            mean.append(mu)
+            std.append(sigma)
+        
+        if calibration_offsets is None:
+            calibration_offsets = {}
+        for filt, sigma in calibration_offsets.items():
+            if filt not in self.filters:
+                raise ValueError(f"Calibration offset given for filter {filt}, which is not used in the likelihood.")
+            self.offset_names.append(f"offset_{filt}")
+            mean.append(0.)
+            std.append(sigma)
+        
+        self.calibration_filters = list(calibration_offsets.keys())
+        self.offset_prior_mean = jnp.array(mean, dtype=float)
+        self.offset_prior_precision = jnp.array([1 / s**2 for s in std], dtype=float) # zero for flat priors
+    
+    def set_output_subset(self, redshift_range: tuple[Float, Float] = None) -> None:
+        """
+        Set up a copy of the model that only reconstructs the outputs needed to interpolate at the observed times.
+        Since the compiled likelihood then depends on the observation times, it can not be shared with other events, see set_data.
+        
+        Args:
+            redshift_range (tuple[Float, Float]): Redshift range for which the model will be evaluated. If None, it is taken from the fixed parameters or the training range of the model.
+        """
+        if redshift_range is None:
+            if "redshift" in self.fixed_params:
+                redshift_range = (self.fixed_params["redshift"], self.fixed_params["redshift"])
+            elif "redshift" in self.model.parameter_distributions:
+                redshift_range = tuple(self.model.parameter_distributions["redshift"][:2])
+        
+        times = np.concatenate([self.times_det[filt] for filt in self.filters] + [self.times_nondet[filt] for filt in self.filters])
+        
+        # shallow copy to get a fresh jit cache and keep the original model intact
+        self.evaluation_model = copy.copy(self.model)
+        self.evaluation_model.set_output_subset(times, redshift_range)
+        self.set_interpolation_stencils()
+    
+    def set_interpolation_stencils(self) -> None:
+        """
+        Precompute the bracketing indices and weights to linearly interpolate the output of the evaluation model onto the observation times.
+        If the time grid of the model does not depend on the redshift (or the redshift is fixed), indices and weights are fixed and the interpolation is a gather plus a multiply-add.
+        Otherwise, the grid is stretched by (1+z) and the observation times are mapped to the source frame in every evaluation. For a grid that is uniform in log-time, the bracketing indices are then obtained from a floor instead of a binary search.
+        """
+        model = self.evaluation_model
+        times = np.asarray(model.times)
+        obs_times = np.asarray(self.obs_times)
+        
+        self.stretched_times = not np.allclose(model.observed_times(1.), times)
+        if "redshift" in self.fixed_params or not self.stretched_times:
+            self.stretched_times = False
+            grid = np.asarray(model.observed_times(self.fixed_params.get("redshift", 0.)))
+            idx = np.clip(np.searchsorted(grid, obs_times), 1, len(grid) - 1)
+            self.stencil_idx = jnp.asarray(idx)
+            self.stencil_weight = jnp.asarray((obs_times - grid[idx - 1]) / (grid[idx] - grid[idx - 1]))
+        else:
+            log_spacing = np.diff(np.log(times))
+            self.log_uniform_times = bool(np.allclose(log_spacing, log_spacing[0]))
+            if self.log_uniform_times:
+                self.log_time_start, self.log_time_step = float(np.log(times[0])), float(log_spacing[0])
+        
+        self.set_data()
+    
+    def set_data(self, n_data: int = None) -> None:
+        """
+        Collect the packed observations, the stencils and the values of the fixed parameters in the pytree self.data that evaluate takes as an argument instead of baking them into the compiled graph as constants.
+        The observations are padded to the next power of two, so that the compiled likelihood (e.g. the sampler of fiesta.inference.fiesta.Fiesta with the persistent compilation cache) is shared by all events with the same model, settings, and bucket size.
+        Padded entries are masked out by data["is_valid"].
+        
+        Args:
+            n_data (int): Length to which the observations are padded. Defaults to None, i.e. the bucket size if pad_to_bucket is set and no padding otherwise.
+        """
+        n_obs = len(self.obs_times)
+        if n_data is None:
+            n_data = get_bucket_size(n_obs) if self.pad_to_bucket else n_obs
+        if n_data < n_obs:
+            raise ValueError(f"Cannot pad {n_obs} observations to {n_data}.")
+        n_pad = n_data - n_obs
+        pad = lambda x, value: jnp.concatenate([x, jnp.full(n_pad, value, dtype=x.dtype)])
+        
+        self.data = {"times": pad(self.obs_times, self.obs_times[0]),
+                     "mag": pad(self.obs_mag, 0.),
+                     "sigma": pad(self.obs_sigma, 1.),
+                     "filter_idx": pad(self.obs_filter_idx, 0),
+                     "lim": pad(self.obs_lim, jnp.inf),
+                     "is_det": pad(self.obs_is_det, True),
+                     "is_valid": pad(jnp.ones(n_obs, dtype=bool), False),
+                     "fixed_params": {key: jnp.asarray(value) for key, value in self.fixed_params.items()}}
+        if not self.stretched_times:
+            self.data["stencil_idx"] = pad(self.stencil_idx, 1)
+            self.data["stencil_weight"] = pad(self.stencil_weight, 0.)
+        if self.offset_names:
+            self.set_offset_data()
+    
+    def set_offset_data(self) -> None:
+        """
+        Add the design matrix of the offsets and, if the uncertainties do not depend on theta, the precision matrix of the offset posterior to self.data.
+        """
+        columns = []
+        if "distance_modulus" in self.offset_names:
+            columns.append(jnp.ones_like(self.data["mag"]))
+        for filt in self.calibration_filters:
+            columns.append((self.data["filter_idx"] == self.model_filters.index(filt)).astype(self.data["mag"].dtype))
+        design = jnp.where(self.data["is_valid"][:, None], jnp.stack(columns, axis=1), 0.)
+        self.data["offset_design"] = design
+        self.data["offset_prior_mean"] = self.offset_prior_mean
+        self.data["offset_prior_precision"] = self.offset_prior_precision
+        
+        if not self.surrogate_uncertainty:
+            self.data["offset_precision"] = self.get_offset_precision(self.data["sigma"], self.data)
+        
+        precision = np.asarray(self.get_offset_precision(self.data["sigma"], self.data))
+        if np.linalg.matrix_rank(precision) < len(self.offset_names):
+            raise ValueError(f"The offsets {self.offset_names} are degenerate with flat priors, use Gaussian priors for some of them.")
+    
+    def get_offset_precision(self,
+                             sigma: Float[Array, "n_obs"],
+                             data: dict) -> Float[Array, "n_offsets n_offsets"]:
+        """Precision matrix of the posterior of the offsets, i.e. the Fisher matrix of the detections plus the prior precision."""
+        design = data["offset_design"]
+        return design.T @ (design / sigma[:, None]**2) + jnp.diag(data["offset_prior_precision"])
+    
+    def get_stencils(self, 
+                     redshift: Float, 
+                     data: dict) -> tuple[Int[Array, "n_obs"], Float[Array, "n_obs"]]:
+        """
+        Indices of the upper bracketing grid points and the interpolation weights of all observations. The weights lie outside [0, 1] for extrapolation.
+        """
+        if not self.stretched_times:
+            return data["stencil_idx"], data["stencil_weight"]
+        
+        times = jnp.asarray(self.evaluation_model.times)
+        if self.log_uniform_times:
+            idx = jnp.floor((jnp.log(data["times"]) - jnp.log1p(redshift) - self.log_time_start) / self.log_time_step).astype(int) + 1
+        else:
+            idx = jnp.searchsorted(times, data["times"] / (1 + redshift))
+        idx = jnp.clip(idx, 1, len(times) - 1)
+        
+        t0, t1 = times[idx - 1] * (1 + redshift), times[idx] * (1 + redshift)
+        return idx, (data["times"] - t0) / (t1 - t0)
+        
     def __call__(self, theta):
         return self.evaluate(theta)
         
@@ -130,102 +389,325 @@ class EMLikelihood:
 
         Args:
             theta (dict[str, Array]): _description_
-            data (dict, optional): Unused, but kept to comply with flowMC likelihood function signature. Defaults to None.
+            data (dict, optional): Observations and fixed parameters as returned by set_data, passed by flowMC as the data argument of the likelihood. Defaults to None, i.e. self.data.
 
         Returns:
             Float: The log-likelihood value at this point.
         """
+        if data is None:
+            data = self.data
         
-        theta = {**theta, **self.fixed_params}
+        theta = {**theta, **data["fixed_params"]}
         theta = self.conversion(theta)
-        times, mag_app = self.model.predict(theta)
+        mag_est, sigma = self.get_mag_est(theta, data)
+        
+        normalization = 0.
+        if self.surrogate_uncertainty:
+            # the Gaussian normalization now depends on theta (the truncated Gaussian is normalized already)
+            normalization = jnp.where(data["is_det"] & (data["lim"] == jnp.inf), -jnp.log(sigma / data["sigma"]), 0.)
+        
+        with jax.named_scope("log_prob"):
+            if self.offset_names:
+                return self.marginalize_offsets(mag_est, sigma, data) + jnp.sum(jnp.where(data["is_valid"], normalization, 0.))
+            
+            log_prob = self.get_log_prob(mag_est, sigma, data)
+            return jnp.sum(jnp.where(data["is_valid"], log_prob + normalization, 0.))
+    
+    def get_mag_est(self,
+                    theta: dict[str, Array],
+                    data: dict) -> tuple[Float[Array, "n_obs"], Float[Array, "n_obs"]]:
+        """
+        Model magnitudes at the observation times and their uncertainties for converted parameters theta that include the fixed parameters.
+        With surrogate_uncertainty, the magnitudes are the mean of the surrogate and its variance is added to the observational uncertainties.
+
+        Returns:
+            tuple: The estimated magnitudes and the uncertainties sigma of the observations.
+        """
+        if self.surrogate_uncertainty:
+            _, mag_app, mag_var = self.evaluation_model.predict_with_uncertainty(theta, self.latent_key, self.n_latent)
+        else:
+            _, mag_app = self.evaluation_model.predict(theta)
+        
+        # Interpolate the mags of all filters to the observed times with one gather
+        with jax.named_scope("interpolate"):
+            stencils = self.get_stencils(theta.get("redshift"), data)
+            mag_est = self.interpolate(mag_app, *stencils, data["filter_idx"])
+        
+        sigma = data["sigma"]
+        if self.surrogate_uncertainty:
+            # add the surrogate variance to the observational uncertainties
+            sigma = jnp.sqrt(data["sigma"]**2 + self.interpolate(mag_var, *stencils, data["filter_idx"]))
+        return mag_est, sigma
+    
+    def evaluate_batch(self,
+                       theta: dict[str, Float[Array, "n_chains"]],
+                       data: dict = None) -> Float[Array, "n_chains"]:
+        """
+        Evaluate the log-likelihood for a batch of points, e.g. all chains of the sampler, at once.
+        The conversion is applied once to the whole batch and the surrogate is evaluated on the (n_chains, n_params) input matrix. Interpolation and reduction are batch-major on (n_chains, n_obs) arrays.
+
+        Args:
+            theta (dict[str, Float[Array, "n_chains"]]): Parameter arrays with a leading batch axis.
+            data (dict, optional): Observations and fixed parameters as returned by set_data. Defaults to None, i.e. self.data.
+
+        Returns:
+            Float[Array, "n_chains"]: The log-likelihood values.
+        """
+        if data is None:
+            data = self.data
+        if self.surrogate_uncertainty:
+            return jax.vmap(self.evaluate, in_axes=(0, None))(theta, data)
         
-        # Interpolate the mags to the times of interest
-        mag_est_det = jax.tree_util.tree_map(lambda t, m: jnp.interp(t, times, m, left = "extrapolate", right = "extrapolate"), # TODO extrapolation is maybe problematic here
-                                          self.times_det, mag_app)
+        n_chains = len(next(iter(theta.values())))
+        # fixed parameters stay scalars, so that everything that only depends on them is computed once for the batch
+        theta = {**theta, **data["fixed_params"]}
+        theta = self.conversion(theta)
         
-        mag_est_nondet = jax.tree_util.tree_map(lambda t, m: jnp.interp(t, times, m, left = "extrapolate", right = "extrapolate"),
-                                          self.times_nondet, mag_app)
+        model = self.evaluation_model
+        X = jnp.stack([jnp.broadcast_to(theta[name], (n_chains,)) for name in model.parameter_names], axis=1)
+        redshift = theta.get("redshift", 0.)
+        mag_app = model.predict_mag_batch(X, theta["luminosity_distance"], redshift)
         
-        # Get chisq
-        chisq = jax.tree_util.tree_map(self.get_chisq_filt, 
-                             mag_est_det, self.mag_det, self.sigma, self.detection_limit)
-        chisq_flatten, _ = jax.flatten_util.ravel_pytree(chisq)
-        chisq_total = jnp.sum(chisq_flatten)#.astype(jnp.float64)
+        # gather from the flattened (n_filters * n_times) output of each chain
+        with jax.named_scope("interpolate"):
+            n_times = mag_app.shape[-1]
+            mag_app = mag_app.reshape(n_chains, -1)
+            if self.stretched_times:
+                idx, weight = jax.vmap(self.get_stencils, in_axes=(0, None))(redshift, data)
+                flat_idx = data["filter_idx"] * n_times + idx
+                m0 = jnp.take_along_axis(mag_app, flat_idx - 1, axis=1)
+                m1 = jnp.take_along_axis(mag_app, flat_idx, axis=1)
+            else:
+                # the stencils are shared by all chains
+                flat_idx, weight = data["filter_idx"] * n_times + data["stencil_idx"], data["stencil_weight"]
+                m0, m1 = mag_app[:, flat_idx - 1], mag_app[:, flat_idx]
+            mag_est = m0 + weight * (m1 - m0)
         
-        # Get gaussprob:
-        gaussprob = jax.tree_util.tree_map(self.get_gaussprob_filt, 
-                                 mag_est_nondet, self.mag_nondet, self.error_budget)
-        gaussprob_flatten, _ = jax.flatten_util.ravel_pytree(gaussprob)
-        gaussprob_total = jnp.sum(gaussprob_flatten)#.astype(jnp.float64)
+        with jax.named_scope("log_prob"):
+            if self.offset_names:
+                return jax.vmap(self.marginalize_offsets, in_axes=(0, None, None))(mag_est, data["sigma"], data)
+            
+            log_prob = self.get_log_prob(mag_est, data["sigma"], data)
+            return jnp.sum(jnp.where(data["is_valid"], log_prob, 0.), axis=1)
+    
+    def profile(self,
+                theta: dict[str, Array],
+                **kwargs) -> dict:
+        """
+        Time the stages of evaluate separately, compiled and with gradients, see fiesta.inference.profiling.profile_likelihood.
+        """
+        from fiesta.inference.profiling import profile_likelihood
+        return profile_likelihood(self, theta, **kwargs)
+    
+    def interpolate(self, 
+                    mag: dict[str, Float[Array, "n_times"]],
+                    idx: Int[Array, "n_obs"],
+                    weight: Float[Array, "n_obs"],
+                    filter_idx: Int[Array, "n_obs"]) -> Float[Array, "n_obs"]:
+        """
+        Linearly interpolate the model output of all filters to the packed observation times with the stencils from get_stencils, extrapolating linearly beyond the time grid like jnp.interp with left = right = "extrapolate".
+        """
+        mag = jnp.stack([mag[filt] for filt in self.model_filters])
+        m0, m1 = mag[filter_idx, idx - 1], mag[filter_idx, idx]
+        return m0 + weight * (m1 - m0) # TODO extrapolation is maybe problematic here
+    
+    def get_offset_posterior(self,
+                             mag_est: Float[Array, "n_obs"],
+                             sigma: Float[Array, "n_obs"],
+                             data: dict) -> tuple[Float[Array, "n_offsets"], Float[Array, "n_offsets n_offsets"], Float]:
+        """
+        Conditional Gaussian posterior of the offsets given the model magnitudes (without offsets) at the observation times.
+
+        Returns:
+            tuple: Mean and precision matrix of the offsets, and the chi-square of the residuals without offsets.
+        """
+        design = data["offset_design"]
+        weight = jnp.where(data["is_valid"], 1 / sigma**2, 0.)
+        residual = jnp.where(data["is_valid"], data["mag"] - mag_est, 0.)
         
-        return chisq_total + gaussprob_total
+        precision = data["offset_precision"] if "offset_precision" in data else self.get_offset_precision(sigma, data)
+        prior_mean, prior_precision = data["offset_prior_mean"], data["offset_prior_precision"]
+        projection = design.T @ (weight * residual) + prior_precision * prior_mean
+        mean = jnp.linalg.solve(precision, projection)
+        chisq = jnp.sum(weight * residual**2) + jnp.sum(prior_precision * prior_mean**2)
+        return mean, precision, chisq - projection @ mean
     
-    ### LIKELIHOOD FUNCTIONS ###
+    def marginalize_offsets(self,
+                            mag_est: Float[Array, "n_obs"],
+                            sigma: Float[Array, "n_obs"],
+                            data: dict) -> Float:
+        """
+        Log-likelihood of the detections marginalized over the offsets, up to a constant that does not depend on theta (like compute_chisq).
+        With the design matrix A of the offsets, weights W = diag(1/sigma^2), residuals r and prior mean m and precision P of the offsets, the precision of the offset posterior is F = A^T W A + P and
+        log L = -1/2 [r^T W r + m^T P m - b^T F^-1 b] - 1/2 log det F, with b = A^T W r + P m.
+        """
+        _, precision, chisq = self.get_offset_posterior(mag_est, sigma, data)
+        return -0.5 * chisq - 0.5 * jnp.linalg.slogdet(precision)[1]
     
-    def get_chisq_filt(self,
-                       mag_est: Array,
-                       mag_det: Array,
-                       sigma: Array,
-                       lim: Float) -> Float:
+    def sample_offsets(self,
+                       samples: dict[str, Float[Array, "..."]],
+                       key: jax.random.PRNGKey = None) -> dict[str, Float[Array, "..."]]:
         """
-        Return the log likelihood of the chisquare part of the likelihood function for a single filter.
-        Branch-off of jax.lax.cond is based on provided detection limit (lim). If the limit is infinite, the likelihood is calculated without truncation and without resorting to scipy for faster evaluation. If the limit is finite, the likelihood is calculated with truncation and with scipy. 
-        TODO: can we circumvent using scipy and implement this ourselves to speed up?
+        Draw the marginalized offsets from their conditional posterior for every posterior sample, e.g. from fiesta.inference.fiesta.Fiesta.get_samples.
+        Together, the samples and offsets are samples of the joint posterior.
 
         Args:
-            mag_est (Array): The estimated apparent magnitudes at the detection times
-            mag_det (Array): The detected apparent magnitudes
-            sigma (Array): The uncertainties on the detected apparent magnitudes, including the error budget.
-            lim (Float): The detection limit for this filter
+            samples (dict[str, Float[Array, "..."]]): Posterior samples of the sampled parameters, with any shape.
+            key (jax.random.PRNGKey): Random key. Defaults to None, i.e. the mean of the conditional posterior instead of a draw, e.g. for a best fit.
 
         Returns:
-            Float: The chi-square value for this filter
+            dict[str, Float[Array, "..."]]: Samples of the offsets with the same shape as the posterior samples. If the distance modulus is marginalized, the luminosity distance in Mpc is added.
         """
+        if not self.offset_names:
+            raise ValueError("No offsets are marginalized in this likelihood.")
+        
+        shape = jnp.shape(next(iter(samples.values())))
+        theta = {name: jnp.reshape(jnp.asarray(value), -1) for name, value in samples.items()}
+        n_samples = len(next(iter(theta.values())))
+        
+        def get_posterior(theta):
+            theta = self.conversion({**theta, **self.data["fixed_params"]})
+            mag_est, sigma = self.get_mag_est(theta, self.data)
+            mean, precision, _ = self.get_offset_posterior(mag_est, sigma, self.data)
+            return mean, precision
+        
+        mean, precision = jax.lax.map(get_posterior, theta)
+        offsets = mean
+        if key is not None:
+            noise = jax.random.normal(key, (n_samples, len(self.offset_names)))
+            # x = mean + L^-T z has covariance (L L^T)^-1 for the Cholesky factor L of the precision
+            cholesky = jnp.linalg.cholesky(precision)
+            offsets = mean + jax.vmap(lambda L, z: jax.scipy.linalg.solve_triangular(L.T, z, lower=False))(cholesky, noise)
         
-        return jax.lax.cond(lim == jnp.inf,
-                           lambda x: self.compute_chisq(*x),
-                           lambda x: self.compute_chisq_trunc(*x),
-                           (mag_est, mag_det, sigma, lim))
+        offsets = {name: offsets[:, j].reshape(shape) for j, name in enumerate(self.offset_names)}
+        if "distance_modulus" in offsets:
+            offsets["luminosity_distance"] = 10**(offsets["distance_modulus"] / 5 + 1) / 1e6
+        return offsets
+    
+    ### LIKELIHOOD FUNCTIONS ###
+    
+    def get_log_prob(self,
+                     mag_est: Float[Array, "... n_obs"],
+                     sigma: Float[Array, "... n_obs"],
+                     data: dict) -> Float[Array, "... n_obs"]:
+        """
+        Return the log likelihood of each observation. Only the terms that are present in the data are built, see set_likelihood_terms.
+        """
+        log_prob = self.compute_chisq(mag_est, data["mag"], sigma)
+        if self.has_truncation:
+            # finite placeholder limit, so that the unused branch does not produce nan gradients
+            lim = jnp.where(data["lim"] == jnp.inf, data["mag"] + 100 * sigma, data["lim"])
+            log_prob = jnp.where(data["lim"] == jnp.inf, log_prob, self.compute_chisq_trunc(mag_est, data["mag"], sigma, lim))
+        if self.has_nondetections:
+            log_prob = jnp.where(data["is_det"], log_prob, self.compute_gaussprob(mag_est, data["mag"], sigma))
+        return log_prob
     
     @staticmethod
     def compute_chisq(mag_est: Array,
                       mag_det: Array,
-                      sigma: Array,
-                      lim: Float) -> Float:
+                      sigma: Array) -> Array:
         """
-        Return the log likelihood of the chisquare part of the likelihood function, without truncation (no detection limit is given), i.e. a Gaussian pdf. See get_chisq_filt for more details.
+        Return the log likelihood of the chisquare part of the likelihood function for each detection, without truncation (no detection limit is given), i.e. a Gaussian pdf without normalization.
+
+        Args:
+            mag_est (Array): The estimated apparent magnitudes at the detection times
+            mag_det (Array): The detected apparent magnitudes
+            sigma (Array): The uncertainties on the detected apparent magnitudes, including the error budget.
+
+        Returns:
+            Array: The chi-square value of each detection
         """
-        val = - 0.5 * jnp.sum(
-            (mag_det - mag_est) ** 2 / sigma ** 2
-        )
-        return val
+        return - 0.5 * (mag_det - mag_est) ** 2 / sigma ** 2
     
     @staticmethod
     def compute_chisq_trunc(mag_est: Array,
                             mag_det: Array,
                             sigma: Array,
-                            lim: Float) -> Float:
+                            lim: Array) -> Array:
         """
-        Return the log likelihood of the chisquare part of the likelihood function, with truncation of the Gaussian (detection limit is given). See get_chisq_filt for more details.
+        Return the log likelihood of the chisquare part of the likelihood function for each detection, with truncation of the Gaussian at the detection limit (lim). See compute_chisq for more details.
         """
-        return jnp.sum(truncated_gaussian(mag_det, sigma, mag_est, lim))
-        
-    def get_gaussprob_filt(self,
-                           mag_est: Array,
-                           mag_nondet: Array,
-                           error_budget: Float) -> Float:
-        
-        return jax.lax.cond(len(mag_est) == 0,
-                           lambda x: 0.0,
-                           lambda x: self.compute_gaussprob(*x),
-                           (mag_est, mag_nondet, error_budget))
+        return truncated_gaussian(mag_det, sigma, mag_est, lim)
         
     @staticmethod
     def compute_gaussprob(mag_est: Array,
                           mag_nondet: Array,
-                          error_budget: Float) -> Float:
-        gausslogsf = jax.scipy.stats.norm.logsf(
-                    mag_nondet, mag_est, error_budget
-                    )
-        return jnp.sum(gausslogsf)
\ No newline at end of file
+                          error_budget: Array) -> Array:
+        """
+        Return the log probability of each non-detection, i.e. that the source was fainter than the reported magnitude.
+        """
+        return jax.scipy.stats.norm.logsf(mag_nondet, mag_est, error_budget)
+
+
+class MultiEventLikelihood:
+    """
+    Log-likelihood of several independent events that are fitted with the same surrogate model and likelihood settings, e.g. in population runs.
+    The padded data of the events are stacked along a leading event axis and all events are evaluated in one vmapped call of the likelihood of the first event, see EMLikelihood.set_data.
+    The parameters of the events are independent, so the log-likelihood is the sum over the events.
+    """
+    
+    likelihoods: list[EMLikelihood]
+    n_events: int
+    data: dict[str, Array]
+    
+    def __init__(self, likelihoods: list[EMLikelihood]):
+        """
+        Args:
+            likelihoods (list[EMLikelihood]): Likelihoods of the single events. They need to share the same model instance, conversion function, and fixed parameter names, and must not use an output subset.
+                They are not changed, the settings and padded data of all events are set on shallow copies.
+        """
+        self.likelihoods = [copy.copy(likelihood) for likelihood in likelihoods]
+        self.n_events = len(likelihoods)
+        
+        reference = self.likelihoods[0]
+        for likelihood in self.likelihoods[1:]:
+            if likelihood.evaluation_model is not reference.evaluation_model:
+                raise ValueError("All events need to be evaluated with the same model instance, without output subset.")
+            if likelihood.conversion is not reference.conversion:
+                raise ValueError("All events need to use the same conversion function.")
+            if set(likelihood.fixed_params) != set(reference.fixed_params):
+                raise ValueError("All events need to fix the same parameters, their values can differ.")
+            if (likelihood.stretched_times, likelihood.surrogate_uncertainty, likelihood.offset_names) != (reference.stretched_times, reference.surrogate_uncertainty, reference.offset_names):
+                raise ValueError("All events need to use the same likelihood settings.")
+        
+        # the likelihood of the first event evaluates all events, so it needs the terms of all of them
+        reference.has_truncation = any([likelihood.has_truncation for likelihood in self.likelihoods])
+        reference.has_nondetections = any([likelihood.has_nondetections for likelihood in self.likelihoods])
+        
+        # pad all events to the same length and stack them
+        n_data = max([len(likelihood.data["mag"]) for likelihood in self.likelihoods])
+        for likelihood in self.likelihoods:
+            likelihood.set_data(n_data)
+        self.data = jax.tree.map(lambda *x: jnp.stack(x), *[likelihood.data for likelihood in self.likelihoods])
+    
+    @property
+    def model(self):
+        return self.likelihoods[0].model
+    
+    def __call__(self, theta):
+        return self.evaluate(theta)
+    
+    def evaluate(self,
+                 theta: dict[str, Float[Array, "n_events"]],
+                 data: dict = None) -> Float:
+        """
+        Evaluate the summed log-likelihood of all events.
+
+        Args:
+            theta (dict[str, Float[Array, "n_events"]]): Parameters of the events, stacked along the event axis.
+            data (dict, optional): Stacked data of the events. Defaults to None, i.e. self.data.
+
+        Returns:
+            Float: The summed log-likelihood value.
+        """
+        return jnp.sum(self.evaluate_events(theta, data))
+    
+    def evaluate_events(self,
+                        theta: dict[str, Float[Array, "n_events"]],
+                        data: dict = None) -> Float[Array, "n_events"]:
+        """
+        Evaluate the log-likelihood of every event in one vmapped call.
+        """
+        if data is None:
+            data = self.data
+        return jax.vmap(self.likelihoods[0].evaluate)(theta, data)
@@ -0,0 +1,166 @@
+"""Local samplers of flowMC whose step size is passed with the data, and the adaptation of their mass matrix and step size during the training loops."""
+
+from typing import Callable
+
+import jax
+import jax.numpy as jnp
+from jax.scipy.stats import multivariate_normal
+from jaxtyping import Array, Float, Int, PRNGKeyArray, PyTree
+
+from flowMC.sampler.MALA import MALA
+from flowMC.sampler.Gaussian_random_walk import GaussianRandomWalk
+
+# asymptotically optimal acceptance rates for Gaussian targets
+TARGET_ACCEPTANCE = {"MALA": 0.574, "GaussianRandomWalk": 0.234}
+
+
+################
+### SAMPLERS ###
+################
+
+class AdaptiveMALA(MALA):
+    """
+    MALA that reads the step size matrix dt from data["local_sampler"]["step_size"] instead of self.params.
+    The kernels of flowMC are compiled with the parameters of the sampler as constants, so the step size can only be changed without recompilation if it is an argument.
+    The proposal is x + C grad / 2 + dt xi with xi ~ N(0, I) and C = dt dt^T, which also holds for dense dt.
+    The logpdf receives the full data, i.e. it has to select data["likelihood"] itself.
+    """
+
+    def body(self, carry, this_key):
+        this_position, dt, data = carry
+        cov = dt @ dt.T
+        this_log_prob, this_d_log = jax.value_and_grad(self.logpdf)(this_position, data)
+        proposal = this_position + jnp.dot(cov, this_d_log) / 2
+        proposal += jnp.dot(dt, jax.random.normal(this_key, shape=this_position.shape))
+        return (proposal, dt, data), (proposal, this_log_prob, this_d_log)
+
+    def kernel(self,
+               rng_key: PRNGKeyArray,
+               position: Float[Array, "ndim"],
+               log_prob: Float[Array, "1"],
+               data: PyTree) -> tuple[Float[Array, "ndim"], Float[Array, "1"], Int[Array, "1"]]:
+        key1, key2 = jax.random.split(rng_key)
+
+        dt = data["local_sampler"]["step_size"]
+        cov = dt @ dt.T
+
+        _, (proposal, logprob, d_logprob) = jax.lax.scan(self.body, (position, dt, data), jnp.array([key1, key1]))
+
+        ratio = logprob[1] - logprob[0]
+        ratio -= multivariate_normal.logpdf(proposal[0], position + jnp.dot(cov, d_logprob[0]) / 2, cov)
+        ratio += multivariate_normal.logpdf(position, proposal[0] + jnp.dot(cov, d_logprob[1]) / 2, cov)
+
+        log_uniform = jnp.log(jax.random.uniform(key2))
+        do_accept = log_uniform < ratio
+
+        position = jnp.where(do_accept, proposal[0], position)
+        log_prob = jnp.where(do_accept, logprob[1], logprob[0])
+        return position, log_prob, do_accept
+
+class AdaptiveGaussianRandomWalk(GaussianRandomWalk):
+    """
+    Gaussian random walk with the proposal x + dt xi, xi ~ N(0, I), where the step size matrix dt is read from data["local_sampler"]["step_size"], see AdaptiveMALA.
+    """
+
+    def kernel(self,
+               rng_key: PRNGKeyArray,
+               position: Float[Array, "ndim"],
+               log_prob: Float[Array, "1"],
+               data: PyTree) -> tuple[Float[Array, "ndim"], Float[Array, "1"], Int[Array, "1"]]:
+        key1, key2 = jax.random.split(rng_key)
+        proposal = position + jnp.dot(data["local_sampler"]["step_size"], jax.random.normal(key1, shape=position.shape))
+        proposal_log_prob = self.logpdf(proposal, data)
+
+        log_uniform = jnp.log(jax.random.uniform(key2))
+        do_accept = log_uniform < proposal_log_prob - log_prob
+
+        position = jnp.where(do_accept, proposal, position)
+        log_prob = jnp.where(do_accept, proposal_log_prob, log_prob)
+        return position, log_prob, do_accept
+
+##################
+### ADAPTATION ###
+##################
+
+def as_step_matrix(step_size: float | Array, n_dim: int) -> Float[Array, "n_dim n_dim"]:
+    """Convert a scalar, a vector of per-dimension step sizes or a matrix to a step size matrix."""
+    step_size = jnp.asarray(step_size, dtype=float)
+    if step_size.ndim == 0:
+        return step_size * jnp.eye(n_dim)
+    if step_size.ndim == 1:
+        return jnp.diag(step_size)
+    return step_size
+
+def default_step_scale(which_local_sampler: str, n_dim: int) -> float:
+    """Optimal scale of the step for a Gaussian target whose covariance is the mass matrix, used as starting point of the tuning."""
+    if which_local_sampler == "MALA":
+        return 1.65 * n_dim**(-1/6)
+    return 2.38 * n_dim**(-1/2)
+
+def estimate_mass_matrix(samples: Float[Array, "n_chains n_steps n_dim"],
+                         dense: bool = False,
+                         regularization: float = 1e-6) -> Float[Array, "n_dim n_dim"]:
+    """
+    Cholesky factor of the covariance of the samples of all chains, which is used as the (inverse) mass matrix of the local sampler.
+    For a diagonal mass matrix, the factor contains the standard deviations. The dense covariance is shrunk towards its diagonal for small sample sizes.
+
+    Args:
+        samples (Float[Array, "n_chains n_steps n_dim"]): Samples of the chains.
+        dense (bool): Whether to estimate the full covariance. Defaults to False.
+        regularization (float): Variance added relative to the mean variance, keeps the factor positive definite if the chains did not move. Defaults to 1e-6.
+
+    Returns:
+        Float[Array, "n_dim n_dim"]: Lower triangular Cholesky factor of the covariance.
+    """
+    samples = samples.reshape(-1, samples.shape[-1])
+    n_samples, n_dim = samples.shape
+    var = jnp.var(samples, axis=0)
+    jitter = regularization * jnp.maximum(jnp.mean(var), jnp.finfo(samples.dtype).tiny)
+    if not dense:
+        return jnp.diag(jnp.sqrt(var + jitter))
+
+    cov = jnp.cov(samples.T).reshape(n_dim, n_dim)
+    weight = n_samples / (n_samples + 5.)
+    cov = weight * cov + (1 - weight) * jnp.diag(var)
+    return jnp.linalg.cholesky(cov + jitter * jnp.eye(n_dim))
+
+def tune_step_scale(kernel_vmap: Callable,
+                    rng_keys: PRNGKeyArray,
+                    positions: Float[Array, "n_chains n_dim"],
+                    log_prob: Float[Array, "n_chains"],
+                    data: dict,
+                    cholesky: Float[Array, "n_dim n_dim"],
+                    step_scale: float,
+                    target_acceptance: float,
+                    max_iter: int = 30,
+                    tolerance: float = 0.05) -> tuple[float, PRNGKeyArray]:
+    """
+    Tune the scale eps of the step size matrix eps * cholesky towards a target acceptance rate, starting from step_scale.
+    Every iteration proposes one step for all chains with the vmapped kernel and moves log(eps) by the difference between the acceptance rate of the chains and the target, with a decaying gain.
+    The chains are not moved, so only the step size is adapted.
+
+    Args:
+        kernel_vmap (Callable): Vmapped kernel of an AdaptiveMALA or AdaptiveGaussianRandomWalk.
+        rng_keys (PRNGKeyArray): Random keys of the chains.
+        positions (Float[Array, "n_chains n_dim"]): Positions of the chains.
+        log_prob (Float[Array, "n_chains"]): Log-probability of the positions.
+        data (dict): Data of the sampler, the step size is replaced in data["local_sampler"].
+        cholesky (Float[Array, "n_dim n_dim"]): Cholesky factor of the mass matrix.
+        step_scale (float): Initial scale.
+        target_acceptance (float): Target acceptance rate.
+        max_iter (int): Maximal number of iterations. Defaults to 30.
+        tolerance (float): The tuning stops once the acceptance rate is within tolerance of the target. Defaults to 0.05.
+
+    Returns:
+        tuple[float, PRNGKeyArray]: Tuned scale and the advanced random keys.
+    """
+    log_scale = jnp.log(step_scale)
+    for i in range(max_iter):
+        rng_keys, tune_keys = jnp.moveaxis(jax.vmap(jax.random.split)(rng_keys), 1, 0)
+        step_data = {**data, "local_sampler": {"step_size": jnp.exp(log_scale) * cholesky}}
+        _, _, do_accept = kernel_vmap(tune_keys, positions, log_prob, step_data)
+        acceptance = jnp.mean(do_accept)
+        if jnp.abs(acceptance - target_acceptance) < tolerance:
+            break
+        log_scale += 3. * (acceptance - target_acceptance) / jnp.sqrt(i + 1.)
+    return float(jnp.exp(log_scale)), rng_keys
@@ -0,0 +1,163 @@
+"""Batched multi-start maximization of a log-probability, used to initialize the chains of the sampler close to the modes of the posterior."""
+
+from functools import partial
+import time
+from typing import Callable
+
+import jax
+import jax.numpy as jnp
+import optax
+from jaxtyping import Array, Float, PRNGKeyArray, PyTree
+
+
+def evolution_strategy(log_prob_batch: Callable,
+                       x: Float[Array, "n_walkers n_dim"],
+                       sigma: Float[Array, "n_walkers n_dim"],
+                       key: PRNGKeyArray,
+                       n_loops: int = 100,
+                       n_offspring: int = 16) -> tuple[Float[Array, "n_walkers n_dim"], Float[Array, "n_walkers"], Float[Array, "n_walkers n_dim"]]:
+    """
+    Independent (1+lambda) evolution strategies for all walkers, evaluated in one batched call per generation.
+    Every walker draws n_offspring Gaussian perturbations and moves to the best of them if it improves the log-probability. The step size of a walker grows after a success and shrinks otherwise.
+
+    Args:
+        log_prob_batch (Callable): Log-probability of a batch of points with shape (n, n_dim).
+        x (Float[Array, "n_walkers n_dim"]): Starting points.
+        sigma (Float[Array, "n_walkers n_dim"]): Initial step sizes per walker and dimension.
+        key (PRNGKeyArray): Random key.
+        n_loops (int): Number of generations. Defaults to 100.
+        n_offspring (int): Number of perturbations per walker and generation. Defaults to 16.
+
+    Returns:
+        tuple: Best points, their log-probabilities and the final step sizes.
+    """
+    n_walkers, n_dim = x.shape
+    log_prob = jnp.nan_to_num(log_prob_batch(x), nan=-jnp.inf)
+
+    def step(carry, key):
+        x, log_prob, sigma = carry
+        candidates = x + sigma * jax.random.normal(key, (n_offspring, n_walkers, n_dim))
+        candidate_log_prob = log_prob_batch(candidates.reshape(-1, n_dim)).reshape(n_offspring, n_walkers)
+        candidate_log_prob = jnp.nan_to_num(candidate_log_prob, nan=-jnp.inf)
+
+        best = jnp.argmax(candidate_log_prob, axis=0)
+        best_log_prob = candidate_log_prob[best, jnp.arange(n_walkers)]
+        success = best_log_prob > log_prob
+        x = jnp.where(success[:, None], candidates[best, jnp.arange(n_walkers)], x)
+        log_prob = jnp.where(success, best_log_prob, log_prob)
+        sigma = sigma * jnp.where(success, 1.5, 0.9)[:, None]
+        return (x, log_prob, sigma), None
+
+    (x, log_prob, sigma), _ = jax.lax.scan(step, (x, log_prob, sigma), jax.random.split(key, n_loops))
+    return x, log_prob, sigma
+
+def adam_refinement(log_prob_batch: Callable,
+                    x: Float[Array, "n_walkers n_dim"],
+                    scale: Float[Array, "n_dim"],
+                    n_steps: int = 100,
+                    learning_rate: float = 1e-2) -> tuple[Float[Array, "n_walkers n_dim"], Float[Array, "n_walkers"]]:
+    """
+    Refine the points of all walkers with Adam on the gradient of the log-probability. The steps are scaled per dimension with scale, and the best point seen by each walker is returned, so steps into regions with a non-finite log-probability are discarded.
+
+    Args:
+        log_prob_batch (Callable): Log-probability of a batch of points with shape (n, n_dim).
+        x (Float[Array, "n_walkers n_dim"]): Starting points.
+        scale (Float[Array, "n_dim"]): Typical scale of each dimension, e.g. the prior width.
+        n_steps (int): Number of Adam steps. Defaults to 100.
+        learning_rate (float): Learning rate in units of scale. Defaults to 1e-2.
+
+    Returns:
+        tuple: Best points and their log-probabilities.
+    """
+    # the walkers are independent, so the gradient of the sum is the gradient of each walker
+    value_and_grad = jax.value_and_grad(lambda x: jnp.sum(log_prob_batch(x)))
+    tx = optax.adam(learning_rate)
+
+    def step(carry, _):
+        x, opt_state, best_x, best_log_prob = carry
+        _, grad = value_and_grad(x)
+        grad = jnp.where(jnp.isfinite(grad), grad, 0.)
+        updates, opt_state = tx.update(-grad, opt_state)
+        x = x + scale * updates
+
+        log_prob = jnp.nan_to_num(log_prob_batch(x), nan=-jnp.inf)
+        improved = log_prob > best_log_prob
+        best_x = jnp.where(improved[:, None], x, best_x)
+        best_log_prob = jnp.where(improved, log_prob, best_log_prob)
+        # walkers that left the support restart from their best point
+        x = jnp.where(jnp.isfinite(log_prob)[:, None], x, best_x)
+        return (x, opt_state, best_x, best_log_prob), None
+
+    log_prob = jnp.nan_to_num(log_prob_batch(x), nan=-jnp.inf)
+    (_, _, x, log_prob), _ = jax.lax.scan(step, (x, tx.init(x), x, log_prob), None, length=n_steps)
+    return x, log_prob
+
+@partial(jax.jit, static_argnums=(0, 4, 5, 6, 7))
+def multi_start_maximization(log_prob_batch: Callable,
+                             x: Float[Array, "n_walkers n_dim"],
+                             key: PRNGKeyArray,
+                             data: PyTree,
+                             n_loops: int = 100,
+                             n_offspring: int = 16,
+                             n_steps_adam: int = 100,
+                             learning_rate: float = 1e-2) -> tuple[Float[Array, "n_walkers n_dim"], Float[Array, "n_walkers"], Float[Array, "n_walkers n_dim"]]:
+    """
+    Maximize the log-probability from every starting point with an evolution strategy followed by Adam, compiled as a single function.
+    The initial step sizes of the evolution strategy and the scales of Adam are set from the spread of the starting points, e.g. draws from the prior.
+    log_prob_batch is a static argument and data a traced one, so the function is compiled once per log_prob_batch (e.g. a bound method of Fiesta) and reused for new data.
+
+    Returns:
+        tuple: Best points, their log-probabilities and the final step sizes of the evolution strategy.
+    """
+    log_prob_batch = partial(log_prob_batch, data=data)
+    scale = jnp.std(x, axis=0) + 1e-8
+    sigma = jnp.broadcast_to(0.1 * scale, x.shape)
+    x, log_prob, sigma = evolution_strategy(log_prob_batch, x, sigma, key, n_loops, n_offspring)
+    if n_steps_adam > 0:
+        x, log_prob = adam_refinement(log_prob_batch, x, scale, n_steps_adam, learning_rate)
+    return x, log_prob, sigma
+
+def initialize_chains(x: Float[Array, "n_walkers n_dim"],
+                      log_prob: Float[Array, "n_walkers"],
+                      sigma: Float[Array, "n_walkers n_dim"],
+                      n_chains: int,
+                      key: PRNGKeyArray,
+                      log_prob_batch: Callable,
+                      jitter: float = 0.1) -> Float[Array, "n_chains n_dim"]:
+    """
+    Place the chains around the best points: the chains are distributed over the min(n_chains, n_walkers) walkers with the highest log-probability and scattered by a fraction jitter of the final step sizes of the evolution strategy. Chains that land outside the support stay at the point of their walker.
+    """
+    n_modes = min(n_chains, len(log_prob))
+    idx = jnp.argsort(-log_prob)[jnp.arange(n_chains) % n_modes]
+    positions = x[idx] + jitter * sigma[idx] * jax.random.normal(key, (n_chains, x.shape[1]))
+    valid = jnp.isfinite(log_prob_batch(positions))
+    return jnp.where(valid[:, None], positions, x[idx])
+
+def maximize_and_initialize(log_prob_batch: Callable,
+                            x: Float[Array, "n_walkers n_dim"],
+                            key: PRNGKeyArray,
+                            data: PyTree,
+                            n_chains: int,
+                            n_loops: int = 100,
+                            n_offspring: int = 16,
+                            n_steps_adam: int = 100,
+                            learning_rate: float = 1e-2) -> tuple[Float[Array, "n_chains n_dim"], dict]:
+    """
+    Run multi_start_maximization from the starting points x and initialize n_chains chains around the best points found.
+    log_prob_batch(x, data) is the log-probability of a batch of points, it should be created once and not as a new closure per call, which would be compiled again.
+
+    Returns:
+        tuple: Initial positions of the chains and a report with the run time, the number of log-probability evaluations (gradients count as one) and the best log-probability.
+    """
+    key_es, key_init = jax.random.split(key)
+    start = time.perf_counter()
+    x, log_prob, sigma = multi_start_maximization(log_prob_batch, x, key_es, data, n_loops, n_offspring, n_steps_adam, learning_rate)
+    positions = initialize_chains(x, log_prob, sigma, n_chains, key_init, partial(log_prob_batch, data=data))
+    positions.block_until_ready()
+
+    n_walkers = x.shape[0]
+    report = {"time": time.perf_counter() - start,
+              "n_evaluations": n_walkers * (1 + n_loops * n_offspring + (2 * n_steps_adam + 1 if n_steps_adam > 0 else 0)) + n_chains,
+              "best_log_prob": float(jnp.max(log_prob)),
+              "best_position": x[jnp.argmax(log_prob)]}
+    return positions, report
@@ -0,0 +1,114 @@
+"""HDF5 file to which the production samples of a sampler are appended after every loop, so that the memory of a run stays bounded."""
+
+import h5py
+import numpy as np
+
+
+class PosteriorFile:
+    """
+    Chunked, compressed and resizable datasets of shape (n_chains, n_steps, ...) that grow along the step axis.
+    The file is only opened for reading and writing, such that it can be inspected while the sampler is running.
+    """
+
+    keys = ["chains", "log_prob", "local_accs", "global_accs"]
+
+    def __init__(self,
+                 filename: str,
+                 n_chains: int,
+                 n_dim: int,
+                 parameter_names: list[str] = None,
+                 thinning: int = 1,
+                 chunk_steps: int = 100,
+                 compression: str = "gzip",
+                 dtype: np.dtype = np.float64,
+                 overwrite: bool = True):
+        """
+        Args:
+            filename (str): Name of the HDF5 file.
+            n_chains (int): Number of chains.
+            n_dim (int): Dimension of the sampled vector.
+            parameter_names (list[str]): Names of the sampled parameters, stored as attribute. Defaults to None.
+            thinning (int): Only every thinning-th step is stored, counted over the whole run. Defaults to 1.
+            chunk_steps (int): Number of steps per HDF5 chunk. Defaults to 100.
+            compression (str): HDF5 compression filter. Defaults to 'gzip'.
+            dtype (np.dtype): Data type of the chains and the log-probability, should be the one of the sampler. The acceptances are stored as float32. Defaults to np.float64.
+            overwrite (bool): Whether to create a new file. Otherwise, an existing file is appended to. Defaults to True.
+        """
+        self.filename = filename
+        self.n_chains = n_chains
+        self.n_dim = n_dim
+        self.thinning = thinning
+
+        if not overwrite:
+            with h5py.File(self.filename, "r") as f:
+                if f["chains"].shape[::2] != (n_chains, n_dim):
+                    raise ValueError(f"The samples in {self.filename} have a different number of chains or dimensions.")
+            return
+
+        with h5py.File(self.filename, "w") as f:
+            f.attrs["thinning"] = thinning
+            if parameter_names is not None:
+                f.attrs["parameter_names"] = list(parameter_names)
+            for key in self.keys:
+                shape = (n_chains, 0, n_dim) if key == "chains" else (n_chains, 0)
+                chunks = (n_chains, chunk_steps, n_dim) if key == "chains" else (n_chains, chunk_steps)
+                dataset = f.create_dataset(key, shape=shape, maxshape=(n_chains, None, *shape[2:]), chunks=chunks, dtype=dtype if key in ["chains", "log_prob"] else np.float32, compression=compression)
+                dataset.attrs["n_seen"] = 0 # number of steps before thinning
+
+    def append(self, state: dict) -> None:
+        """
+        Append the steps of a sampler state (a dict of arrays as returned by flowMC's Sampler.get_sampler_state) to the file.
+        """
+        with h5py.File(self.filename, "a") as f:
+            for key in self.keys:
+                values = np.asarray(state[key])
+                dataset = f[key]
+                n_seen = int(dataset.attrs["n_seen"])
+                # keep the thinning consistent across loops
+                values = values[:, -n_seen % self.thinning::self.thinning]
+                dataset.resize(dataset.shape[1] + values.shape[1], axis=1)
+                dataset[:, dataset.shape[1] - values.shape[1]:] = values
+                dataset.attrs["n_seen"] = n_seen + np.asarray(state[key]).shape[1]
+
+    def get_state(self) -> dict:
+        """Lengths of the datasets, e.g. to be stored in a checkpoint."""
+        with h5py.File(self.filename, "r") as f:
+            return {key: (f[key].shape[1], int(f[key].attrs["n_seen"])) for key in self.keys}
+
+    def set_state(self, state: dict) -> None:
+        """Truncate the datasets to a state from get_state, removing the steps that were written afterwards."""
+        with h5py.File(self.filename, "a") as f:
+            for key, (n_steps, n_seen) in state.items():
+                f[key].resize(n_steps, axis=1)
+                f[key].attrs["n_seen"] = n_seen
+
+    def n_steps(self, key: str = "chains") -> int:
+        with h5py.File(self.filename, "r") as f:
+            return f[key].shape[1]
+
+    def read(self, key: str, steps: slice = slice(None)) -> np.ndarray:
+        """Read a dataset, or a slice of its steps."""
+        with h5py.File(self.filename, "r") as f:
+            return f[key][:, steps]
+
+    def read_points(self, key: str, chain_idx: np.ndarray, step_idx: np.ndarray, chunk_steps: int = 1_000) -> np.ndarray:
+        """
+        Read single steps of single chains, e.g. a random subset of the samples. 
+        The points are gathered from blocks of chunk_steps steps, so that many points are read with few accesses to the file, and blocks without points are skipped.
+        """
+        chain_idx, step_idx = np.asarray(chain_idx), np.asarray(step_idx)
+        with h5py.File(self.filename, "r") as f:
+            dataset = f[key]
+            points = np.empty((len(chain_idx), *dataset.shape[2:]), dtype=dataset.dtype)
+            for start in range(0, dataset.shape[1], chunk_steps):
+                in_block = (step_idx >= start) & (step_idx < start + chunk_steps)
+                if np.any(in_block):
+                    block = dataset[:, start:start + chunk_steps]
+                    points[in_block] = block[chain_idx[in_block], step_idx[in_block] - start]
+        return points
+
+    def iter_chunks(self, key: str, chunk_steps: int = 1_000):
+        """Iterate over the dataset in blocks of chunk_steps steps, so that it never has to be loaded as a whole."""
+        n_steps = self.n_steps(key)
+        for start in range(0, n_steps, chunk_steps):
+            yield self.read(key, slice(start, start + chunk_steps))
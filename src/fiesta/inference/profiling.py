@@ -0,0 +1,196 @@
+"""Per-stage profiling of the surrogate prediction and the likelihood evaluation, to see where the time of a fit goes."""
+
+import contextlib
+import json
+import time
+
+import jax
+import jax.numpy as jnp
+from jaxtyping import Array
+
+from fiesta.inference.lightcurve_model import SurrogateModel
+
+
+#################
+### UTILITIES ###
+#################
+
+def sum_outputs(output) -> Array:
+    """Sum of all floating point leaves of the output of a stage, used as scalar to time the gradient."""
+    leaves = [jnp.sum(leaf) for leaf in jax.tree.leaves(output) if jnp.issubdtype(jnp.result_type(leaf), jnp.inexact)]
+    return sum(leaves)
+
+def get_cost(compiled) -> dict:
+    """FLOPs, accessed bytes and memory of a compiled function as estimated by XLA. Entries that the backend does not provide are None."""
+    cost = compiled.cost_analysis()
+    if isinstance(cost, (list, tuple)):
+        cost = cost[0] if len(cost) > 0 else None
+    cost = cost or {}
+
+    memory = compiled.memory_analysis()
+    get_memory = lambda name: getattr(memory, name, None) if memory is not None else None
+    return {"flops": cost.get("flops"),
+            "bytes_accessed": cost.get("bytes accessed"),
+            "argument_bytes": get_memory("argument_size_in_bytes"),
+            "output_bytes": get_memory("output_size_in_bytes"),
+            "temp_bytes": get_memory("temp_size_in_bytes")}
+
+def time_compiled(func: callable, arg, n_repeat: int) -> float:
+    """Mean wall time of a compiled function in seconds, after one warm up call."""
+    jax.block_until_ready(func(arg))
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        jax.block_until_ready(func(arg))
+    return (time.perf_counter() - start) / n_repeat
+
+def profile_stage(func: callable,
+                  arg,
+                  n_repeat: int = 100,
+                  gradient: bool = True) -> dict:
+    """
+    Compile a single stage and measure its compile time, run time, FLOPs and memory, and the run time of its gradient with respect to the input.
+
+    Args:
+        func (callable): Stage as a function of a single (pytree) argument.
+        arg: Input of the stage.
+        n_repeat (int): Number of timed calls. Defaults to 100.
+        gradient (bool): Whether to also time the gradient of the summed output. Defaults to True.
+
+    Returns:
+        dict: Measurements of the stage, times in seconds.
+    """
+    start = time.perf_counter()
+    compiled = jax.jit(func).lower(arg).compile()
+    result = {"compile_time": time.perf_counter() - start,
+              "time": time_compiled(compiled, arg, n_repeat),
+              "grad_time": None}
+    result.update(get_cost(compiled))
+
+    if gradient:
+        grad = jax.jit(jax.grad(lambda a: sum_outputs(func(a)))).lower(arg).compile()
+        result["grad_time"] = time_compiled(grad, arg, n_repeat)
+    return result
+
+def run_stages(stages: list[tuple[str, callable, object]],
+               n_repeat: int,
+               trace_dir: str = None) -> dict:
+    """Profile a list of (name, function, input) stages, optionally inside a jax.profiler trace written to trace_dir."""
+    report = {"backend": jax.default_backend(), "n_repeat": n_repeat, "stages": {}}
+    trace = jax.profiler.trace(trace_dir) if trace_dir is not None else contextlib.nullcontext()
+    with trace:
+        for name, func, arg in stages:
+            with jax.profiler.TraceAnnotation(name):
+                report["stages"][name] = profile_stage(func, arg, n_repeat)
+    return report
+
+def as_float(x: dict) -> dict:
+    return jax.tree.map(lambda value: jnp.asarray(value, dtype=float), x)
+
+##############
+### STAGES ###
+##############
+
+def get_model_stages(model: SurrogateModel,
+                     x: dict[str, Array]) -> list[tuple[str, callable, object]]:
+    """
+    Stages of SurrogateModel.predict with their inputs, which are computed by running the stages one after another.
+    The names agree with the named scopes in predict, so that the stages can also be identified in profiler traces.
+    """
+    x = as_float(x)
+    x_array = jnp.array([x[name] for name in model.parameter_names])
+    x_tilde = model.project_input(x_array)
+    y_tilde = model.compute_output(x_tilde)
+    y = model.project_output(y_tilde).astype(jnp.result_type(float))
+
+    return [("project_input", model.project_input, x_array),
+            ("apply_fn", model.compute_output, x_tilde),
+            ("inverse_transform", lambda y: model.project_output(y).astype(jnp.result_type(float)), y_tilde),
+            ("get_mag", lambda y: model.convert_to_mag(y, x)[1], y)]
+
+def profile_model(model: SurrogateModel,
+                  x: dict[str, Array],
+                  n_repeat: int = 100,
+                  trace_dir: str = None) -> dict:
+    """
+    Time the stages of SurrogateModel.predict (project_input, apply_fn, inverse_transform, get_mag) separately and the full prediction, each compiled on its own and with gradients.
+
+    Args:
+        model (SurrogateModel): The surrogate model.
+        x (dict[str, Array]): Parameters including luminosity_distance and redshift.
+        n_repeat (int): Number of timed calls per stage. Defaults to 100.
+        trace_dir (str): If given, a jax.profiler trace of the profiling is written to this directory. Defaults to None.
+
+    Returns:
+        dict: Report with the backend, n_repeat and per stage the compile time, time, gradient time (in seconds), FLOPs, accessed bytes and memory.
+    """
+    x = as_float(x)
+    stages = get_model_stages(model, x)
+    stages.append(("predict", lambda x: model.predict(x)[1], x))
+    return run_stages(stages, n_repeat, trace_dir)
+
+def profile_likelihood(likelihood,
+                       theta: dict[str, Array],
+                       data: dict = None,
+                       n_repeat: int = 100,
+                       trace_dir: str = None) -> dict:
+    """
+    Time the stages of EMLikelihood.evaluate separately: the stages of the surrogate prediction (see profile_model), the interpolation to the observation times and the reduction to the log-likelihood (log_prob), as well as the full evaluation.
+    The stages follow the prediction without surrogate uncertainty.
+
+    Args:
+        likelihood (EMLikelihood): The likelihood.
+        theta (dict[str, Array]): Sampled parameters.
+        data (dict): Data of the likelihood. Defaults to None, i.e. likelihood.data.
+        n_repeat (int): Number of timed calls per stage. Defaults to 100.
+        trace_dir (str): If given, a jax.profiler trace of the profiling is written to this directory. Defaults to None.
+
+    Returns:
+        dict: Report as returned by profile_model.
+    """
+    if data is None:
+        data = likelihood.data
+    theta = as_float(theta)
+    x = likelihood.conversion({**theta, **data["fixed_params"]})
+    model = likelihood.evaluation_model
+
+    stages = get_model_stages(model, x)
+    _, mag_app = model.predict(x)
+    stencils = likelihood.get_stencils(x.get("redshift"), data)
+    mag_est = likelihood.interpolate(mag_app, *stencils, data["filter_idx"])
+
+    def log_prob(mag_est):
+        if likelihood.offset_names:
+            return likelihood.marginalize_offsets(mag_est, data["sigma"], data)
+        return jnp.sum(jnp.where(data["is_valid"], likelihood.get_log_prob(mag_est, data["sigma"], data), 0.))
+
+    stages += [("interpolate", lambda mag: likelihood.interpolate(mag, *stencils, data["filter_idx"]), mag_app),
+               ("log_prob", log_prob, mag_est),
+               ("evaluate", lambda theta: likelihood.evaluate(theta, data), theta)]
+    return run_stages(stages, n_repeat, trace_dir)
+
+##############
+### REPORT ###
+##############
+
+def format_report(report: dict) -> str:
+    """Format a profiling report as a text table, times in microseconds."""
+    header = f"{'stage':<20}{'time [us]':>12}{'grad [us]':>12}{'compile [s]':>13}{'MFLOPs':>12}{'MB accessed':>13}{'temp MB':>10}"
+    lines = [f"Backend: {report['backend']}, {report['n_repeat']} repetitions", header, "-" * len(header)]
+
+    def fmt(value, scale, width, precision):
+        return f"{'-':>{width}}" if value is None else f"{value * scale:>{width}.{precision}f}"
+
+    for name, stage in report["stages"].items():
+        lines.append(f"{name:<20}" + fmt(stage["time"], 1e6, 12, 1) + fmt(stage["grad_time"], 1e6, 12, 1)
+                     + fmt(stage["compile_time"], 1, 13, 2) + fmt(stage["flops"], 1e-6, 12, 3)
+                     + fmt(stage["bytes_accessed"], 1e-6, 13, 3) + fmt(stage["temp_bytes"], 1e-6, 10, 3))
+    return "\n".join(lines)
+
+def save_report(report: dict, filename: str) -> None:
+    """Save a profiling report as JSON if the filename ends with .json, and as text table otherwise."""
+    with open(filename, "w") as f:
+        if filename.endswith(".json"):
+            json.dump(report, f, indent=4)
+        else:
+            f.write(format_report(report) + "\n")
+    print(f"Saved profiling report to {filename}.")
@@ -0,0 +1,123 @@
+"""Process-wide registry of loaded surrogate models, so that every model is only loaded (and compiled) once per process."""
+
+from collections import OrderedDict
+import os
+
+import numpy as np
+import jax
+from flax.training.train_state import TrainState
+
+from fiesta.inference.lightcurve_model import SurrogateModel
+from fiesta.scalers import Scaler
+
+
+def get_model_nbytes(obj, visited: set = None) -> int:
+    """
+    Estimate the memory held by the arrays of a model (network parameters, scalers, grids).
+
+    Args:
+        obj: Model or one of its attributes.
+        visited (set): Ids of the objects that were already counted.
+
+    Returns:
+        int: Number of bytes.
+    """
+    if visited is None:
+        visited = set()
+    if id(obj) in visited:
+        return 0
+    visited.add(id(obj))
+
+    if isinstance(obj, (np.ndarray, jax.Array)):
+        return obj.nbytes
+    elif isinstance(obj, TrainState):
+        return sum(get_model_nbytes(leaf, visited) for leaf in jax.tree.leaves(obj.params))
+    elif isinstance(obj, dict):
+        return sum(get_model_nbytes(value, visited) for value in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(get_model_nbytes(value, visited) for value in obj)
+    elif isinstance(obj, (SurrogateModel, Scaler)):
+        return get_model_nbytes(vars(obj), visited)
+    return 0
+
+class ModelRegistry:
+    """
+    Cache of surrogate models keyed on their class, name, directory, filters, and further constructor arguments such as the precision.
+    Returned models are shared, i.e. they keep their compiled functions between requests, and should not be modified.
+    If the memory of the cached models exceeds max_memory, the least recently used models are evicted.
+    """
+
+    def __init__(self, max_memory: int = 2 * 1024**3):
+        """
+        Args:
+            max_memory (int): Memory cap in bytes for the arrays of all cached models. Defaults to 2 GB.
+        """
+        self.max_memory = max_memory
+        self.models = OrderedDict()
+        self.nbytes = {}
+
+    def get_model(self,
+                  model_class: type,
+                  name: str,
+                  directory: str,
+                  filters: list[str] = None,
+                  **kwargs) -> SurrogateModel:
+        """
+        Get a model from the registry, loading it if it is not cached yet.
+
+        Args:
+            model_class (type): Class of the surrogate model, e.g. AfterglowFlux or BullaLightcurveModel.
+            name (str): Name of the model.
+            directory (str): Directory of the model files.
+            filters (list[str]): Filters of the model. Defaults to None, i.e. all available filters.
+            **kwargs: Further arguments passed to the constructor of model_class, e.g. precision or fused.
+
+        Returns:
+            SurrogateModel: The shared model instance.
+        """
+        if filters is not None:
+            filters = tuple(filters)
+        key = (model_class, name, os.path.abspath(directory), filters, tuple(sorted(kwargs.items())))
+
+        if key in self.models:
+            self.models.move_to_end(key)
+            model = self.models[key]
+        else:
+            model = model_class(name=name, directory=directory, filters=None if filters is None else list(filters), **kwargs)
+            self.models[key] = model
+        
+        # networks of bundles are loaded lazily, so the memory is updated on every request
+        self.nbytes[key] = get_model_nbytes(model)
+        self.evict()
+        return model
+
+    def evict(self) -> None:
+        """Remove the least recently used models until the memory cap is met, the most recently used model is always kept."""
+        while len(self.models) > 1 and self.memory > self.max_memory:
+            key, model = self.models.popitem(last=False)
+            del self.nbytes[key]
+            print(f"NOTE: Evicting surrogate {model.name} from the model registry.")
+
+    @property
+    def memory(self) -> int:
+        """Memory in bytes of the cached models at the time they were last requested."""
+        return sum(self.nbytes.values())
+
+    def clear(self) -> None:
+        self.models.clear()
+        self.nbytes.clear()
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+
+# default registry of the process
+registry = ModelRegistry()
+
+def get_model(model_class: type,
+              name: str,
+              directory: str,
+              filters: list[str] = None,
+              **kwargs) -> SurrogateModel:
+    """Get a shared model from the default registry of the process, see ModelRegistry.get_model."""
+    return registry.get_model(model_class, name, directory, filters, **kwargs)
@@ -0,0 +1,287 @@
+"""Adaptive tempered sequential Monte Carlo with MALA and normalizing flow moves, compiled as a single loop. Returns weighted samples of the posterior and the log-evidence."""
+
+from functools import partial
+from typing import Callable
+
+import equinox as eqx
+import jax
+import jax.numpy as jnp
+import optax
+from jax.scipy.linalg import solve_triangular
+from jax.scipy.special import logsumexp
+from jaxtyping import Array, Float, PRNGKeyArray, PyTree
+
+from flowMC.nfmodel.base import NFModel
+
+from fiesta.inference.local_sampler import TARGET_ACCEPTANCE, default_step_scale, estimate_mass_matrix
+
+
+#################
+### UTILITIES ###
+#################
+
+def get_log_target(log_prior_and_likelihood: Callable,
+                   x: Float[Array, "n_particles n_dim"],
+                   beta: Float) -> tuple[Float[Array, "n_particles"], Float[Array, "n_particles n_dim"], Float[Array, "n_particles"]]:
+    """
+    Tempered log target log prior + beta * log likelihood of all particles and its gradient, evaluated in one batched call.
+    Points outside the support of the prior or with a non-finite likelihood get -inf and a zero gradient.
+
+    Returns:
+        tuple: The log target, its gradient and the log-likelihood of the particles.
+    """
+    def summed_log_target(x):
+        log_prior, log_likelihood = log_prior_and_likelihood(x)
+        log_likelihood = jnp.nan_to_num(log_likelihood, nan=-jnp.inf, posinf=-jnp.inf)
+        log_target = log_prior + jnp.where(beta > 0, beta * log_likelihood, 0.)
+        log_target = jnp.where(jnp.isfinite(log_target), log_target, -jnp.inf)
+        # the particles are independent, so the gradient of the sum is the gradient of each particle
+        return jnp.sum(jnp.where(jnp.isfinite(log_target), log_target, 0.)), (log_target, log_likelihood)
+
+    (_, (log_target, log_likelihood)), grad = jax.value_and_grad(summed_log_target, has_aux=True)(x)
+    grad = jnp.where(jnp.isfinite(grad), grad, 0.)
+    return log_target, grad, log_likelihood
+
+def get_ess(log_weights: Float[Array, "n_particles"]) -> Float:
+    """Effective sample size of normalized log weights."""
+    return 1. / jnp.sum(jnp.exp(2 * log_weights))
+
+def normalize(log_weights: Float[Array, "n_particles"]) -> Float[Array, "n_particles"]:
+    return log_weights - logsumexp(log_weights)
+
+def next_temperature(beta: Float,
+                     log_likelihood: Float[Array, "n_particles"],
+                     log_weights: Float[Array, "n_particles"],
+                     target_ess: float,
+                     n_bisections: int = 50) -> Float:
+    """
+    Next inverse temperature, chosen by bisection such that the effective sample size of the reweighted particles drops to the fraction target_ess of the particles, or 1 if it stays above.
+    """
+    n_particles = log_weights.shape[0]
+    ess_fraction = lambda delta: get_ess(normalize(log_weights + jnp.where(delta > 0, delta * log_likelihood, 0.))) / n_particles
+
+    def bisect(_, bounds):
+        lower, upper = bounds
+        middle = (lower + upper) / 2
+        above = ess_fraction(middle) >= target_ess
+        return jnp.where(above, middle, lower), jnp.where(above, upper, middle)
+
+    delta, _ = jax.lax.fori_loop(0, n_bisections, bisect, (0., 1. - beta))
+    # the step must not vanish, and the last step has to end exactly at 1
+    delta = jnp.maximum(delta, 1e-6 * (1. - beta))
+    return jnp.where(ess_fraction(1. - beta) >= target_ess, 1., beta + delta)
+
+def systematic_resampling(key: PRNGKeyArray, log_weights: Float[Array, "n_particles"]) -> Array:
+    """Indices of the resampled particles, drawn with a single uniform number."""
+    n_particles = log_weights.shape[0]
+    positions = (jax.random.uniform(key) + jnp.arange(n_particles)) / n_particles
+    return jnp.minimum(jnp.searchsorted(jnp.cumsum(jnp.exp(log_weights)), positions), n_particles - 1)
+
+#############
+### MOVES ###
+#############
+
+def mala_moves(log_prior_and_likelihood: Callable,
+               key: PRNGKeyArray,
+               x: Float[Array, "n_particles n_dim"],
+               log_target: Float[Array, "n_particles"],
+               grad: Float[Array, "n_particles n_dim"],
+               log_likelihood: Float[Array, "n_particles"],
+               beta: Float,
+               cholesky: Float[Array, "n_dim n_dim"],
+               step_scale: Float,
+               n_steps: int) -> tuple[tuple, Float, Float]:
+    """
+    n_steps MALA steps of all particles towards the tempered target, preconditioned with the covariance cholesky cholesky^T of the particles.
+    The proposal is x + eps^2 C grad / 2 + eps cholesky xi with xi ~ N(0, I) and C = cholesky cholesky^T.
+    After every step, log(eps) moves by the difference between the acceptance rate of all particles and the optimal acceptance rate of MALA.
+
+    Returns:
+        tuple: The updated particle state (x, log_target, grad, log_likelihood), the adapted step scale and the mean acceptance rate.
+    """
+    cov = cholesky @ cholesky.T
+
+    def step(carry, key):
+        (x, log_target, grad, log_likelihood), step_scale = carry
+        key_proposal, key_accept = jax.random.split(key)
+        xi = jax.random.normal(key_proposal, x.shape)
+        proposal = x + step_scale**2 / 2 * grad @ cov + step_scale * xi @ cholesky.T
+        proposal_log_target, proposal_grad, proposal_log_likelihood = get_log_target(log_prior_and_likelihood, proposal, beta)
+
+        # log q(x | proposal) - log q(proposal | x) in whitened coordinates
+        backward = solve_triangular(cholesky, (x - proposal - step_scale**2 / 2 * proposal_grad @ cov).T, lower=True).T / step_scale
+        log_ratio = proposal_log_target - log_target - 0.5 * jnp.sum(backward**2, axis=1) + 0.5 * jnp.sum(xi**2, axis=1)
+        accept = jnp.log(jax.random.uniform(key_accept, log_ratio.shape)) < log_ratio
+
+        select = lambda new, old: jnp.where(accept.reshape(-1, *[1] * (new.ndim - 1)), new, old)
+        state = (select(proposal, x), select(proposal_log_target, log_target), select(proposal_grad, grad), select(proposal_log_likelihood, log_likelihood))
+        step_scale = step_scale * jnp.exp(jnp.mean(accept) - TARGET_ACCEPTANCE["MALA"])
+        return (state, step_scale), jnp.mean(accept)
+
+    (state, step_scale), acceptance = jax.lax.scan(step, ((x, log_target, grad, log_likelihood), step_scale), jax.random.split(key, n_steps))
+    return state, step_scale, jnp.mean(acceptance)
+
+def flow_move(log_prior_and_likelihood: Callable,
+              key: PRNGKeyArray,
+              state: tuple,
+              beta: Float,
+              flow_params: NFModel,
+              flow_static: NFModel,
+              opt_state: optax.OptState,
+              optimizer: optax.GradientTransformation,
+              n_train_steps: int,
+              batch_size: int) -> tuple[tuple, NFModel, optax.OptState, Float]:
+    """
+    Fit the normalizing flow to the particles with n_train_steps Adam steps on random batches, continuing from the flow of the previous temperature,
+    and move all particles with one independence Metropolis-Hastings step that proposes samples of the flow.
+
+    Returns:
+        tuple: The updated particle state, the parameters of the flow, the optimizer state and the acceptance rate.
+    """
+    x, log_target, grad, log_likelihood = state
+    n_particles = x.shape[0]
+    key_train, key_sample, key_accept = jax.random.split(key, 3)
+
+    # the flow standardizes with the moments of its training data, which are buffers and not trained
+    flow_static = eqx.tree_at(lambda m: (m._data_mean, m._data_cov), flow_static, (jnp.mean(x, axis=0), jnp.diag(jnp.var(x, axis=0) + 1e-12)))
+    loss_fn = eqx.filter_value_and_grad(lambda params, batch: -jnp.mean(eqx.combine(params, flow_static).log_prob(batch)))
+
+    def train_step(carry, key):
+        flow_params, opt_state = carry
+        batch = x[jax.random.randint(key, (batch_size,), 0, n_particles)]
+        _, grads = loss_fn(flow_params, batch)
+        updates, opt_state = optimizer.update(grads, opt_state, flow_params)
+        return (eqx.apply_updates(flow_params, updates), opt_state), None
+
+    (flow_params, opt_state), _ = jax.lax.scan(train_step, (flow_params, opt_state), jax.random.split(key_train, n_train_steps))
+    flow = eqx.combine(flow_params, flow_static)
+
+    proposal = flow.sample(key_sample, n_particles)
+    proposal_log_target, proposal_grad, proposal_log_likelihood = get_log_target(log_prior_and_likelihood, proposal, beta)
+    log_ratio = proposal_log_target - log_target + flow.log_prob(x) - flow.log_prob(proposal)
+    log_ratio = jnp.nan_to_num(log_ratio, nan=-jnp.inf)
+    accept = jnp.log(jax.random.uniform(key_accept, (n_particles,))) < log_ratio
+
+    select = lambda new, old: jnp.where(accept.reshape(-1, *[1] * (new.ndim - 1)), new, old)
+    state = (select(proposal, x), select(proposal_log_target, log_target), select(proposal_grad, grad), select(proposal_log_likelihood, log_likelihood))
+    return state, flow_params, opt_state, jnp.mean(accept)
+
+###########
+### SMC ###
+###########
+
+@eqx.filter_jit
+def tempered_smc(log_prior_and_likelihood: Callable,
+                 x: Float[Array, "n_particles n_dim"],
+                 key: PRNGKeyArray,
+                 data: PyTree = None,
+                 n_mcmc_steps: int = 10,
+                 target_ess: float = 0.5,
+                 max_steps: int = 200,
+                 flow: NFModel = None,
+                 n_flow_steps: int = 0,
+                 flow_batch_size: int = 1_000,
+                 learning_rate: float = 1e-3) -> dict[str, Array]:
+    """
+    Adaptive tempered SMC from prior draws x to the posterior prior * likelihood, compiled as a single while loop.
+    At every temperature, the particles are reweighted to the next inverse temperature beta, chosen such that the effective sample size drops to the fraction target_ess,
+    resampled, and moved with n_mcmc_steps MALA steps (see mala_moves) and, if a flow is given, a normalizing flow move (see flow_move).
+    The step size of MALA is preconditioned with the covariance of the particles and adapted towards the optimal acceptance rate.
+    At beta = 1, the particles are moved without resampling, so that the returned samples carry the importance weights of the last step.
+    The log-evidence is the sum of the logarithms of the mean incremental weights.
+    log_prior_and_likelihood is static and data is traced, so the compiled loop is reused for new data as long as the same function (e.g. a bound method of Fiesta) is passed instead of a new closure.
+
+    Args:
+        log_prior_and_likelihood (Callable): Log prior and log-likelihood log_prior_and_likelihood(x, data) of a batch of points with shape (n_particles, n_dim), returned as two arrays of shape (n_particles,).
+        x (Float[Array, "n_particles n_dim"]): Draws from the prior.
+        key (PRNGKeyArray): Random key.
+        data (PyTree): Data passed to log_prior_and_likelihood. Defaults to None.
+        n_mcmc_steps (int): Number of MALA steps per temperature. Defaults to 10.
+        target_ess (float): Fraction of the particles that the effective sample size may drop to in a step. Defaults to 0.5.
+        max_steps (int): Maximal number of temperatures. Defaults to 200.
+        flow (NFModel): Normalizing flow for the flow moves, e.g. a flowMC MaskedCouplingRQSpline. Defaults to None, i.e. only MALA moves.
+        n_flow_steps (int): Number of Adam steps to fit the flow per temperature. Defaults to 0, i.e. only MALA moves.
+        flow_batch_size (int): Batch size of the fit of the flow. Defaults to 1_000.
+        learning_rate (float): Learning rate of the fit of the flow. Defaults to 1e-3.
+
+    Returns:
+        dict[str, Array]: The samples, their normalized log_weights and log_likelihood, the log_evidence, the number of temperatures n_steps,
+            and per temperature the inverse temperatures betas and the acceptance rates mala_acceptance and flow_acceptance (padded to max_steps with nan).
+    """
+    log_prior_and_likelihood = partial(log_prior_and_likelihood, data=data)
+    n_particles, n_dim = x.shape
+    use_flow = flow is not None and n_flow_steps > 0
+    if use_flow:
+        # the normalization buffers of the flow are set from the particles and not trained
+        filter_spec = jax.tree.map(eqx.is_inexact_array, flow)
+        filter_spec = eqx.tree_at(lambda m: (m._data_mean, m._data_cov), filter_spec, replace=(False, False))
+        flow_params, flow_static = eqx.partition(flow, filter_spec)
+        optimizer = optax.adam(learning_rate)
+        opt_state = optimizer.init(flow_params)
+    else:
+        flow_params, flow_static, opt_state, optimizer = None, None, None, None
+
+    log_target, grad, log_likelihood = get_log_target(log_prior_and_likelihood, x, 0.)
+    history = jnp.full((3, max_steps), jnp.nan)
+    init = {"particles": (x, log_target, grad, log_likelihood),
+            "log_weights": jnp.full(n_particles, -jnp.log(n_particles)),
+            "beta": jnp.asarray(0.),
+            "log_evidence": jnp.asarray(0.),
+            "step_scale": jnp.asarray(default_step_scale("MALA", n_dim)),
+            "flow_params": flow_params,
+            "opt_state": opt_state,
+            "history": history,
+            "n_steps": 0,
+            "key": key}
+
+    def body(carry):
+        x, log_target, grad, log_likelihood = carry["particles"]
+        beta, log_weights = carry["beta"], carry["log_weights"]
+        key, key_resample, key_mala, key_flow = jax.random.split(carry["key"], 4)
+
+        # reweight to the next temperature
+        new_beta = next_temperature(beta, log_likelihood, log_weights, target_ess)
+        log_increment = log_weights + jnp.where(new_beta > beta, (new_beta - beta) * log_likelihood, 0.)
+        log_evidence = carry["log_evidence"] + logsumexp(log_increment)
+        log_weights = normalize(log_increment)
+
+        # resample, except at the last temperature
+        idx = jnp.where(new_beta < 1., systematic_resampling(key_resample, log_weights), jnp.arange(n_particles))
+        log_weights = jnp.where(new_beta < 1., -jnp.log(n_particles), log_weights)
+        x, log_likelihood = x[idx], log_likelihood[idx]
+        log_target, grad, _ = get_log_target(log_prior_and_likelihood, x, new_beta)
+
+        # move
+        cholesky = estimate_mass_matrix(x[None], dense=True)
+        particles, step_scale, mala_acceptance = mala_moves(log_prior_and_likelihood, key_mala, x, log_target, grad, log_likelihood,
+                                                            new_beta, cholesky, carry["step_scale"], n_mcmc_steps)
+
+        flow_params, opt_state, flow_acceptance = carry["flow_params"], carry["opt_state"], jnp.nan
+        if use_flow:
+            particles, flow_params, opt_state, flow_acceptance = flow_move(log_prior_and_likelihood, key_flow, particles, new_beta, flow_params, flow_static,
+                                                                           opt_state, optimizer, n_flow_steps, min(flow_batch_size, n_particles))
+
+        history = carry["history"].at[:, carry["n_steps"]].set(jnp.array([new_beta, mala_acceptance, flow_acceptance]))
+        return {"particles": particles,
+                "log_weights": log_weights,
+                "beta": new_beta,
+                "log_evidence": log_evidence,
+                "step_scale": step_scale,
+                "flow_params": flow_params,
+                "opt_state": opt_state,
+                "history": history,
+                "n_steps": carry["n_steps"] + 1,
+                "key": key}
+
+    cond = lambda carry: (carry["beta"] < 1.) & (carry["n_steps"] < max_steps)
+    result = jax.lax.while_loop(cond, body, init)
+
+    x, _, _, log_likelihood = result["particles"]
+    return {"samples": x,
+            "log_weights": result["log_weights"],
+            "log_likelihood": log_likelihood,
+            "log_evidence": result["log_evidence"],
+            "n_steps": result["n_steps"],
+            "betas": result["history"][0],
+            "mala_acceptance": result["history"][1],
+            "flow_acceptance": result["history"][2]}
@@ -1,3 +1,4 @@
+import copy
 from functools import partial
 
 import jax.numpy as jnp
@@ -30,6 +31,19 @@ class Scaler(object):
         self.fit(x)
         return self.transform(x)
     
+    def output_subset(self, idx: Int[Array, "n_subset"]) -> "Scaler":
+        """
+        Return a copy of this scaler whose inverse_transform only reconstructs the output entries idx.
+        The transform method of the returned scaler is not meaningful anymore.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support the reconstruction of output subsets.")
+    
+    def astype(self, dtype: jnp.dtype) -> "Scaler":
+        """
+        Return a copy of this scaler whose arrays are cast to dtype, e.g. to evaluate the transforms in reduced precision.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support casting to {dtype}.")
+    
     def __call__(self, x: Array) -> Array:
         return self.transform(x)
 
@@ -56,6 +70,15 @@ class MinMaxScalerJax(Scaler):
     
     def inverse_transform(self, x: Array) -> Array:
         return x * (self.max_val - self.min_val) + self.min_val
+    
+    def output_subset(self, idx: Int[Array, "n_subset"]) -> Scaler:
+        min_val, max_val = jnp.asarray(self.min_val), jnp.asarray(self.max_val)
+        if min_val.ndim > 0:
+            min_val, max_val = min_val[idx], max_val[idx]
+        return MinMaxScalerJax(min_val, max_val)
+    
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        return MinMaxScalerJax(jnp.asarray(self.min_val, dtype=dtype), jnp.asarray(self.max_val, dtype=dtype))
 
     
 class StandardScalerJax(Scaler):
@@ -80,6 +103,15 @@ class StandardScalerJax(Scaler):
     
     def inverse_transform(self, x: Array) -> Array:
         return x * self.sigma + self.mu
+    
+    def output_subset(self, idx: Int[Array, "n_subset"]) -> Scaler:
+        mu, sigma = jnp.asarray(self.mu), jnp.asarray(self.sigma)
+        if mu.ndim > 0:
+            mu, sigma = mu[idx], sigma[idx]
+        return StandardScalerJax(mu, sigma)
+    
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        return StandardScalerJax(jnp.asarray(self.mu, dtype=dtype), jnp.asarray(self.sigma, dtype=dtype))
 
 
 class PCADecomposer(Scaler):
@@ -149,6 +181,18 @@ class PCADecomposer(Scaler):
     
     def inverse_transform(self, x: Array)->Array:
         return jnp.dot(x, self.Vt) + self.means
+    
+    def output_subset(self, idx: Int[Array, "n_subset"]) -> Scaler:
+        subset = copy.copy(self)
+        subset.Vt = self.Vt[:, idx]
+        subset.means = self.means[:, idx]
+        return subset
+    
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        cast = copy.copy(self)
+        cast.Vt = self.Vt.astype(dtype)
+        cast.means = self.means.astype(dtype)
+        return cast
 
     
 class SVDDecomposer(Scaler):
@@ -178,6 +222,18 @@ class SVDDecomposer(Scaler):
         x = jnp.dot(x, self.VA)
         x = self.scaler.inverse_transform(x)
         return x
+    
+    def output_subset(self, idx: Int[Array, "n_subset"]) -> Scaler:
+        subset = copy.copy(self)
+        subset.VA = self.VA[:, idx]
+        subset.scaler = self.scaler.output_subset(idx)
+        return subset
+    
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        cast = copy.copy(self)
+        cast.VA = self.VA.astype(dtype)
+        cast.scaler = self.scaler.astype(dtype)
+        return cast
 
 
 class ImageScaler(Scaler):
@@ -191,6 +247,9 @@ class ImageScaler(Scaler):
                  downscale: Int[Array, "shape=(2,)"],
                  upscale: Int[Array, "shape=(2,)"]):
         
+        self.downscale = downscale
+        self.upscale = upscale
+        
         #these are defined here so that upscale and downscale become static
         def transform(x: Array) -> Array:
             x = x.reshape(-1, upscale[0], upscale[1])
@@ -211,6 +270,32 @@ class ImageScaler(Scaler):
     def fit(self, x: Array):
         pass    
     
+    def output_subset(self, idx: Int[Array, "n_subset"], chunk_size: int = 64) -> Scaler:
+        # the upsampling and the edge extrapolation are linear, so the entries idx of the flattened output 
+        # are a matrix product with the images of the unit vectors, which are computed in chunks
+        n_in = self.downscale[0] * self.downscale[1]
+        inverse = jax.jit(lambda x: self.inverse_transform(x).reshape(x.shape[0], -1)[:, idx])
+        offset = inverse(jnp.zeros((1, n_in)))
+        basis = jnp.eye(n_in)
+        matrix = jnp.concatenate([inverse(basis[j:j + chunk_size]) - offset for j in range(0, n_in, chunk_size)])
+        
+        subset = copy.copy(self)
+        subset.subset_matrix, subset.subset_offset = matrix, offset[0]
+        subset.inverse_transform = subset.subset_inverse_transform
+        return subset
+    
+    def subset_inverse_transform(self, x: Array) -> Array:
+        return jnp.dot(x.reshape(-1, self.subset_matrix.shape[0]), self.subset_matrix) + self.subset_offset
+    
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        if not hasattr(self, "subset_matrix"):
+            # no stored arrays, the resizing is done in the dtype of the input
+            return self
+        cast = copy.copy(self)
+        cast.subset_matrix, cast.subset_offset = self.subset_matrix.astype(dtype), self.subset_offset.astype(dtype)
+        cast.inverse_transform = cast.subset_inverse_transform
+        return cast
+    
     @staticmethod
     @jax.vmap
     def fix_edges(yp: Array)-> Array:
@@ -253,6 +338,11 @@ class ParameterScaler(Scaler):
         x = self.conversion(x)
         return self.scaler.transform(x)
     
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        cast = copy.copy(self)
+        cast.scaler = self.scaler.astype(dtype)
+        return cast
+    
 def thetaWing_inclination(x):
     return jnp.hstack((x, (x[:,3]*x[:,2]-x[:,0]).reshape(-1,1) ))
 
@@ -292,5 +382,19 @@ class DataScaler(Scaler):
         for scaler in reversed(self.scalers):
             x = scaler.inverse_transform(x)
         return x
+    
+    def output_subset(self, idx: Int[Array, "n_subset"]) -> Scaler:
+        # the first scaler is the last one applied in inverse_transform,
+        # element-wise scalers are sliced until we reach a projection onto the coefficient space
+        scalers = []
+        for j, scaler in enumerate(self.scalers):
+            scalers.append(scaler.output_subset(idx))
+            if isinstance(scaler, (PCADecomposer, SVDDecomposer, ImageScaler)):
+                scalers += self.scalers[j+1:]
+                break
+        return DataScaler(scalers)
+    
+    def astype(self, dtype: jnp.dtype) -> Scaler:
+        return DataScaler([scaler.astype(dtype) for scaler in self.scalers])
 
         
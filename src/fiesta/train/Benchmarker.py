@@ -13,6 +13,15 @@ from scipy.interpolate import interp1d
 
 from fiesta.inference.lightcurve_model import LightcurveModel, FluxModel
 
+def get_metric(metric_name: str, times: np.ndarray) -> callable:
+    """
+    Error metric over the last axis of a magnitude difference array, either 'L2' (integrated over log time) or 'Linf'.
+    """
+    if metric_name == "L2":
+        return lambda y: np.sqrt(trapezoid(x= np.log(times) ,y=y**2, axis = -1)) / (np.log(times[-1]) - np.log(times[0]))
+    else:
+        return lambda y: np.max(np.abs(y), axis = -1)
+
 class Benchmarker:
 
     def __init__(self,
@@ -36,14 +45,13 @@ class Benchmarker:
         print(f"Loaded filters are: {[Filt.name for Filt in self.Filters]}.")
 
         # Load metric
+        self.metric = get_metric(metric_name, self.times)
         if metric_name == "L2":
             self.metric_name = "$\\mathcal{L}_2$"
-            self.metric = lambda y: np.sqrt(trapezoid(x= np.log(self.times) ,y=y**2, axis = -1)) / (np.log(self.times[-1]) - np.log(self.times[0]))
             self.metric2d = lambda y: np.sqrt(trapezoid(x = self.nus, y =trapezoid(x = self.times, y = (y**2).reshape(-1, len(self.nus), len(self.times)) ) ))
             self.file_ending = "L2"
         else:
             self.metric_name = "$\\mathcal{L}_\\inf$"
-            self.metric = lambda y: np.max(np.abs(y), axis = -1)
             self.metric2d = lambda y: np.max(np.abs(y), axis = (1,2))
             self.file_ending = "Linf"
 
@@ -119,7 +119,8 @@ class PCATrainer(FluxTrainer):
                  n_pca: Int = 100,
                  conversion: str = None,
                  plots_dir: str = None,
-                 save_preprocessed_data: bool = False) -> None:
+                 save_preprocessed_data: bool = False,
+                 n_ensemble: Int = 1) -> None:
         """
         FluxTrainer for training a feed-forward neural network on the PCA coefficients of the training data to predict the full 2D spectral flux density array.
         Initializing will read the data and preprocess it with the DataManager class. It can then be fit with the fit() method. 
@@ -133,6 +134,7 @@ class PCATrainer(FluxTrainer):
             conversion (str): references how to convert the parameters for the training. Defaults to None, in which case it's the identity.
             plots_dir (str): Directory where the loss curves will be plotted. If None, the plot will not be created. Defaults to None.
             save_preprocessed_data (bool): Whether the preprocessed (i.e. PCA decomposed) training and validation data will be written to file. Defaults to False.
+            n_ensemble (int): Number of ensemble members. If larger than 1, a deep ensemble of MLPs is trained that also provides the surrogate uncertainty. Defaults to 1.
         """
 
         super().__init__(name = name,
@@ -140,7 +142,8 @@ class PCATrainer(FluxTrainer):
                          plots_dir = plots_dir,
                          save_preprocessed_data = save_preprocessed_data)
         
-        self.model_type = "MLP"
+        self.n_ensemble = n_ensemble
+        self.model_type = "MLPEnsemble" if n_ensemble > 1 else "MLP"
 
         self.n_pca = n_pca
         self.conversion = conversion
@@ -185,7 +188,10 @@ class PCATrainer(FluxTrainer):
 
         
         # Create neural network and initialize the state
-        self.network = fiesta_nn.MLP(config = config, input_ndim = input_ndim, key = key)
+        if self.n_ensemble > 1:
+            self.network = fiesta_nn.MLPEnsemble(config = config, input_ndim = input_ndim, n_ensemble = self.n_ensemble, key = key)
+        else:
+            self.network = fiesta_nn.MLP(config = config, input_ndim = input_ndim, key = key)
                 
         # Perform training loop
         state, train_losses, val_losses = self.network.train_loop(self.train_X, self.train_y, self.val_X, self.val_y, verbose=verbose)
@@ -50,6 +50,9 @@ class LightcurveTrainer:
 
         self.save_preprocessed_data = save_preprocessed_data
 
+        self.n_ensemble = 1
+        self.model_type = "MLP"
+
         # To be loaded by child classes
         self.filters = None
         self.parameter_names = None
@@ -102,7 +105,10 @@ class LightcurveTrainer:
             print(f"\n\n Training {filt.name}... \n\n")
             
             # Create neural network and initialize the state
-            net = fiesta_nn.MLP(config = config, input_ndim = input_ndim, key = key)
+            if self.n_ensemble > 1:
+                net = fiesta_nn.MLPEnsemble(config = config, input_ndim = input_ndim, n_ensemble = self.n_ensemble, key = key)
+            else:
+                net = fiesta_nn.MLP(config = config, input_ndim = input_ndim, key = key)
 
             # Perform training loop
             state, train_losses, val_losses = net.train_loop(self.train_X, self.train_y[filt.name], self.val_X, self.val_y[filt.name], verbose=verbose)
@@ -138,7 +144,7 @@ class LightcurveTrainer:
         save["X_scaler"] = self.X_scaler
         save["y_scaler"] = self.y_scaler
 
-        save["model_type"] = "MLP"
+        save["model_type"] = self.model_type
 
         with open(meta_filename, "wb") as meta_file:
             dill.dump(save, meta_file)
@@ -163,7 +169,8 @@ class SVDTrainer(LightcurveTrainer):
                  svd_ncoeff: Int = 50,
                  conversion: str = None,
                  plots_dir: str = None,
-                 save_preprocessed_data: bool = False) -> None:
+                 save_preprocessed_data: bool = False,
+                 n_ensemble: Int = 1) -> None:
         """
         Initialize the surrogate model trainer that decomposes the training data into its SVD coefficients. The initialization also takes care of reading data and preprocessing it, but does not automatically fit the model. Users may want to inspect the data before fitting the model.
         
@@ -176,6 +183,7 @@ class SVDTrainer(LightcurveTrainer):
             conversion (str): references how to convert the parameters for the training. Defaults to None, in which case it's the identity.
             plots_dir (str, optional): Directory where the plots of the training process will be saved. Defaults to None, which means no plots will be generated.
             save_preprocessed_data (bool, optional): If True, the preprocessed data (reduced, rescaled) will be saved in the outdir. Defaults to False.
+            n_ensemble (int, optional): Number of ensemble members per filter. If larger than 1, deep ensembles of MLPs are trained that also provide the surrogate uncertainty. Defaults to 1.
         """
 
         super().__init__(name = name,
@@ -184,6 +192,8 @@ class SVDTrainer(LightcurveTrainer):
                          save_preprocessed_data = save_preprocessed_data)
         
         self.svd_ncoeff = svd_ncoeff
+        self.n_ensemble = n_ensemble
+        self.model_type = "MLPEnsemble" if n_ensemble > 1 else "MLP"
 
         self.conversion = conversion
         
@@ -1,4 +1,5 @@
 import time
+from typing import NamedTuple
 
 import jax
 import jax.numpy as jnp
@@ -95,6 +96,52 @@ def serialize(state: TrainState,
     
     return serialized_dict
 
+class QuantizedArray(NamedTuple):
+    """Kernel stored as int8 values with one float scale per output column, i.e. kernel = values * scale."""
+    values: Array
+    scale: Array
+
+def quantize_params(params: dict, precision: str) -> dict:
+    """
+    Cast the network parameters to a reduced storage precision.
+
+    Args:
+        params (dict): Parameters of a flax network.
+        precision (str): Either 'float32', 'bfloat16', or 'int8'. For 'int8', the kernels are quantized symmetrically per output column, while the biases are kept in float32.
+
+    Returns:
+        dict: Parameters with the same tree structure, where the kernels are replaced by QuantizedArray for 'int8'.
+    """
+    if precision in ["float32", "bfloat16"]:
+        return jax.tree.map(lambda p: p.astype(precision), params)
+    elif precision == "int8":
+        def quantize(path, p):
+            if path[-1].key != "kernel":
+                return p.astype(jnp.float32)
+            scale = jnp.max(jnp.abs(p), axis=-2, keepdims=True) / 127. # leading axes of stacked kernels get their own scales
+            scale = jnp.where(scale == 0., 1., scale)
+            values = jnp.round(p / scale).astype(jnp.int8)
+            return QuantizedArray(values, scale.astype(jnp.float32))
+        return jax.tree_util.tree_map_with_path(quantize, params)
+    else:
+        raise ValueError(f"Precision {precision} not supported for the network parameters.")
+
+def dequantize_params(params: dict, dtype: jnp.dtype = jnp.float32) -> dict:
+    """
+    Recover the network parameters from quantize_params in the compute dtype.
+    """
+    def dequantize(p):
+        if isinstance(p, QuantizedArray):
+            return p.values.astype(dtype) * p.scale.astype(dtype)
+        return p.astype(dtype)
+    return jax.tree.map(dequantize, params, is_leaf=lambda p: isinstance(p, QuantizedArray))
+
+def apply_ensemble(apply_fn: callable, params: dict, x: Array) -> Array:
+    """
+    Apply all members of an ensemble, whose parameters are stacked along the leading axis, to the same input in a single vmapped call.
+    """
+    return jax.vmap(lambda p: apply_fn({'params': p}, x))(params)
+
 ################
 ### TRAINING ###
 ################
@@ -357,4 +404,50 @@ class MLP:
         # Create train state without optimizer
         state = TrainState.create(apply_fn = net.apply, params = params, tx = optax.adam(config.learning_rate))
     
-        return state, config            
\ No newline at end of file
+        return state, config            
+
+
+class MLPEnsemble(MLP):
+    """
+    Deep ensemble of MLPs that share the same architecture. The parameters of the members are stacked along a leading axis, so that all members are trained and evaluated together.
+    """
+    def __init__(self,
+                 config: NeuralnetConfig,
+                 input_ndim: Int,
+                 n_ensemble: Int = 5,
+                 key: jax.random.PRNGKey = jax.random.key(21)):
+        self.config = config
+        self.n_ensemble = n_ensemble
+        net = nn.MLP(layer_sizes= config.layer_sizes)
+        keys = jax.random.split(key, n_ensemble)
+        params = jax.vmap(lambda k: net.init(k, jnp.ones(input_ndim))['params'])(keys) # members only differ by their initialization
+        tx = optax.adam(config.learning_rate)
+        self.state = TrainState.create(apply_fn = net.apply, params = params, tx = tx) # initialize the training state
+
+    @staticmethod
+    @jax.jit
+    def train_step(state: TrainState, 
+                   train_X: Float[Array, "n_batch_train ndim_input"], 
+                   train_y: Float[Array, "n_batch_train ndim_output"],
+                   val_X: Float[Array, "n_batch_val ndim_output"] = None, 
+                   val_y: Float[Array, "n_batch_val ndim_output"] = None, 
+                   ) -> tuple[TrainState, Float[Array, "n_batch_train"], Float[Array, "n_batch_val"]]:
+        def apply_model(state, X, y):
+            def loss_fn(params):
+                reconstructed_y = apply_ensemble(state.apply_fn, params, X)
+                mse_loss = jax.vmap(lambda pred: jnp.mean(jax.vmap(mse)(y, pred)))(reconstructed_y) # mean squared error loss per member
+                return jnp.sum(mse_loss), mse_loss # the members do not interact, so the gradient of the sum is the gradient of each member
+    
+            grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
+            (_, mse_loss), grads = grad_fn(state.params)
+            return jnp.mean(mse_loss), grads
+        train_loss, grads = apply_model(state, train_X, train_y)
+        if val_X is not None:
+            val_loss, _ = apply_model(state, val_X, val_y)
+        else:
+            val_loss = jnp.zeros_like(train_loss)
+    
+        # Update parameters
+        state = state.apply_gradients(grads=grads)
+    
+        return state, train_loss, val_loss
@@ -0,0 +1,271 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+import jax
+import jax.numpy as jnp
+from flowMC.nfmodel.rqSpline import MaskedCouplingRQSpline
+
+from fiesta.inference.lightcurve_model import AfterglowFlux
+from fiesta.inference.likelihood import EMLikelihood
+from fiesta.inference.prior import Uniform, CompositePrior
+from fiesta.inference.fiesta import Fiesta, CHECKPOINT_FILENAME, DIAGNOSTICS_FILENAME, POSTERIOR_PREDICTIVE_FILENAME
+from fiesta.inference.diagnostics import compute_diagnostics
+from fiesta.inference.optimizer import multi_start_maximization
+from fiesta.inference.smc import tempered_smc
+from fiesta.inference.local_sampler import AdaptiveMALA, AdaptiveGaussianRandomWalk, TARGET_ACCEPTANCE, estimate_mass_matrix, tune_step_scale
+
+
+working_dir = os.path.dirname(__file__)
+model_dir = os.path.join(working_dir, "models")
+
+def create_fiesta(likelihood_kwargs: dict = None, **kwargs) -> Fiesta:
+    """Small Fiesta run with the test flux model."""
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    data = {"radio-6GHz": np.array([[2.5, 20., 0.1], [4., 21., 0.2], [9., 19., np.inf]]),
+            "bessellv": np.array([[1.5, 22., 0.1], [30., 20., 0.2], [60., 23., 0.3]])}
+    likelihood_kwargs = {"fixed_params": {"luminosity_distance": 40.0, "redshift": 0.01}, **(likelihood_kwargs or {})}
+    if likelihood_kwargs.pop("detections_only", False):
+        data["radio-6GHz"] = data["radio-6GHz"][:2]
+    likelihood = EMLikelihood(model, data, filters=filters.copy(), **likelihood_kwargs)
+    
+    priors = [Uniform(xmin=float(xmin), xmax=float(xmax), naming=[name]) for name, (xmin, xmax, _) in model.parameter_distributions.items()]
+    prior = CompositePrior(priors)
+    
+    settings = dict(n_chains=4, n_loop_training=1, n_loop_production=2, n_local_steps=3, n_global_steps=3, n_epochs=2, 
+                    num_layers=2, hidden_size=[8, 8], max_samples=100, batch_size=50, local_sampler_arg={"step_size": 1e-3 * jnp.eye(prior.n_dim)})
+    settings.update(kwargs)
+    return Fiesta(likelihood, prior, **settings)
+
+def test_checkpoint(tmp_path):
+    
+    reference = create_fiesta()
+    reference.sample(jax.random.PRNGKey(0))
+    
+    # run that is interrupted after the first production loop and then resumed
+    interrupted = create_fiesta(n_loop_production=1)
+    interrupted.sample(jax.random.PRNGKey(0), outdir=tmp_path)
+    assert os.path.exists(os.path.join(tmp_path, CHECKPOINT_FILENAME))
+    
+    resumed = create_fiesta()
+    resumed.sample(jax.random.PRNGKey(1), outdir=tmp_path, resume=True)
+    for mode in ["training", "production"]:
+        for key, value in reference.Sampler.summary[mode].items():
+            assert resumed.Sampler.summary[mode][key].shape == value.shape
+            assert jnp.allclose(resumed.Sampler.summary[mode][key], value)
+
+def test_resume_without_checkpoint(tmp_path, capsys):
+    
+    fiesta = create_fiesta()
+    fiesta.sample(jax.random.PRNGKey(0), outdir=tmp_path / "new", resume=True)
+    assert "No checkpoint found" in capsys.readouterr().out
+    
+    # options of flowMC.Sampler.sample are not used by the loops of Fiesta
+    with pytest.raises(ValueError):
+        create_fiesta(local_autotune=lambda *args: args[-2])
+
+def test_streamed_output(tmp_path):
+    
+    fiesta = create_fiesta(n_loop_production=3)
+    fiesta.sample(jax.random.PRNGKey(0), outdir=tmp_path, stream_output=True, thinning=2)
+    
+    # the production samples are only kept in the file
+    assert fiesta.Sampler.summary["production"]["chains"].shape[1] == 0
+    chains = fiesta.posterior_file.read("chains")
+    n_steps = 3 * (3 + 3) # three loops of local and global steps
+    assert chains.shape == (4, n_steps // 2, fiesta.n_dim)
+    assert chains.dtype == jnp.result_type(float)
+    
+    samples = fiesta.get_samples()
+    assert samples[fiesta.prior.naming[0]].shape == (4, n_steps // 2)
+    
+    moments = fiesta.get_streamed_moments(transform=False)
+    name = fiesta.prior.naming[0]
+    assert np.allclose(moments[name][0], np.mean(chains[..., 0]), rtol=1e-5)
+    assert np.allclose(moments[name][1], np.std(chains[..., 0]), rtol=1e-3)
+    fiesta.print_summary()
+
+def test_sharded_chains():
+    
+    # several host devices can only be set up before jax is initialized, so the run is done in a new process
+    script = f"""
+import sys
+sys.path.insert(0, {working_dir!r})
+import jax
+from test_fiesta import create_fiesta
+fiesta = create_fiesta(n_chains=8, shard_chains=True)
+fiesta.sample(jax.random.PRNGKey(0))
+chains = fiesta.Sampler.summary["production"]["chains"]
+assert chains.shape == (8, 12, fiesta.n_dim)
+assert len(chains.sharding.device_set) == 4
+assert jax.numpy.all(jax.numpy.isfinite(fiesta.Sampler.summary["production"]["log_prob"]))
+"""
+    env = {**os.environ, "XLA_FLAGS": "--xla_force_host_platform_device_count=4"}
+    result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+def test_maximize_likelihood():
+    
+    fiesta = create_fiesta(n_chains=8, n_walkers_maximize_likelihood=32, n_loops_maximize_likelihood=30, n_steps_adam_maximize_likelihood=30)
+    data = fiesta.likelihood.data
+    
+    key_prior, _ = jax.random.split(jax.random.PRNGKey(0))
+    samples = fiesta.prior.sample(key_prior, 32)
+    x = jnp.stack([samples[name] for name in fiesta.prior.naming]).T
+    
+    positions = fiesta.maximize_likelihood(jax.random.PRNGKey(0))
+    assert positions.shape == (8, fiesta.n_dim)
+    log_prob = fiesta.posterior_batch(positions, data)
+    assert jnp.all(jnp.isfinite(log_prob))
+    # the optimizer starts from these prior draws
+    assert fiesta.maximization_report["best_log_prob"] > jnp.max(fiesta.posterior_batch(x, data))
+    assert jnp.min(log_prob) > jnp.median(fiesta.posterior_batch(x, data))
+    
+    # the maximization is compiled once per Fiesta object
+    n_compiled = multi_start_maximization._cache_size()
+    fiesta.maximize_likelihood(jax.random.PRNGKey(1))
+    assert multi_start_maximization._cache_size() == n_compiled
+
+def test_adapt_local_sampler():
+    
+    # correlated gaussian target, sampled with the adaptive kernels from a poorly scaled step size
+    cov = jnp.array([[1., 0.09], [0.09, 0.01]])
+    precision = jnp.linalg.inv(cov)
+    logpdf = lambda x, data: -0.5 * x @ precision @ x
+    x0 = jax.random.normal(jax.random.PRNGKey(1), (200, 2)) * jnp.array([1., 0.1])
+    for name, sampler in [("MALA", AdaptiveMALA), ("GaussianRandomWalk", AdaptiveGaussianRandomWalk)]:
+        local_sampler = sampler(logpdf, True, {})
+        cholesky = estimate_mass_matrix(x0[:, None], dense=True)
+        data = {"local_sampler": {"step_size": cholesky}}
+        keys = jax.random.split(jax.random.PRNGKey(0), 200)
+        step_scale, keys = tune_step_scale(local_sampler.kernel_vmap, keys, x0, local_sampler.logpdf_vmap(x0, data), data, cholesky, 1e-3, TARGET_ACCEPTANCE[name])
+        _, chains, _, acceptance = local_sampler.sample(keys, 200, x0, {"local_sampler": {"step_size": step_scale * cholesky}})
+        assert abs(jnp.mean(acceptance) - TARGET_ACCEPTANCE[name]) < 0.15
+        assert jnp.allclose(jnp.cov(chains[:, 50:].reshape(-1, 2).T), cov, rtol=0.15, atol=5e-3)
+    
+    # without a given step size, the mass matrix is estimated from the chains
+    fiesta = create_fiesta(local_sampler_arg={}, mass_matrix="dense")
+    fiesta.sample(jax.random.PRNGKey(0))
+    step_size = fiesta.Sampler.local_sampler.params["step_size"]
+    assert jnp.all(jnp.isfinite(step_size))
+    assert jnp.allclose(step_size, jnp.tril(step_size))
+    assert jnp.mean(fiesta.Sampler.summary["production"]["local_accs"]) > 0
+    
+    with pytest.raises(ValueError):
+        create_fiesta(local_sampler_arg={}, adapt_local_sampler=False)
+
+def test_early_stopping(tmp_path):
+    
+    # independent draws are converged, shifted chains are not
+    chains = jax.random.normal(jax.random.PRNGKey(0), (8, 1_000, 2))
+    diagnostics = compute_diagnostics(chains)
+    assert jnp.allclose(diagnostics["rhat"], 1., atol=0.01)
+    assert jnp.all(diagnostics["bulk_ess"] > 6_000) and jnp.all(diagnostics["tail_ess"] > 6_000)
+    assert jnp.all(compute_diagnostics(chains + jnp.arange(8)[:, None, None])["rhat"] > 1.5)
+    
+    # with loose thresholds, training stops once the loss change is defined and production after its first loop
+    fiesta = create_fiesta(n_loop_training=4, n_loop_production=4, loss_tolerance=1e6, rhat_threshold=1e6, target_ess=1.)
+    fiesta.sample(jax.random.PRNGKey(0), outdir=tmp_path)
+    assert fiesta.Sampler.summary["training"]["loss_vals"].shape[0] == 2
+    assert fiesta.Sampler.summary["production"]["chains"].shape[1] == 3 + 3
+    
+    with open(os.path.join(tmp_path, DIAGNOSTICS_FILENAME)) as f:
+        history = json.load(f)
+    assert [(record["stage"], record["loop"], record["converged"]) for record in history] == [("training", 1, False), ("training", 2, True), ("production", 1, True)]
+    assert set(history[-1]["total_bulk_ess"].keys()) == set(fiesta.prior.naming)
+
+def test_posterior_predictive(tmp_path):
+    
+    fiesta = create_fiesta()
+    fiesta.sample(jax.random.PRNGKey(0), outdir=tmp_path, stream_output=True)
+    chains = fiesta.posterior_file.read("chains")
+    chain_idx, step_idx = np.array([3, 0, 2, 0]), np.array([1, 5, 0, 11])
+    assert np.array_equal(fiesta.posterior_file.read_points("chains", chain_idx, step_idx, chunk_steps=4), chains[chain_idx, step_idx])
+    
+    posterior_predictive = fiesta.save_posterior_predictive(tmp_path, n_samples=30, chunk_size=8)
+    n_filters, n_times = len(fiesta.likelihood.filters), len(posterior_predictive["times"])
+    assert posterior_predictive["bands"].shape == (5, n_filters, n_times)
+    assert np.all(np.diff(posterior_predictive["bands"], axis=0) >= 0)
+    
+    # the batched prediction agrees with the prediction of a single sample
+    sample = chains[1, 2]
+    _, mag = fiesta.predict_lightcurves(sample[:, None], chunk_size=8)
+    x = fiesta.likelihood.conversion({**fiesta.prior.transform(fiesta.prior.add_name(sample)), **fiesta.likelihood.fixed_params})
+    _, mag_single = fiesta.likelihood.model.predict(x)
+    for i, filt in enumerate(fiesta.likelihood.filters):
+        assert jnp.allclose(mag[0, i], mag_single[filt], atol=1e-4)
+    
+    fiesta.plot_lightcurves(os.path.join(tmp_path, POSTERIOR_PREDICTIVE_FILENAME), outdir=tmp_path)
+    assert os.path.exists(os.path.join(tmp_path, "lightcurves.png"))
+    
+    # without arguments, the saved posterior predictive is plotted
+    fiesta.plot_lightcurves(outdir=tmp_path)
+    assert fiesta.posterior_predictive is posterior_predictive
+    with pytest.warns(DeprecationWarning):
+        fiesta.plot_lightcurves(outdir=tmp_path, N_curves=20, chunk_size=8)
+    with pytest.warns(DeprecationWarning):
+        fiesta.plot_lightcurves(20, outdir=tmp_path, chunk_size=8)
+
+def test_posterior_predictive_offsets(tmp_path):
+    
+    likelihood_kwargs = {"fixed_params": {"redshift": 0.01}, "marginalize_distance_modulus": True, "calibration_offsets": {"bessellv": 0.5}, "detections_only": True}
+    fiesta = create_fiesta(likelihood_kwargs)
+    fiesta.sample(jax.random.PRNGKey(0))
+    
+    # the offsets are added to the absolute magnitudes, which would be off by a distance modulus of about 33
+    posterior_predictive = fiesta.get_posterior_predictive(n_samples=30, chunk_size=8)
+    assert np.all(np.diff(posterior_predictive["bands"], axis=0) >= 0)
+    for i, filt in enumerate(fiesta.likelihood.filters):
+        mag_obs = fiesta.likelihood.mag_det[filt]
+        mag_est = np.interp(fiesta.likelihood.times_det[filt], posterior_predictive["times"], posterior_predictive["best_fit"][i])
+        assert np.all(np.abs(mag_est - mag_obs) < 10)
+    
+    # the same sample gets different offsets in every draw, the mean without a key
+    sample = fiesta.get_production_log_prob()[1](np.array([0, 0]))
+    _, mag = fiesta.predict_lightcurves(sample, key=jax.random.key(0))
+    assert not jnp.allclose(mag[0], mag[1])
+    _, mag = fiesta.predict_lightcurves(sample)
+    assert jnp.allclose(mag[0], mag[1])
+    
+    fiesta.plot_lightcurves(outdir=tmp_path, n_samples=30, chunk_size=8)
+    assert os.path.exists(os.path.join(tmp_path, "lightcurves.png"))
+
+def test_smc():
+    
+    # gaussian likelihood inside a uniform prior box, the evidence is the inverse volume of the box
+    n_traces = []
+    def prior_and_likelihood(x, data):
+        n_traces.append(1)
+        mu, sigma = data
+        log_prior = jnp.where(jnp.all(jnp.abs(x) < 5, axis=1), -jnp.log(100.), -jnp.inf)
+        log_likelihood = jnp.sum(-0.5 * ((x - mu) / sigma)**2 - jnp.log(sigma) - 0.5 * jnp.log(2 * jnp.pi), axis=1)
+        return log_prior, log_likelihood
+    
+    x = jax.random.uniform(jax.random.PRNGKey(0), (1_000, 2), minval=-5, maxval=5)
+    flow = MaskedCouplingRQSpline(2, 2, [8, 8], 4, jax.random.PRNGKey(1))
+    mu, sigma = jnp.array([1., -2.]), jnp.array([0.5, 0.05])
+    for n_flow_steps in [0, 20]:
+        results = tempered_smc(prior_and_likelihood, x, jax.random.PRNGKey(2), (mu, sigma), flow=flow, n_flow_steps=n_flow_steps)
+        weights = jnp.exp(results["log_weights"])
+        assert abs(results["log_evidence"] + jnp.log(100.)) < 0.15
+        assert jnp.allclose(weights @ results["samples"], mu, atol=0.05)
+        assert results["betas"][results["n_steps"] - 1] == 1.
+        
+        # new data does not trace the loop again
+        n_traced = len(n_traces)
+        results = tempered_smc(prior_and_likelihood, x, jax.random.PRNGKey(2), (-mu, sigma), flow=flow, n_flow_steps=n_flow_steps)
+        assert len(n_traces) == n_traced
+        assert jnp.allclose(jnp.exp(results["log_weights"]) @ results["samples"], -mu, atol=0.1)
+    
+    fiesta = create_fiesta(sampler_backend="smc", n_particles_smc=64, n_mcmc_steps_smc=3, n_flow_steps_smc=5)
+    fiesta.sample(jax.random.PRNGKey(0))
+    assert np.isfinite(fiesta.smc_results["log_evidence"])
+    samples = fiesta.get_samples()
+    assert samples[fiesta.prior.naming[0]].shape == (64, 1)
+    assert fiesta.get_posterior_predictive(n_samples=16)["bands"].shape[0] == 5
+    fiesta.print_summary()
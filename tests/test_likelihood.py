@@ -0,0 +1,305 @@
+import json
+import os
+
+import dill
+import numpy as np
+import jax
+import jax.numpy as jnp
+import pytest
+
+from fiesta.inference.lightcurve_model import AfterglowFlux
+from fiesta.inference.likelihood import EMLikelihood, MultiEventLikelihood
+from fiesta.inference.prior import Uniform, CompositePrior
+from fiesta.inference.fiesta import Fiesta
+import fiesta.train.neuralnets as fiesta_nn
+from fiesta.inference.profiling import save_report
+from fiesta.utils import truncated_gaussian
+
+
+working_dir = os.path.dirname(__file__)
+model_dir = os.path.join(working_dir, "models")
+
+def test_output_subset():
+
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux",
+                          directory=model_dir,
+                          filters=filters)
+
+    data = {}
+    for j, filt in enumerate(filters):
+        times = np.array([2.5, 4., 7.5 + j, 30.])
+        data[filt] = np.array([times, np.full(4, 20.), np.full(4, 0.1)]).T
+
+    fixed_params = {"luminosity_distance": 40.0, "redshift": 0.01}
+    likelihood = EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params)
+    likelihood_subset = EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params, output_subset=True)
+
+    assert likelihood_subset.model is model
+    assert not (likelihood.has_truncation or likelihood.has_nondetections)
+    assert len(likelihood_subset.evaluation_model.times) < len(model.times)
+
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    assert jnp.allclose(likelihood.evaluate(theta), likelihood_subset.evaluate(theta), rtol=1e-5)
+
+def create_cvae_flux_model(directory: str, name: str = "cvae"):
+    """Write an untrained CVAE flux model with the scalers and grids of the test flux model."""
+    
+    with open(os.path.join(model_dir, "flux_metadata.pkl"), "rb") as meta_file:
+        metadata = dill.load(meta_file)
+    metadata["model_type"] = "CVAE"
+    with open(os.path.join(directory, f"{name}_metadata.pkl"), "wb") as meta_file:
+        dill.dump(metadata, meta_file)
+    
+    config = fiesta_nn.NeuralnetConfig(output_size=10, hidden_layer_sizes=[16], latent_dim=4)
+    net = fiesta_nn.CVAE(config=config, conditional_dim=len(metadata["parameter_names"]), key=jax.random.key(0))
+    net.trained_state = net.state
+    net.save_model(outfile=os.path.join(directory, f"{name}.pkl"))
+
+def test_surrogate_uncertainty(tmp_path):
+    
+    create_cvae_flux_model(tmp_path)
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="cvae", directory=tmp_path, filters=filters)
+    assert model.latent_dim == 4
+    
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    x = {**theta, "luminosity_distance": 40.0, "redshift": 0.01}
+    times, mag, mag_var = model.predict_with_uncertainty(x, jax.random.key(1), n_latent=16)
+    for filt in model.filters:
+        assert mag[filt].shape == mag_var[filt].shape == times.shape
+        assert jnp.all(mag_var[filt] >= 0)
+    
+    data = {}
+    for filt in model.filters:
+        times = np.array([2.5, 4., 7.5, 30.])
+        data[filt] = np.array([times, np.full(4, 20.), np.full(4, 0.1)]).T
+    fixed_params = {"luminosity_distance": 40.0, "redshift": 0.01}
+    likelihood = EMLikelihood(model, data, filters=model.filters.copy(), fixed_params=fixed_params, surrogate_uncertainty=True, n_latent=16)
+    
+    # the latent vectors are fixed, so the likelihood is deterministic
+    assert jnp.isfinite(likelihood.evaluate(theta))
+    assert likelihood.evaluate(theta) == likelihood.evaluate(theta)
+    
+    mlp_model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    with pytest.raises(ValueError):
+        EMLikelihood(mlp_model, data, filters=mlp_model.filters.copy(), fixed_params=fixed_params, surrogate_uncertainty=True)
+    
+    # the offsets are drawn from the same magnitudes and uncertainties as the likelihood uses,
+    # the small observational uncertainties of the radio data make the surrogate variance matter
+    for j, filt in enumerate(model.filters):
+        data[filt][:, 2] = [0.01, 0.3][j]
+    likelihood = EMLikelihood(model, data, filters=model.filters.copy(), fixed_params=fixed_params, surrogate_uncertainty=True, n_latent=16)
+    marginalized = EMLikelihood(model, data, filters=model.filters.copy(), fixed_params={"redshift": 0.01}, surrogate_uncertainty=True, n_latent=16, marginalize_distance_modulus=True)
+    distance_modulus = jnp.linspace(-20., 80., 20_001)
+    luminosity_distance = 10**(distance_modulus / 5 + 1) / 1e6
+    log_likelihood = jax.vmap(lambda d: likelihood.evaluate(theta, {**likelihood.data, "fixed_params": {"luminosity_distance": d, "redshift": 0.01}}))(luminosity_distance)
+    mean = jnp.sum(jax.nn.softmax(log_likelihood) * distance_modulus)
+    offsets = marginalized.sample_offsets({name: jnp.full(2, value) for name, value in theta.items()})
+    assert jnp.allclose(offsets["distance_modulus"], mean, atol=1e-3)
+
+@pytest.mark.parametrize("fixed_redshift", [True, False])
+def test_packed_observations(fixed_redshift):
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    
+    data = {"radio-6GHz": np.array([[2.5, 20., 0.1], [4., 21., 0.2], [9., 19., np.inf]]),
+            "bessellv": np.array([[1.5, 22., 0.1], [30., 20., np.inf], [60., 23., 0.3], [0.01, 18., 0.1]])}
+    fixed_params = {"luminosity_distance": 40.0, "redshift": 0.01} if fixed_redshift else {"luminosity_distance": 40.0}
+    detection_limit = {"radio-6GHz": jnp.inf, "bessellv": 25.}
+    likelihood = EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params, detection_limit=detection_limit, error_budget=0.5)
+    assert likelihood.obs_times.shape == (7,)
+    assert jnp.sum(likelihood.obs_is_det) == 5
+    assert likelihood.has_truncation and likelihood.has_nondetections
+    
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    if not fixed_redshift:
+        # the time grid is stretched by the sampled redshift
+        theta["redshift"] = 0.3
+        assert likelihood.stretched_times and likelihood.log_uniform_times
+    
+    # reference with one interpolation per filter
+    times, mag_app = model.predict({**theta, **fixed_params})
+    expected = 0.
+    for filt in filters:
+        interp = lambda t: jnp.interp(t, times, mag_app[filt], left="extrapolate", right="extrapolate")
+        sigma = jnp.sqrt(likelihood.mag_err[filt]**2 + 0.5**2)
+        mag_est = interp(likelihood.times_det[filt])
+        if detection_limit[filt] == jnp.inf:
+            expected += jnp.sum(-0.5 * (likelihood.mag_det[filt] - mag_est)**2 / sigma**2)
+        else:
+            expected += jnp.sum(jax.scipy.stats.truncnorm.logpdf(likelihood.mag_det[filt], (-999 - mag_est) / sigma, (25. - mag_est) / sigma, loc=mag_est, scale=sigma))
+        expected += jnp.sum(jax.scipy.stats.norm.logsf(likelihood.mag_nondet[filt], interp(likelihood.times_nondet[filt]), 0.5))
+    
+    assert jnp.allclose(likelihood.evaluate(theta), expected, rtol=1e-6)
+
+def test_missing_filter():
+
+    filters = ["radio-6GHz", "bessellv", "bessellb"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+
+    # no data in the first filter, the model is shared and must keep all filters
+    data = {"bessellv": np.array([[1.5, 22., 0.1], [60., 23., 0.3]]),
+            "bessellb": np.array([[2.5, 21., 0.1], [30., 22., 0.2]])}
+    fixed_params = {"luminosity_distance": 40.0, "redshift": 0.01}
+    likelihood = EMLikelihood(model, data, fixed_params=fixed_params)
+    assert likelihood.filters == ["bessellv", "bessellb"]
+    assert model.filters == filters
+
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    times, mag_app = model.predict({**theta, **fixed_params})
+    assert set(mag_app.keys()) == set(filters)
+
+    expected = 0.
+    for filt in likelihood.filters:
+        mag_est = jnp.interp(likelihood.times_det[filt], times, mag_app[filt])
+        expected += jnp.sum(-0.5 * (likelihood.mag_det[filt] - mag_est)**2 / likelihood.sigma[filt]**2)
+    assert jnp.allclose(likelihood.evaluate(theta), expected, rtol=1e-6)
+
+def test_evaluate_batch():
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    data = {"radio-6GHz": np.array([[2.5, 20., 0.1], [4., 21., 0.2], [9., 19., np.inf]]),
+            "bessellv": np.array([[1.5, 22., 0.1], [30., 20., np.inf], [60., 23., 0.3]])}
+    # the likelihood filters are ordered differently than the model filters
+    likelihood = EMLikelihood(model, data, filters=filters[::-1], fixed_params={"luminosity_distance": 40.0})
+    
+    X = np.array([3.141/30, 54., 0.05, -1., 2.5, -2., -4.])
+    X = X + np.random.default_rng(0).uniform(-0.01, 0.01, size=(5, len(X)))
+    theta = dict(zip(model.parameter_names, X.T))
+    theta["redshift"] = np.linspace(0.01, 0.5, 5)
+    
+    expected = jax.vmap(likelihood.evaluate)(theta)
+    assert jnp.allclose(likelihood.evaluate_batch(theta), expected, rtol=1e-5)
+
+def test_shared_compilation():
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    
+    # two events with a different number of observations and luminosity distance that fall into the same bucket
+    likelihoods = []
+    for n_obs, luminosity_distance in zip([5, 7], [40.0, 80.0]):
+        data = {}
+        for filt in filters:
+            times = np.geomspace(1., 50., n_obs)
+            data[filt] = np.array([times, np.full(n_obs, 20.), np.full(n_obs, 0.1)]).T
+        fixed_params = {"luminosity_distance": luminosity_distance, "redshift": 0.01}
+        likelihoods.append(EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params))
+    
+    assert likelihoods[0].data["mag"].shape == likelihoods[1].data["mag"].shape == (16,)
+    
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    evaluate = jax.jit(likelihoods[0].evaluate)
+    for likelihood in likelihoods:
+        assert jnp.allclose(evaluate(theta, likelihood.data), likelihood.evaluate(theta), rtol=1e-6)
+    assert evaluate._cache_size() == 1
+
+def test_multi_event_likelihood():
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    
+    likelihoods = []
+    for n_obs, luminosity_distance in zip([3, 5, 12], [40.0, 80.0, 160.0]):
+        data = {}
+        for filt in filters:
+            times = np.geomspace(1., 50., n_obs)
+            data[filt] = np.array([times, np.full(n_obs, 20.), np.full(n_obs, 0.1)]).T
+        fixed_params = {"luminosity_distance": luminosity_distance, "redshift": 0.01}
+        likelihoods.append(EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params))
+    n_data = [len(likelihood.data["mag"]) for likelihood in likelihoods]
+    multi_likelihood = MultiEventLikelihood(likelihoods)
+    assert multi_likelihood.data["mag"].shape == (3, 32)
+    # the likelihoods of the single events are not changed
+    assert [len(likelihood.data["mag"]) for likelihood in likelihoods] == n_data != [32] * 3
+    
+    X = np.array([3.141/30, 54., 0.05, -1., 2.5, -2., -4.]) + np.linspace(0, 0.01, 3)[:, None]
+    theta = dict(zip(model.parameter_names, X.T))
+    expected = [likelihood.evaluate({key: value[j] for key, value in theta.items()}) for j, likelihood in enumerate(likelihoods)]
+    assert jnp.allclose(multi_likelihood.evaluate_events(theta), jnp.array(expected), rtol=1e-6)
+    
+    priors = [Uniform(xmin=float(xmin), xmax=float(xmax), naming=[name]) for name, (xmin, xmax, _) in model.parameter_distributions.items()]
+    prior = CompositePrior(priors)
+    fiesta = Fiesta(multi_likelihood, prior, n_chains=4)
+    assert fiesta.n_dim == 3 * prior.n_dim
+    expected_posterior = jnp.sum(jnp.array(expected)) + sum(prior.log_prob(dict(zip(prior.naming, x))) for x in X)
+    assert jnp.allclose(fiesta.posterior(jnp.array(X).flatten(), multi_likelihood.data), expected_posterior, rtol=1e-6)
+
+def test_truncated_gaussian():
+    
+    mag_est = jnp.array([20., 21., 24.9, 26., 30.])
+    sigma = jnp.array([0.1, 0.5, 1., 0.3, 0.5])
+    mag_det, lim = 22., 25.
+    expected = jax.scipy.stats.truncnorm.logpdf(mag_det, (-999 - mag_est) / sigma, (lim - mag_est) / sigma, loc=mag_est, scale=sigma)
+    assert jnp.allclose(truncated_gaussian(mag_det, sigma, mag_est, lim), expected, rtol=1e-5)
+    
+    # finite gradients also if the estimate lies beyond the detection limit
+    grad = jax.grad(lambda x: jnp.sum(truncated_gaussian(mag_det, sigma, x, lim)))(mag_est)
+    assert jnp.all(jnp.isfinite(grad))
+    assert truncated_gaussian(26., 0.1, 20., lim) == -jnp.inf
+
+def test_marginalized_offsets():
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    data = {"radio-6GHz": np.array([[2.5, 20., 0.1], [4., 21., 0.2], [9., 19., 0.1]]),
+            "bessellv": np.array([[1.5, 22., 0.1], [30., 20., 0.2], [60., 23., 0.3]])}
+    fixed_params = {"redshift": 0.01}
+    likelihood = EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params, error_budget=0.3)
+    marginalized = EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params, error_budget=0.3, marginalize_distance_modulus=True)
+    assert marginalized.offset_names == ["distance_modulus"]
+    
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    
+    # numerical integration over the distance modulus with a flat prior
+    distance_modulus = jnp.linspace(-20., 80., 20_001)
+    luminosity_distance = 10**(distance_modulus / 5 + 1) / 1e6
+    log_likelihood = jax.vmap(lambda d: likelihood.evaluate({**theta, "luminosity_distance": d}))(luminosity_distance)
+    expected = jax.scipy.special.logsumexp(log_likelihood) + jnp.log(distance_modulus[1] - distance_modulus[0])
+    # the marginalized likelihood drops the constant 1/2 log(2 pi) of the Gaussian integral
+    assert jnp.allclose(marginalized.evaluate(theta) + 0.5 * jnp.log(2 * jnp.pi), expected, atol=1e-2)
+    
+    offsets = marginalized.sample_offsets({name: jnp.full((2, 500), value) for name, value in theta.items()}, jax.random.key(0))
+    assert offsets["distance_modulus"].shape == offsets["luminosity_distance"].shape == (2, 500)
+    posterior = jax.nn.softmax(log_likelihood)
+    mean = jnp.sum(posterior * distance_modulus)
+    std = jnp.sqrt(jnp.sum(posterior * (distance_modulus - mean)**2))
+    assert jnp.abs(jnp.mean(offsets["distance_modulus"]) - mean) < 0.2 * std
+    
+    # calibration offsets with Gaussian priors, batched evaluation
+    marginalized = EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params, error_budget=0.3, marginalize_distance_modulus=True, calibration_offsets={"bessellv": 0.1})
+    theta_batch = {name: jnp.full(3, value) + jnp.linspace(0, 0.01, 3) for name, value in theta.items()}
+    assert jnp.allclose(marginalized.evaluate_batch(theta_batch), jax.vmap(marginalized.evaluate)(theta_batch), rtol=1e-5)
+    
+    # flat priors on the distance modulus and the offsets of all filters are degenerate
+    with pytest.raises(ValueError):
+        EMLikelihood(model, data, filters=filters.copy(), fixed_params=fixed_params, marginalize_distance_modulus=True, calibration_offsets={"radio-6GHz": np.inf, "bessellv": np.inf})
+
+def test_profiling(tmp_path):
+    
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=filters)
+    data = {"radio-6GHz": np.array([[2.5, 20., 0.1], [4., 21., 0.2], [9., 19., np.inf]]),
+            "bessellv": np.array([[1.5, 22., 0.1], [30., 20., 0.2], [60., 23., 0.3]])}
+    likelihood = EMLikelihood(model, data, filters=filters.copy(), fixed_params={"luminosity_distance": 40.0, "redshift": 0.01})
+    
+    X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
+    theta = dict(zip(model.parameter_names, X))
+    report = likelihood.profile(theta, n_repeat=2)
+    assert list(report["stages"]) == ["project_input", "apply_fn", "inverse_transform", "get_mag", "interpolate", "log_prob", "evaluate"]
+    for stage in report["stages"].values():
+        assert stage["time"] > 0 and stage["grad_time"] > 0
+    
+    save_report(report, os.path.join(tmp_path, "report.json"))
+    save_report(report, os.path.join(tmp_path, "report.txt"))
+    with open(os.path.join(tmp_path, "report.json")) as f:
+        assert json.load(f)["stages"].keys() == report["stages"].keys()
@@ -1,6 +1,19 @@
+import copy
 import os
 
-from fiesta.inference.lightcurve_model import AfterglowFlux
+import dill
+import numpy as np
+import jax
+import jax.numpy as jnp
+import pytest
+
+from fiesta.inference.aot import get_export_key
+from fiesta.inference.bundle import convert_to_bundle
+from fiesta.inference.lightcurve_model import AfterglowFlux, BullaLightcurveModel
+from fiesta.inference.registry import ModelRegistry
+from fiesta import filters as fiesta_filters
+from fiesta.scalers import DataScaler, ImageScaler, MinMaxScalerJax, StandardScalerJax, SVDDecomposer
+import fiesta.train.neuralnets as fiesta_nn
 
 
 ##############
@@ -19,4 +32,254 @@ def test_models():
     X = [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]
     mag = model.predict_abs_mag(dict(zip(model.parameter_names, X)))
 
+def test_filter_mag_weights():
+    
+    nus = jnp.geomspace(1e9, 1e19, 40)
+    flux = jnp.exp(jax.random.normal(jax.random.key(0), (len(nus), 5)))
+    for name in ["radio-6GHz", "bessellv", "X-ray-1keV", "XRT0.3-10"]:
+        Filter = fiesta_filters.get_filter(name)
+        W, offset = Filter.get_mag_weights(nus)
+        assert jnp.allclose(-2.5 * jnp.log10(W @ flux) + offset, Filter.get_mag(flux, nus), atol=1e-4)
+
+def test_image_scaler_output_subset():
+    
+    # output scaler of the CVAE flux models, see fiesta.train.DataManager
+    scaler = DataScaler([ImageScaler(downscale=(6, 8), upscale=(12, 30)), StandardScalerJax()])
+    scaler.fit(jax.random.normal(jax.random.key(0), (20, 12 * 30)))
+    x = jax.random.normal(jax.random.key(1), (3, 6 * 8))
+    idx = np.array([0, 7, 29, 30, 200, 359])
+    
+    subset = scaler.output_subset(idx)
+    expected = scaler.inverse_transform(x).reshape(3, -1)[:, idx]
+    assert jnp.allclose(subset.inverse_transform(x), expected, atol=1e-5)
+    assert jnp.allclose(subset.astype(jnp.float32).inverse_transform(x), expected, atol=1e-4)
+
+####################
+# Lightcurve model #
+####################
+
+lc_filters = ["bessellb", "bessellv", "bessellr"]
+lc_parameter_names = ["log10_mej_dyn", "log10_mej_wind", "KNphi", "KNtheta"]
+
+def create_lightcurve_model(directory: str, name: str = "lc", n_ensemble: int = 1):
+    """Write a small untrained lightcurve model with the same file layout as fiesta.train.LightcurveTrainer.save()."""
+    
+    times = np.geomspace(0.2, 20, 30)
+    X_raw = np.random.uniform(0, 1, size=(50, len(lc_parameter_names)))
+    X_scaler = MinMaxScalerJax()
+    X_scaler.fit(X_raw)
+    
+    y_scaler = {}
+    config = fiesta_nn.NeuralnetConfig(output_size=5, hidden_layer_sizes=[8, 8])
+    for j, filt in enumerate(lc_filters):
+        y_raw = np.random.normal(-15, 1, size=(50, len(times)))
+        y_scaler[filt] = DataScaler([SVDDecomposer(5)])
+        y_scaler[filt].fit(jnp.array(y_raw))
+        
+        if n_ensemble > 1:
+            net = fiesta_nn.MLPEnsemble(config=config, input_ndim=len(lc_parameter_names), n_ensemble=n_ensemble, key=jax.random.key(j))
+        else:
+            net = fiesta_nn.MLP(config=config, input_ndim=len(lc_parameter_names), key=jax.random.key(j))
+        net.trained_state = net.state
+        net.save_model(outfile=os.path.join(directory, f"{name}_{filt}.pkl"))
+    
+    metadata = {"times": times,
+                "parameter_names": lc_parameter_names,
+                "parameter_distributions": str({p: (0, 1, "uniform") for p in lc_parameter_names}),
+                "X_scaler": X_scaler,
+                "y_scaler": y_scaler,
+                "model_type": "MLPEnsemble" if n_ensemble > 1 else "MLP"}
+    with open(os.path.join(directory, f"{name}_metadata.pkl"), "wb") as meta_file:
+        dill.dump(metadata, meta_file)
+
+def test_fused_lightcurve_model(tmp_path):
+    
+    create_lightcurve_model(tmp_path)
+    model = BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters)
+    fused_model = BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters, fused=True)
+    
+    x = dict(zip(lc_parameter_names, [0.1, 0.2, 0.3, 0.4]))
+    x["luminosity_distance"] = 40.0
+    times, mag = model.predict(x)
+    fused_times, fused_mag = fused_model.predict(x)
+    
+    assert jnp.allclose(times, fused_times)
+    for filt in lc_filters:
+        assert jnp.allclose(mag[filt], fused_mag[filt], atol=1e-4)
+
+def test_ensemble_lightcurve_model(tmp_path):
+    
+    create_lightcurve_model(tmp_path, n_ensemble=4)
+    x = dict(zip(lc_parameter_names, [0.1, 0.2, 0.3, 0.4]))
+    x["luminosity_distance"] = 40.0
+    
+    for fused in [False, True]:
+        model = BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters, fused=fused)
+        assert model.predicts_uncertainty
+        times, mag = model.predict(x)
+        _, mag_mean, mag_var = model.predict_with_uncertainty(x)
+        for filt in lc_filters:
+            # the magnitudes are linear in the network output, so the ensemble mean is the prediction
+            assert jnp.allclose(mag[filt], mag_mean[filt], atol=1e-4)
+            assert mag_var[filt].shape == times.shape
+            assert jnp.all(mag_var[filt] > 0)
+    
+    convert_to_bundle(tmp_path, "lc")
+    bundle_model = BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters)
+    _, bundle_mag = bundle_model.predict(x)
+    for filt in lc_filters:
+        assert jnp.allclose(mag[filt], bundle_mag[filt])
+
+def test_ensemble_flux_model(tmp_path):
+
+    # untrained ensemble with the scalers and grids of the test flux model
+    with open(os.path.join(model_dir, "flux_metadata.pkl"), "rb") as meta_file:
+        metadata = dill.load(meta_file)
+    metadata["model_type"] = "MLPEnsemble"
+    with open(os.path.join(tmp_path, "ensemble_metadata.pkl"), "wb") as meta_file:
+        dill.dump(metadata, meta_file)
+    config = fiesta_nn.NeuralnetConfig(output_size=10, hidden_layer_sizes=[16])
+    net = fiesta_nn.MLPEnsemble(config=config, input_ndim=len(metadata["parameter_names"]), n_ensemble=4, key=jax.random.key(0))
+    net.trained_state = net.state
+    net.save_model(outfile=os.path.join(tmp_path, "ensemble.pkl"))
+
+    filters = ["radio-6GHz", "bessellv"]
+    model = AfterglowFlux(name="ensemble", directory=tmp_path, filters=filters)
+    assert model.predicts_uncertainty and model.latent_dim == 0
+    x = dict(zip(model.parameter_names, [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]))
+    x["luminosity_distance"] = 40.0
+    x["redshift"] = 0.01
+    _, mag = model.predict(x)
+
+    convert_to_bundle(tmp_path, "ensemble")
+    bundle_model = AfterglowFlux(name="ensemble", directory=tmp_path, filters=filters)
+    assert bundle_model.bundle is not None and bundle_model.latent_dim == 0
+    _, bundle_mag = bundle_model.predict(x)
+    for filt in filters:
+        assert jnp.allclose(mag[filt], bundle_mag[filt])
+
+def test_ensemble_training():
+    
+    config = fiesta_nn.NeuralnetConfig(output_size=3, hidden_layer_sizes=[8], nb_epochs=50, learning_rate=1e-2)
+    X = np.random.uniform(0, 1, size=(64, 2))
+    y = np.stack([X[:, 0], X[:, 1], X[:, 0] * X[:, 1]], axis=1)
+    net = fiesta_nn.MLPEnsemble(config=config, input_ndim=2, n_ensemble=3)
+    state, train_losses, _ = net.train_loop(X, y, verbose=False)
+    
+    assert jax.tree.leaves(state.params)[0].shape[0] == 3
+    assert train_losses[-1] < train_losses[0]
+
+def test_predict_batch():
+    
+    model = AfterglowFlux(name="flux",
+                          directory=model_dir,
+                          filters=["radio-6GHz", "bessellv", "X-ray-1keV"])
+    
+    X = jnp.array([[3.141/30, 54., 0.05, -1., 2.5, -2., -4.],
+                   [3.141/20, 53., 0.1, -2., 2.2, -1.5, -3.],
+                   [3.141/10, 52., 0.07, -3., 2.3, -1., -2.]])
+    times, mag = model.predict_batch(X, 40.0, 0.01, chunk_size=2)
+    assert mag.shape == (3, len(model.filters), len(model.times))
+    
+    for j in range(len(X)):
+        x = dict(zip(model.parameter_names, X[j]))
+        x["luminosity_distance"] = 40.0
+        x["redshift"] = 0.01
+        times_single, mag_single = model.predict(x)
+        assert jnp.allclose(times, times_single)
+        for k, filt in enumerate(model.filters):
+            assert jnp.allclose(mag[j, k], mag_single[filt], atol=1e-4)
+    
+    _, mag = model.predict_batch(X[:0], 40.0, 0.01)
+    assert mag.shape == (0, len(model.filters), len(model.times))
+
+def test_precision():
+    
+    model = AfterglowFlux(name="flux",
+                          directory=model_dir,
+                          filters=["radio-6GHz", "bessellv"])
+    
+    for precision in ["float32", "bfloat16", "int8"]:
+        reduced_model = AfterglowFlux(name="flux",
+                                      directory=model_dir,
+                                      filters=["radio-6GHz", "bessellv"],
+                                      precision=precision)
+        assert reduced_model.precision == precision
+        assert reduced_model.get_error(model, n_test=100) < 0.05
+    
+    # the accuracy guard refuses the reduced precision for a strict threshold
+    with pytest.raises(ValueError):
+        model.set_precision("int8", threshold=1e-8, n_test=100)
+    assert model.precision == "float64"
+
+def test_bundle(tmp_path):
+    
+    convert_to_bundle(model_dir, "flux", outfile=os.path.join(tmp_path, "flux.fiesta"))
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=["radio-6GHz", "bessellv"])
+    bundle_model = AfterglowFlux(name="flux", directory=tmp_path, filters=["radio-6GHz", "bessellv"])
+    assert bundle_model.bundle is not None
+    
+    x = dict(zip(model.parameter_names, [3.141/30, 54., 0.05, -1., 2.5, -2., -4.]))
+    x["luminosity_distance"] = 40.0
+    x["redshift"] = 0.01
+    _, mag = model.predict(x)
+    _, bundle_mag = bundle_model.predict(x)
+    for filt in model.filters:
+        assert jnp.allclose(mag[filt], bundle_mag[filt])
+    
+    create_lightcurve_model(tmp_path)
+    convert_to_bundle(tmp_path, "lc")
+    assert BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters).bundle is not None
+    # a network that changed after the conversion makes the bundle stale
+    network_file = os.path.join(tmp_path, f"lc_{lc_filters[0]}.pkl")
+    os.utime(network_file, ns=(0, os.stat(network_file).st_mtime_ns + 10**9))
+    assert BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters).bundle is None
+
+    convert_to_bundle(tmp_path, "lc")
+    os.remove(os.path.join(tmp_path, "lc_metadata.pkl"))
+    bundle_model = BullaLightcurveModel(name="lc", directory=tmp_path, filters=lc_filters[:2])
+    assert len(bundle_model.models) == 0 # networks are only loaded on first use
+    x = dict(zip(lc_parameter_names, [0.1, 0.2, 0.3, 0.4]))
+    x["luminosity_distance"] = 40.0
+    bundle_model.predict(x)
+    assert sorted(bundle_model.models.keys()) == sorted(lc_filters[:2])
+
+def test_exported_predict(tmp_path):
+    
+    pytest.importorskip("flatbuffers") # needed by jax to serialize exported functions
+    model = AfterglowFlux(name="flux", directory=model_dir, filters=["radio-6GHz", "bessellv"])
+    for _ in range(2): # export in the first iteration, load from file in the second
+        exported_model = AfterglowFlux(name="flux", directory=model_dir, filters=["radio-6GHz", "bessellv"])
+        exported_model.load_exported_predict(cache_dir=tmp_path)
+    # the function is exported to the cache and the global jax configuration is not changed
+    assert len(os.listdir(os.path.join(tmp_path, "exported"))) == 1
+    assert jax.config.jax_compilation_cache_dir is None
+    
+    # models with grids of the same length, e.g. output subsets, are exported separately
+    shifted_model = copy.copy(model)
+    shifted_model.times = model.times + 1.
+    assert get_export_key(shifted_model) != get_export_key(model)
+    
+    X = jnp.array([[3.141/30, 54., 0.05, -1., 2.5, -2., -4.],
+                   [3.141/20, 53., 0.1, -2., 2.2, -1.5, -3.],
+                   [3.141/10, 52., 0.07, -3., 2.3, -1., -2.]])
+    for n_samples in [3, 2]: # new batch sizes use the same exported function
+        _, mag = model.predict_batch(X[:n_samples], 40.0, 0.01)
+        _, exported_mag = exported_model.predict_batch(X[:n_samples], 40.0, 0.01)
+        assert jnp.allclose(mag, exported_mag)
+
+def test_registry():
+    
+    registry = ModelRegistry()
+    model = registry.get_model(AfterglowFlux, "flux", model_dir, filters=["radio-6GHz", "bessellv"])
+    assert registry.get_model(AfterglowFlux, "flux", model_dir, filters=["radio-6GHz", "bessellv"]) is model
+    assert model.Filters[0] is fiesta_filters.get_filter("radio-6GHz")
+    assert registry.memory > 0
+    
+    # the least recently used model is evicted once the memory cap is exceeded
+    registry.max_memory = registry.memory
+    other_model = registry.get_model(AfterglowFlux, "flux", model_dir, filters=["bessellv"])
+    assert len(registry) == 1
+    assert registry.get_model(AfterglowFlux, "flux", model_dir, filters=["bessellv"]) is other_model
+
 # TODO: Add more model types here
\ No newline at end of file